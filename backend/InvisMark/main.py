@@ -47,8 +47,8 @@ import numpy as np
 import uuid
 logger = logging.getLogger(__name__)
 
-def uuid_to_bits(batch_size):
-    uid = [uuid.uuid4() for _ in range(batch_size)]
+def uuid_to_bits(batch_size, uid=None):
+    uid = uid or [uuid.uuid4() for _ in range(batch_size)]
     seq = np.array([[n for n in u.bytes] for u in uid], dtype=np.uint8)
     bits = torch.Tensor(np.unpackbits(seq, axis=1)).to(torch.float32)
     strs = [str(u) for u in uid]
@@ -319,10 +319,13 @@ class BCHECC:
     def _bitstring_to_bytes(self, s):
         return bytearray(int(s, 2).to_bytes((len(s) + 7) // 8, byteorder='big'))
 
+import io
 import os
+import sys
 import torch
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.responses import JSONResponse
+from typing import Optional
 from PIL import Image
 import torchvision.transforms as T
 
@@ -331,7 +334,17 @@ import torchvision.transforms as T
 # -----------------------
   # adjust this import
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.result_cache import ResultCache, cache_key, router as cache_router
+
 app = FastAPI(title="Watermark Encoder API")
+app.include_router(cache_router)
+
+# The encoder is deterministic for a given image and watermark, so results are
+# cached when the client passes its own watermark_uuid. Memory only: the encoder
+# weights are initialised at startup rather than loaded from a checkpoint, so
+# results from a previous process are not valid.
+watermark_cache = ResultCache("invismark", disk_bytes=0)
 
 MODEL = None
 CONFIG = None
@@ -378,11 +391,13 @@ def unload_model():
 # ------------------------------------------------------------
 # PROCESS IMAGE + INFERENCE FUNCTION
 # ------------------------------------------------------------
-def run_inference(image: Image.Image):
+def run_inference(image: Image.Image, watermark_uuid: Optional[uuid.UUID] = None):
     image_tensor = transform(image).unsqueeze(0).to(DEVICE)
 
-    # generate UUID watermark
-    watermark_bits, watermark_str = uuid_to_bits(batch_size=1)
+    # generate UUID watermark (or encode the one the client asked for)
+    watermark_bits, watermark_str = uuid_to_bits(
+        batch_size=1, uid=[watermark_uuid] if watermark_uuid else None
+    )
     watermark_bits = watermark_bits.to(DEVICE)
 
     with torch.no_grad():
@@ -396,18 +411,40 @@ def run_inference(image: Image.Image):
     save_path = "./watermarked_output.png"
     pil_img.save(save_path)
 
-    return save_path, watermark_str[0]
+    return save_path, watermark_str[0], pil_img
 
 
 # ------------------------------------------------------------
 # API ROUTE: RUN INFERENCE
 # ------------------------------------------------------------
 @app.post("/watermark")
-async def watermark_image(file: UploadFile = File(...)):
+async def watermark_image(file: UploadFile = File(...), watermark_uuid: Optional[str] = Form(None)):
     try:
-        image = Image.open(file.file).convert("RGB")
-
-        output_path, watermark_uuid = run_inference(image)
+        image_bytes = await file.read()
+
+        key = None
+        if watermark_uuid:
+            watermark_uuid = uuid.UUID(watermark_uuid)
+            key = cache_key("invismark-encoder", "startup", image_bytes, watermark=str(watermark_uuid))
+            cached = watermark_cache.get(key)
+            if cached is not None:
+                output_path = "./watermarked_output.png"
+                with open(output_path, "wb") as f:
+                    f.write(cached)
+                return JSONResponse({
+                    "status": "success",
+                    "saved_output_path": output_path,
+                    "watermark_uuid": str(watermark_uuid)
+                })
+
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+        output_path, watermark_uuid, pil_img = run_inference(image, watermark_uuid)
+
+        if key is not None:
+            buf = io.BytesIO()
+            pil_img.save(buf, format="PNG")
+            watermark_cache.put(key, buf.getvalue())
 
         return JSONResponse({
             "status": "success",
@@ -1,14 +1,26 @@
+import asyncio
 import io
+import os
+import sys
+import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
-import base64
 from fastapi import FastAPI, UploadFile, File
+from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
-from torchvision import transforms
 from transformers import AutoModelForImageSegmentation
 import huggingface_hub
+from concurrent.futures import ThreadPoolExecutor
 huggingface_hub.cached_download = huggingface_hub.hf_hub_download
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.batching import MicroBatcher
+from common.transport import check_format, decode_image, encode_image, image_response
+from common.result_cache import ResultCache, cache_key, router as cache_router
+from common.masks import refine_soft_mask
+
 app = FastAPI()
 
 app.add_middleware(
@@ -18,82 +30,167 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(residency_router)
+app.include_router(cache_router)
 
 
-model = None
+MODEL_KEY = "briaai/RMBG-2.0"
+MODEL_REVISION = "main"
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
 image_size = (512,512)
-transform_image = transforms.Compose([
-    transforms.Resize(image_size),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406],
-                            [0.229, 0.224, 0.225])
-])
+# hires=true runs at RMBG-2.0's native resolution and refines the edges at full size.
+HIRES_BASE_SIZE = 1024
 
+# Inference precision: fp16 (default on GPU), bf16 or fp32. RMBG_COMPILE=1 adds
+# torch.compile, warmed up at load for the standard base sizes so the first
+# request does not pay for compilation.
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+model_dtype = DTYPES[os.environ.get("RMBG_DTYPE", "fp16")] if device == "cuda" else torch.float32
+COMPILE = os.environ.get("RMBG_COMPILE", "0") == "1"
+WARMUP_SIZES = (image_size[0], HIRES_BASE_SIZE)
 
-@app.post("/load")
-def load_model():
-    global model
+MEAN = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1)
+STD = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1)
+
+if device == "cuda":
+    # Only a few input shapes ever reach the model, so autotuned convs pay off.
+    torch.backends.cudnn.benchmark = True
 
-    if model is not None:
-        return {"status": "already_loaded"}
 
+def _load_rmbg():
     model = AutoModelForImageSegmentation.from_pretrained(
-        "briaai/RMBG-2.0", trust_remote_code=True
-    ).eval().to(device)
+        MODEL_KEY, trust_remote_code=True
+    ).eval().to(device, dtype=model_dtype)
+    model = model.to(memory_format=torch.channels_last)
 
-    return {"status": "model_loaded", "device": device}
+    if COMPILE:
+        model = torch.compile(model)
+        with torch.no_grad():
+            for size in WARMUP_SIZES:
+                warmup = torch.zeros(1, 3, size, size, device=device, dtype=model_dtype)
+                model(warmup.contiguous(memory_format=torch.channels_last))
+    return model
 
 
-@app.post("/run")
-async def run_model(file: UploadFile = File(...)):
-    global model
-    if model is None:
-        return {"error": "Model not loaded. Call /load first."}
+residency.register(MODEL_KEY, _load_rmbg, priority=1)
 
-    
-    img_bytes = await file.read()
-    image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    original_size = image.size
 
-    
-    input_tensor = transform_image(image).unsqueeze(0).to(device)
+def _to_model_input(pixels, base_size):
+    """HxWx3 uint8 array -> normalized 1x3xSxS tensor; the resize and normalize run on the GPU."""
+    t = torch.from_numpy(pixels).to(device, non_blocking=True).permute(2, 0, 1)[None].float()
+    t = F.interpolate(t, size=(base_size, base_size), mode="bilinear", align_corners=False, antialias=True)
+    return (t / 255.0 - MEAN) / STD
+
 
-    with torch.no_grad():
-        preds = model(input_tensor)[-1].sigmoid().cpu()
+def _run_batch(items):
+    # Items are (uint8 pixels, base size), grouped by base size so every batch stacks.
+    with residency.lease(MODEL_KEY) as model, torch.no_grad():
+        batch = torch.cat([_to_model_input(pixels, base_size) for pixels, base_size in items])
+        batch = batch.to(dtype=model_dtype).contiguous(memory_format=torch.channels_last)
+        preds = model(batch)[-1].sigmoid().float().cpu()
 
+    return list(preds)
 
-    pred_mask = preds[0].squeeze()
-    pred_pil = transforms.ToPILImage()(pred_mask)
 
+# Masks are cached per input image, so undo/redo resubmits skip the model.
+mask_cache = ResultCache("rmbg_masks")
+
+batcher = MicroBatcher(
+    _run_batch, max_batch_size=8, max_wait_ms=10, name="rmbg", max_pending=64,
+    group_key=lambda item: item[1],
+)
+
+# Decoding, full-resolution alpha refinement and encoding, off the event loop
+# and off the batch worker so the next forward pass isn't held up.
+post_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rmbg-post")
+
+
+def full_res_alpha(pred, image, refine):
+    """
+    Upsamples the model's soft mask to the image size. With `refine`, the
+    uncertain band (hair, soft edges) is snapped to image edges by a guided
+    filter at full resolution; confident regions are left untouched.
+    """
+    w, h = image.size
+    alpha = F.interpolate(pred[None].float(), size=(h, w), mode="bilinear", align_corners=False)[0, 0].numpy()
+    if refine:
+        # Roughly one model pixel, in image pixels.
+        radius = max(2, round(max(w, h) / pred.shape[-1]))
+        guide = np.asarray(image.convert("L"))
+        alpha = refine_soft_mask(guide, alpha, radius=radius, eps=1e-4)
+    return Image.fromarray((np.clip(alpha, 0.0, 1.0) * 255).round().astype(np.uint8))
+
+
+def _cutout(image, pred, cached, key, refine, format):
+    if cached is not None:
+        mask = Image.open(io.BytesIO(cached))
+    else:
+        mask = full_res_alpha(pred, image, refine=refine)
+        mask_cache.put(key, encode_image(mask))
 
-    mask = pred_pil.resize(original_size)
     image.putalpha(mask)
+    return image_response(image, format)
 
 
-    buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
-    base64_img = base64.b64encode(buffer.getvalue()).decode()
+@app.post("/load")
+def load_model():
+    # Advisory: /run loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
+        return {"status": "already_loaded"}
 
-    return {"image_base64": base64_img}
+    residency.acquire(MODEL_KEY)
 
+    return {"status": "model_loaded", "device": device}
 
 
-@app.post("/unload")
-def unload_model():
-    global model
+@app.post("/run")
+async def run_model(
+    file: UploadFile = File(...),
+    format: str = "json",
+    hires: bool = False,
+    base_size: Optional[int] = None
+):
+    # format=png|webp|npy returns the RGBA cutout as a raw body instead of base64 JSON.
+    # hires=true runs at base_size (default 1024) and refines the alpha at full resolution.
+    check_format(format)
+    if base_size is None:
+        base_size = HIRES_BASE_SIZE if hires else image_size[0]
+    if base_size % 32 or not 256 <= base_size <= 2048:
+        return {"error": "base_size must be a multiple of 32 between 256 and 2048."}
 
-    if model is None:
-        return {"status": "model already unloaded"}
+    img_bytes = await file.read()
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(post_pool, lambda: decode_image(img_bytes).convert("RGB"))
+
+    key = cache_key(MODEL_KEY, MODEL_REVISION, img_bytes, image_size=(base_size, base_size), refine=hires, dtype=str(model_dtype))
+    cached = mask_cache.get(key)
 
+    pred = None
+    if cached is None:
+        # Concurrent requests share one forward pass.
+        pred = await batcher.submit((np.asarray(image), base_size))
 
-    del model
-    model = None
-    torch.cuda.empty_cache()
+    return await loop.run_in_executor(post_pool, _cutout, image, pred, cached, key, hires, format)
 
-    return {"status": "model_unloaded", "device": device}
 
+@app.get("/batching")
+def batching_stats():
+    return batcher.stats()
 
 
+@app.post("/unload")
+async def unload_model(force: bool = False):
+    # Demotes the model to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued
+    # batches first.
+    if force:
+        location = await batcher.run(residency.evict, MODEL_KEY)
+    else:
+        location = await off_loop(residency.release, MODEL_KEY)
+
+    if location is None:
+        return {"status": "model already unloaded"}
+
+    return {"status": "model_unloaded", "location": location, "device": device}
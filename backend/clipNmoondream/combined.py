@@ -0,0 +1,49 @@
+import importlib.util
+import os
+import sys
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(HERE)
+import main as defects
+
+
+def _load_guardrails():
+    # guard-rails is not an importable package name, so load its main.py by path.
+    path = os.path.join(os.path.dirname(HERE), "guard-rails", "main.py")
+    spec = importlib.util.spec_from_file_location("guardrails_main", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+guardrails = _load_guardrails()
+
+# ============================================================
+# APP INIT
+# ============================================================
+# Defect detector and guard rails in one process: both use the same CLIP
+# instance and image-embedding cache from common/clip_service.py, so an upload
+# checked by /detect and /analyze is encoded once.
+app = FastAPI(title="CLIP Defects + Guard Rails API")
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Shared routers (/cache, /clip/...) are included by both apps; keep one copy.
+_seen = set()
+for route in defects.app.routes + guardrails.app.routes:
+    if not isinstance(route, APIRoute):
+        continue
+    key = (route.path, tuple(sorted(route.methods)))
+    if key in _seen:
+        continue
+    _seen.add(key)
+    app.router.routes.append(route)
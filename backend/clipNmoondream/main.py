@@ -1,13 +1,20 @@
 import io
+import os
+import sys
 import torch
 import base64
-import clip
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
 from typing import List
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.executor import ModelExecutor, router as executor_router
+from common import clip_service
+from common.result_cache import ResultCache, cache_key, router as cache_router
+
 app = FastAPI(title="CLIP + Moondream Photo Defect Detector API")
 app.add_middleware(
     CORSMiddleware,
@@ -16,10 +23,13 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(residency_router)
+app.include_router(executor_router)
+app.include_router(cache_router)
+app.include_router(clip_service.router)
 
-CLIP_MODEL = None
-CLIP_PREPROCESS = None
-MOONDREAM = None
+CLIP_KEY = clip_service.CLIP_KEY
+MOONDREAM_KEY = "vikhyatk/moondream2"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 texts = [
@@ -55,62 +65,46 @@ texts = [
 
 
 
-@app.post("/load_models")
-def load_models():
-    global CLIP_MODEL, CLIP_PREPROCESS, MOONDREAM
-
-    if CLIP_MODEL is not None and MOONDREAM is not None:
-        return {"status": "already_loaded"}
-
-    
-    CLIP_MODEL, CLIP_PREPROCESS = clip.load("ViT-B/32", device=DEVICE)
-
-    
-    MOONDREAM = AutoModelForCausalLM.from_pretrained(
-        "vikhyatk/moondream2",
+def _load_moondream():
+    return AutoModelForCausalLM.from_pretrained(
+        MOONDREAM_KEY,
         revision="2025-06-21",
         trust_remote_code=True,
         device_map={"": DEVICE},
     )
 
-    return {"status": "loaded", "device": DEVICE}
 
+# CLIP itself is registered by common/clip_service.py.
+residency.register(MOONDREAM_KEY, _load_moondream)
 
- 
-@app.post("/analyze")
-async def analyze(
-    image: UploadFile = File(...),
-    topk: int = Form(3)
-):
-    global CLIP_MODEL, CLIP_PREPROCESS, MOONDREAM
+# The vocabulary is fixed, so its text embeddings are computed once (on
+# /load_models or the first request) and each /analyze only needs the image
+# embedding, which guard-rails may already have computed.
+defect_index = clip_service.LabelIndex("defects", texts)
 
-    if CLIP_MODEL is None:
-        return {"error": "Models not loaded. Call /load_models first."}
+executor = ModelExecutor("defect_detector", max_queue=8)
 
+# Only the CLIP shortlist is cached; the Moondream write-up is still generated per request.
+defect_cache = ResultCache("clip_defects", disk_bytes=16 * 1024 ** 2)
 
-    img_bytes = await image.read()
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
 
-    img_input = CLIP_PREPROCESS(img).unsqueeze(0).to(DEVICE)
+def _warm_up():
+    defect_index.features()
+    residency.acquire(MOONDREAM_KEY)
 
-    
-    text_tokens = clip.tokenize(texts).to(DEVICE)
 
-   
-    with torch.no_grad():
-        img_feat = CLIP_MODEL.encode_image(img_input)
-        txt_feat = CLIP_MODEL.encode_text(text_tokens)
+@app.post("/load_models")
+async def load_models():
+    # Advisory: /analyze loads on demand, this only warms the models up front.
+    if residency.get(CLIP_KEY) is not None and residency.get(MOONDREAM_KEY) is not None:
+        return {"status": "already_loaded"}
 
-    
-    img_feat /= img_feat.norm(dim=-1, keepdim=True)
-    txt_feat /= txt_feat.norm(dim=-1, keepdim=True)
+    await executor.run(_warm_up)
 
-    
-    sim = (img_feat @ txt_feat.T).squeeze(0)
+    return {"status": "loaded", "device": DEVICE}
 
-    values, indices = sim.topk(topk)
 
-    detected = [texts[idx] for idx in indices.tolist()]
+def _analyze(img, detected):
     defects_string = ", ".join(detected)
 
     
@@ -119,9 +113,30 @@ async def analyze(
         f"flaws: {defects_string}. For each flaw, confirm if it exists and describe what you see."
     )
 
-    answer = MOONDREAM.query(img, question)["answer"]
+    with residency.lease(MOONDREAM_KEY) as MOONDREAM:
+        return MOONDREAM.query(img, question)["answer"]
+
+
+@app.post("/analyze")
+async def analyze(
+    image: UploadFile = File(...),
+    topk: int = Form(3)
+):
+    img_bytes = await image.read()
+    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+
+    key = cache_key(CLIP_KEY, clip_service.CLIP_REVISION, img_bytes, defect_index.key, topk=topk)
+    detected = defect_cache.get(key)
+
+    if detected is None:
+        # Batched with concurrent requests in clip_service.
+        _, embedding = await clip_service.embed(img_bytes, image=img)
+        await defect_index.ready()
+        detected, _ = defect_index.topk(embedding, topk)
+        defect_cache.put(key, detected)
 
-    torch.cuda.empty_cache()
+    # Moondream starts as soon as the shortlist is known.
+    answer = await executor.run(_analyze, img, detected)
 
     return {
         "detected_defects": detected,
@@ -130,15 +145,27 @@ async def analyze(
 
 
 
-@app.post("/unload_models")
-def unload_models():
-    global CLIP_MODEL, CLIP_PREPROCESS, MOONDREAM
+def _unload(force):
+    for key in (CLIP_KEY, MOONDREAM_KEY):
+        if force:
+            residency.evict(key)
+        else:
+            residency.release(key)
 
-    CLIP_MODEL = None
-    CLIP_PREPROCESS = None
-    MOONDREAM = None
 
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
+@app.post("/unload_models")
+async def unload_models(force: bool = False):
+    # Demotes both models to pinned CPU RAM (each once its running job ends), so
+    # the VRAM goes back to the other services. `force=true` also waits for
+    # queued jobs first.
+    if force:
+        await executor.run(_unload, True)
+    else:
+        await off_loop(_unload, False)
 
     return {"status": "models_unloaded"}
+
+
+@app.get("/batching")
+def batching_stats():
+    return clip_service.stats()
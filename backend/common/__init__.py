@@ -0,0 +1,4 @@
+# Helpers shared by the backend services.
+#
+# Services are started from their own folder (e.g. `cd backend/sam`), so they add
+# the parent `backend/` folder to sys.path before importing from `common`.
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .executor import DEFAULT_JOB_SECONDS, too_busy
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for up to `max_wait_ms` (or until `max_batch_size`
+    items are waiting), groups them by `group_key(item)` so only shape-compatible
+    inputs are stacked, runs `run_batch(items) -> results` once per group and hands
+    each awaiting handler its own result.
+
+    `run_batch` is a blocking function (a batched forward pass) and runs on a single
+    worker thread, so batches for the same model never overlap on the GPU.
+    With `max_pending` set, inputs beyond that many queued or running items are
+    rejected with a 429 instead of piling up.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=10, group_key=None, name="batcher", max_pending=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.group_key = group_key or (lambda item: None)
+        self.name = name
+        self.max_pending = max_pending
+        self._pending = {}
+        self._in_flight = 0
+        self._avg_batch_seconds = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        """Queues one input and waits for its result."""
+        if self.max_pending is not None and self._in_flight >= self.max_pending:
+            batches_ahead = self._in_flight / self.max_batch_size + 1
+            raise too_busy(batches_ahead * (self._avg_batch_seconds or DEFAULT_JOB_SECONDS))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = self.group_key(item)
+
+        group = self._pending.get(key)
+        if group is None:
+            group = self._pending[key] = []
+            loop.call_later(self.max_wait, self._flush, key, group)
+        group.append((item, future))
+
+        if len(group) >= self.max_batch_size:
+            self._flush(key, group)
+
+        self._in_flight += 1
+        try:
+            return await future
+        finally:
+            self._in_flight -= 1
+
+    async def run(self, fn, *args):
+        """Runs `fn(*args)` on the batch worker, after the batch already running."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "waiting": sum(len(g) for g in self._pending.values()),
+            "in_flight": self._in_flight,
+            "max_pending": self.max_pending,
+        }
+
+    # ---------------------------------------------------
+
+    def _flush(self, key, group):
+        # The timer and the size trigger can both fire for the same group.
+        if self._pending.get(key) is not group:
+            return
+        del self._pending[key]
+        asyncio.ensure_future(self._run(group))
+
+    async def _run(self, group):
+        items = [item for item, _ in group]
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            results = await loop.run_in_executor(self._executor, self.run_batch, items)
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        elapsed = time.monotonic() - start
+        if self._avg_batch_seconds is None:
+            self._avg_batch_seconds = elapsed
+        else:
+            self._avg_batch_seconds = 0.8 * self._avg_batch_seconds + 0.2 * elapsed
+        self.batches += 1
+        self.items += len(items)
+
+        for (_, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
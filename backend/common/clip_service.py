@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import io
+from collections import OrderedDict
+from typing import List, Optional
+
+import clip
+import numpy as np
+import torch
+from fastapi import APIRouter, File, Form, UploadFile
+from PIL import Image
+
+from .batching import MicroBatcher
+from .residency import residency
+from .result_cache import ResultCache, cache_key
+
+# One CLIP ViT-B/32 per process, shared by guard-rails (moderation labels) and
+# clipNmoondream (defect labels). Run both from clipNmoondream/combined.py and
+# an upload is encoded once for both.
+CLIP_KEY = "ViT-B/32"
+CLIP_REVISION = "openai"
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# ~2 KB per embedding (512 fp32 on the CPU).
+EMBED_CACHE_ENTRIES = 4096
+
+_preprocess = None
+
+
+def _load_clip():
+    global _preprocess
+    model, _preprocess = clip.load(CLIP_KEY, device=DEVICE)
+    return model
+
+
+residency.register(CLIP_KEY, _load_clip, priority=1)
+
+
+def get_model():
+    return residency.acquire(CLIP_KEY)
+
+
+def preprocess(image):
+    """CLIP's resize/crop/normalize for a PIL image, as a 3x224x224 tensor."""
+    if _preprocess is None:
+        get_model()
+    return _preprocess(image.convert("RGB"))
+
+
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+# -------------------------------------------------------
+# Label sets
+# -------------------------------------------------------
+index_cache = ResultCache("clip_label_index", disk_bytes=16 * 1024 ** 2)
+label_sets = {}
+
+
+class LabelIndex:
+    """
+    Unit-norm text embeddings for a fixed label set, built once on first use.
+    With several `templates` each label is embedded per template and the
+    normalized embeddings are averaged (CLIP prompt ensembling). The matrix
+    stays on the CLIP device and is kept in the result cache keyed by labels and
+    templates, so restarts only run the text encoder when one of them changed.
+    Build it at load time or through `await ready()`, not on the event loop.
+    """
+
+    def __init__(self, name, labels, templates=("{}",), phrase=None):
+        self.name = name
+        self.labels = list(labels)
+        self.templates = list(templates)
+        self.phrases = [phrase(label) for label in self.labels] if phrase else self.labels
+        self.key = cache_key(CLIP_KEY, CLIP_REVISION, "\n".join(self.phrases), "\n".join(self.templates))
+        self._features = None
+        label_sets[name] = self
+
+    def features(self):
+        if self._features is None:
+            self._features = self._build()
+        return self._features
+
+    async def ready(self):
+        """Builds the index on the CLIP worker if it isn't built yet."""
+        if self._features is None:
+            await image_batcher.run(self.features)
+        return self
+
+    def scores(self, embedding):
+        """Cosine similarity of one image embedding to every label, on the CPU."""
+        return (self.features() @ embedding.to(DEVICE)).cpu()
+
+    def topk(self, embedding, k):
+        values, indices = self.scores(embedding).topk(min(k, len(self.labels)))
+        return [self.labels[i] for i in indices.tolist()], [float(v) for v in values.tolist()]
+
+    def _build(self):
+        cached = index_cache.get(self.key)
+        if cached is not None:
+            return torch.from_numpy(np.load(io.BytesIO(cached))).to(DEVICE)
+
+        ensembled = 0
+        with residency.lease(CLIP_KEY) as model, torch.no_grad():
+            for template in self.templates:
+                tokens = clip.tokenize([template.format(p) for p in self.phrases]).to(DEVICE)
+                features = model.encode_text(tokens).float()
+                ensembled = ensembled + features / features.norm(dim=-1, keepdim=True)
+        # Stays on the GPU (a few hundred KB), even while CLIP itself is demoted.
+        index = ensembled / ensembled.norm(dim=-1, keepdim=True)
+
+        buf = io.BytesIO()
+        np.save(buf, index.cpu().numpy(), allow_pickle=False)
+        index_cache.put(self.key, buf.getvalue())
+        return index
+
+
+# -------------------------------------------------------
+# Image embeddings
+# -------------------------------------------------------
+def _encode_batch(image_inputs):
+    """One image-encoder pass for a list of preprocessed tensors, unit-norm fp32 rows on the CPU."""
+    # CLIP preprocess always yields 224x224 tensors, so requests stack freely.
+    with residency.lease(CLIP_KEY) as model, torch.no_grad():
+        features = model.encode_image(torch.stack(image_inputs).to(DEVICE)).float()
+    features = features / features.norm(dim=-1, keepdim=True)
+    return list(features.cpu())
+
+
+image_batcher = MicroBatcher(_encode_batch, max_batch_size=32, max_wait_ms=10, name="clip-image")
+
+
+class EmbeddingCache:
+    """LRU of image embeddings by content hash; concurrent misses for one image share a single encode."""
+
+    def __init__(self, entries=EMBED_CACHE_ENTRIES):
+        self.entries = entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_encode(self, key, load_input):
+        embedding = self._entries.get(key)
+        if embedding is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(image_batcher.submit(load_input()))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        embedding = await task
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.entries:
+            self._entries.popitem(last=False)
+        return embedding
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+embedding_cache = EmbeddingCache()
+
+
+async def embed(image_bytes, image=None, image_input=None):
+    """
+    Returns (content hash, unit-norm embedding) for an uploaded image. `image`
+    (PIL) or `image_input` (already preprocessed) skip decoding the bytes again;
+    either way nothing is decoded on a cache hit.
+    """
+    key = image_hash(image_bytes)
+
+    def load_input():
+        if image_input is not None:
+            return image_input
+        return preprocess(image if image is not None else Image.open(io.BytesIO(image_bytes)))
+
+    return key, await embedding_cache.get_or_encode(key, load_input)
+
+
+def stats():
+    return {
+        "batching": image_batcher.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "label_sets": {name: len(index.labels) for name, index in label_sets.items()},
+    }
+
+
+# -------------------------------------------------------
+# Optional local endpoint
+# -------------------------------------------------------
+router = APIRouter(prefix="/clip")
+
+
+@router.post("/score")
+async def score_image(
+    file: UploadFile = File(...),
+    label_sets_: Optional[List[str]] = Form(None, alias="label_sets"),
+    topk: int = Form(3)
+):
+    # Scores one image against several label sets (e.g. "moderation" and
+    # "defects") from a single embedding.
+    image_bytes = await file.read()
+    names = label_sets_ or list(label_sets)
+    unknown = [name for name in names if name not in label_sets]
+    if unknown:
+        return {"error": f"Unknown label sets: {', '.join(unknown)}"}
+
+    key, embedding = await embed(image_bytes)
+    for name in names:
+        await label_sets[name].ready()
+    results = {}
+    for name in names:
+        labels, scores = label_sets[name].topk(embedding, topk)
+        results[name] = {"labels": labels, "scores": scores}
+    return {"image_hash": key, "results": results}
+
+
+@router.get("/stats")
+def clip_stats():
+    return stats()
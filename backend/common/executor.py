@@ -0,0 +1,105 @@
+import asyncio
+import functools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import APIRouter, HTTPException
+
+# Used for Retry-After until a model has finished its first job.
+DEFAULT_JOB_SECONDS = 10.0
+
+
+def too_busy(retry_after_s, detail="Model queue is full, retry later."):
+    """429 response telling the client when a slot is likely to be free."""
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after_s)))},
+    )
+
+
+class ModelExecutor:
+    """
+    Runs blocking inference for one model on its own worker thread so the
+    event loop keeps serving uploads, health checks and /unload while a job
+    is on the GPU. At most `max_queue` jobs (running + waiting) are accepted;
+    beyond that `run` raises a 429 with a Retry-After estimated from recent
+    job durations.
+    """
+
+    def __init__(self, name, max_queue=4, workers=1):
+        self.name = name
+        self.max_queue = max_queue
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._avg_seconds = None
+        _executors[name] = self
+
+    def depth(self):
+        return self._pending
+
+    def retry_after(self):
+        per_job = self._avg_seconds or DEFAULT_JOB_SECONDS
+        return per_job * max(1, self._pending) / self.workers
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues `fn(*args, **kwargs)` on the model's worker right away and returns a
+        future for it, or raises the 429 if the queue is full.
+        """
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise too_busy(self.retry_after())
+
+        self._pending += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._pool, functools.partial(self._timed, fn, *args, **kwargs))
+        future.add_done_callback(self._finished)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Queues `fn(*args, **kwargs)` on the model's worker and waits for its result."""
+        return await self.submit(fn, *args, **kwargs)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "depth": self._pending,
+            "max_queue": self.max_queue,
+            "workers": self.workers,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_job_seconds": self._avg_seconds,
+        }
+
+    # ---------------------------------------------------
+
+    def _finished(self, future):
+        self._pending -= 1
+
+    def _timed(self, fn, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            # Exponential moving average, so Retry-After follows the current workload.
+            if self._avg_seconds is None:
+                self._avg_seconds = elapsed
+            else:
+                self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+            self.completed += 1
+
+
+_executors = {}
+
+router = APIRouter()
+
+
+@router.get("/queue")
+def queue_status():
+    return {"executors": [e.stats() for e in _executors.values()]}
@@ -0,0 +1,154 @@
+import io
+import time
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+from iopaint.helper import pil_to_bytes, concat_alpha_channel
+from iopaint.model.utils import torch_gc
+
+from . import sd_presets
+from .sd15_pool import iopaint_manager
+from .transport import decode_image
+
+
+# -------------------------------------------------------
+# Decoding / encoding, same as iopaint's helpers but from raw upload bytes
+# -------------------------------------------------------
+def decode_upload(data: bytes, gray: bool = False):
+    """Same as iopaint's decode_base64_to_image, straight from the uploaded bytes."""
+    image = decode_image(data)
+    ext = (image.format or "png").lower()
+    try:
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        pass
+    infos = image.info
+
+    alpha_channel = None
+    if gray:
+        np_image = np.array(image.convert("L"))
+    elif image.mode == "RGBA":
+        np_image = np.array(image)
+        alpha_channel = np_image[:, :, -1]
+        np_image = cv2.cvtColor(np_image, cv2.COLOR_RGBA2RGB)
+    else:
+        np_image = np.array(image.convert("RGB"))
+    return np_image, alpha_channel, infos, ext
+
+
+def encode_output(image, ext, infos):
+    if ext == "png":
+        # Lossless either way; level 1 is several times faster than the default.
+        buf = io.BytesIO()
+        kwargs = {k: infos[k] for k in ("dpi", "icc_profile", "exif") if k in infos}
+        image.save(buf, format="PNG", compress_level=1, **kwargs)
+        return buf.getvalue()
+    return pil_to_bytes(image, ext=ext, quality=100, infos=infos)
+
+
+# -------------------------------------------------------
+# ROI engine: only the masked region (plus context) goes through the model
+# -------------------------------------------------------
+ROI_MIN_SIDE = 512      # SD1.5's native size, for context when the image allows it
+ROI_MAX_SIDE = 1024     # larger crops are downscaled to this (or the preset's max_side)
+ROI_MIN_PAD = 32
+ROI_PAD_RATIO = 0.5     # context around the mask, relative to its bbox size
+ROI_SNAP = 64
+MASK_DILATE = 15
+FEATHER_SIGMA = 3.0
+
+
+def roi_box(mask, width, height):
+    """
+    Mask bounding box plus context padding that grows with the mask, enlarged
+    to at least ROI_MIN_SIDE and to a multiple of ROI_SNAP per side, shifted and
+    clamped to stay inside the image. Returns (x0, y0, x1, y1).
+    """
+    x, y, bw, bh = cv2.boundingRect(mask)
+    pad = max(ROI_MIN_PAD, int(ROI_PAD_RATIO * max(bw, bh)))
+
+    def fit(lo, hi, limit):
+        size = max(hi - lo, ROI_MIN_SIDE)
+        size = min(-(-size // ROI_SNAP) * ROI_SNAP, limit)
+        lo = min(max(0, (lo + hi - size) // 2), limit - size)
+        return lo, lo + size
+
+    x0, x1 = fit(x - pad, x + bw + pad, width)
+    y0, y1 = fit(y - pad, y + bh + pad, height)
+    return x0, y0, x1, y1
+
+
+def inpaint_roi(model, image_np, mask_np, request, max_side=ROI_MAX_SIDE):
+    """
+    Inpaints the ROI crop and feather-blends it back into a copy of `image_np`.
+    Pixels outside the feathered mask are copied from the original untouched.
+    """
+    h, w = mask_np.shape
+    x0, y0, x1, y1 = roi_box(mask_np, w, h)
+    crop = image_np[y0:y1, x0:x1]
+    crop_mask = cv2.dilate(mask_np[y0:y1, x0:x1], np.ones((MASK_DILATE, MASK_DILATE), np.uint8), iterations=1)
+
+    ch, cw = crop_mask.shape
+    scale = min(1.0, max_side / max(ch, cw))
+    if scale < 1.0:
+        size = tuple(max(ROI_SNAP, round(side * scale / ROI_SNAP) * ROI_SNAP) for side in (cw, ch))
+        model_in = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        model_mask = cv2.resize(crop_mask, size, interpolation=cv2.INTER_NEAREST)
+    else:
+        model_in, model_mask = crop, crop_mask
+
+    out_bgr = model(model_in, model_mask, request)
+    result = cv2.cvtColor(out_bgr.astype(np.uint8), cv2.COLOR_BGR2RGB)
+    if result.shape[:2] != (ch, cw):
+        result = cv2.resize(result, (cw, ch), interpolation=cv2.INTER_CUBIC)
+
+    alpha = cv2.GaussianBlur(crop_mask.astype(np.float32) / 255.0, (0, 0), FEATHER_SIGMA)[..., None]
+    blended = (alpha * result + (1.0 - alpha) * crop).round().astype(np.uint8)
+
+    out = image_np.copy()
+    out[y0:y1, x0:x1] = np.where(alpha > 0, blended, crop)
+    return out
+
+
+# -------------------------------------------------------
+# Upload in, encoded result out
+# -------------------------------------------------------
+def inpaint_upload(image: bytes, mask: bytes, make_request, prompt="", negative_prompt="",
+                   preset=None, budget_ms=None, steps=None):
+    """
+    Inpaints the uploaded image bytes under the uploaded mask with the shared
+    iopaint manager, ROI crop only, using a preset from common/sd_presets.py.
+    `make_request(**fields)` builds the caller's iopaint request. Returns
+    (bytes in the upload's format, ext, preset name or None if the mask is empty).
+    Call it on the manager's worker thread.
+    """
+    image_np, alpha_channel, infos, ext = decode_upload(image)
+    mask_np, _, _, _ = decode_upload(mask, gray=True)
+
+    if mask_np.shape != image_np.shape[:2]:
+        mask_np = cv2.resize(mask_np, (image_np.shape[1], image_np.shape[0]), interpolation=cv2.INTER_NEAREST)
+    mask_np = cv2.threshold(mask_np, 127, 255, cv2.THRESH_BINARY)[1]
+
+    if not mask_np.any():
+        # Nothing to erase.
+        return image, ext, None
+
+    x0, y0, x1, y1 = roi_box(mask_np, mask_np.shape[1], mask_np.shape[0])
+    roi_size = (x1 - x0, y1 - y0)
+    name = sd_presets.choose(preset, budget_ms, roi_size)
+
+    fields = sd_presets.settings(name)
+    if steps:
+        fields["sd_steps"] = steps
+    request = make_request(prompt=prompt, negative_prompt=negative_prompt, **fields)
+
+    with iopaint_manager() as model:
+        start = time.monotonic()
+        out_rgb = inpaint_roi(model, image_np, mask_np, request, max_side=sd_presets.preset(name)["max_side"])
+        if not steps:
+            sd_presets.record(name, *roi_size, time.monotonic() - start)
+    torch_gc()
+
+    out_rgba = concat_alpha_channel(out_rgb, alpha_channel)
+    return encode_output(Image.fromarray(out_rgba), ext, infos), ext, name
@@ -0,0 +1,317 @@
+import asyncio
+import base64
+import inspect
+import io
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import torch
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Finished jobs are kept this long for the client to fetch the result.
+RESULT_TTL_SECONDS = 10 * 60
+MAX_FINISHED_JOBS = 32
+# How often the SSE stream checks a job for new progress.
+EVENT_POLL_SECONDS = 0.2
+
+# Approximate SD1.5 latent -> RGB projection, good enough for a thumbnail preview.
+SD15_LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    One long-running request. The worker reports progress through `progress()`,
+    which is also where a cancelled job stops, at the next step boundary.
+    """
+
+    def __init__(self, kind, supersede_key=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.supersede_key = supersede_key
+        self.status = "queued"  # queued, running, done, error, cancelled
+        self.stage = None
+        self.step = 0
+        self.total = None
+        self.error = None
+        self.result = None
+        self.preview = None  # JPEG bytes of the latest preview
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self._cancel = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def cancel(self):
+        self._cancel.set()
+        if self.status == "queued":
+            self._finish("cancelled")
+
+    def progress(self, step, total=None, stage=None, preview=None):
+        """Called from the worker. Raises JobCancelled once the client cancelled the job."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.step = step
+        if total is not None:
+            self.total = total
+        if stage is not None:
+            self.stage = stage
+        if preview is not None:
+            buf = io.BytesIO()
+            preview.convert("RGB").save(buf, format="JPEG", quality=70)
+            self.preview = buf.getvalue()
+        self.version += 1
+
+    def info(self, previews=False):
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "step": self.step,
+            "total": self.total,
+            "has_preview": self.preview is not None,
+        }
+        if self.error:
+            data["error"] = self.error
+        if previews and self.preview is not None:
+            data["preview_base64"] = base64.b64encode(self.preview).decode()
+        return data
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self.version += 1
+
+
+class JobManager:
+    """
+    Runs long jobs on a model's ModelExecutor and keeps their state, so a POST
+    can return a job id right away and the client polls or streams progress
+    instead of holding the connection (and the proxy timeout) for the whole run.
+
+    A job function is `fn(job, *args, **kwargs)`; it calls `job.progress(...)`
+    between steps and returns either a JSON-able dict or a fastapi Response.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._jobs = {}
+
+    def submit(self, kind, fn, *args, supersede_key=None, **kwargs):
+        """
+        Queues a job and returns it. With `supersede_key`, older unfinished jobs
+        with the same key (e.g. earlier edits from the same canvas) are cancelled.
+        """
+        self._purge()
+        job = Job(kind, supersede_key)
+        # Admitted first: a 429 here must not cancel the edit it would replace.
+        self.executor.submit(self._run, job, fn, args, kwargs)
+
+        if supersede_key is not None:
+            for other in self._jobs.values():
+                if other.supersede_key == supersede_key and not other.done:
+                    other.cancel()
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired job id.")
+        return job
+
+    def router(self):
+        """Status, progress stream, preview, result and cancel endpoints for this manager's jobs."""
+        router = APIRouter()
+
+        @router.get("/jobs/{job_id}")
+        def job_status(job_id: str, previews: bool = False):
+            return self.get(job_id).info(previews)
+
+        @router.get("/jobs/{job_id}/events")
+        async def job_events(job_id: str, previews: bool = False):
+            job = self.get(job_id)
+            return StreamingResponse(
+                self._events(job, previews),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        @router.get("/jobs/{job_id}/preview")
+        def job_preview(job_id: str):
+            job = self.get(job_id)
+            if job.preview is None:
+                raise HTTPException(status_code=404, detail="No preview yet.")
+            return Response(content=job.preview, media_type="image/jpeg")
+
+        @router.get("/jobs/{job_id}/result")
+        def job_result(job_id: str):
+            job = self.get(job_id)
+            if not job.done:
+                return JSONResponse(status_code=202, content=job.info())
+            if job.status != "done":
+                return JSONResponse(status_code=409, content=job.info())
+            # Either a dict or a ready-made Response (e.g. raw PNG bytes).
+            return job.result
+
+        @router.delete("/jobs/{job_id}")
+        def cancel_job(job_id: str):
+            job = self.get(job_id)
+            if not job.done:
+                job.cancel()
+            return job.info()
+
+        return router
+
+    # ---------------------------------------------------
+
+    def _run(self, job, fn, args, kwargs):
+        # Runs on the model's worker thread.
+        if job.done:
+            return
+        job.status = "running"
+        job.version += 1
+        try:
+            job._finish("done", result=fn(job, *args, **kwargs))
+        except JobCancelled:
+            job._finish("cancelled")
+        except Exception as e:
+            job._finish("error", error=str(e))
+
+    async def _events(self, job, previews):
+        seen = -1
+        while True:
+            if job.version != seen:
+                seen = job.version
+                event = job.status if job.done else "progress"
+                yield f"event: {event}\ndata: {json.dumps(job.info(previews))}\n\n"
+                if job.done:
+                    return
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+    def _purge(self):
+        now = time.time()
+        finished = sorted(
+            (j for j in self._jobs.values() if j.done),
+            key=lambda j: j.finished,
+        )
+        excess = len(finished) - MAX_FINISHED_JOBS
+        for i, job in enumerate(finished):
+            if i < excess or now - job.finished > RESULT_TTL_SECONDS:
+                del self._jobs[job.id]
+
+
+# -------------------------------------------------------
+# Progress hooks for diffusers pipelines
+# -------------------------------------------------------
+class _JobProgressBar:
+    """Wraps the tqdm bar a diffusers pipeline creates so every step is reported to the job."""
+
+    def __init__(self, bar, job, stage, total):
+        self.bar = bar
+        self.job = job
+        self.stage = stage
+        self.total = total
+        self.n = 0
+
+    def __iter__(self):
+        # `for t in self.progress_bar(timesteps)`: tqdm advances itself.
+        for item in self.bar:
+            yield item
+            self._report(1)
+
+    def __enter__(self):
+        self.bar.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.bar.__exit__(*exc)
+
+    def update(self, n=1):
+        # `with self.progress_bar(total=...) as bar: bar.update()`
+        self.bar.update(n)
+        self._report(n)
+
+    def _report(self, n):
+        self.n += n
+        self.job.progress(self.n, self.total, stage=self.stage)
+
+
+@contextmanager
+def pipeline_progress(pipe, job, stage=None):
+    """
+    Reports the denoising (and inversion) loops of a diffusers pipeline to `job`
+    for the duration of the block. A no-op when `job` is None.
+    """
+    if job is None:
+        yield pipe
+        return
+
+    original = pipe.progress_bar
+
+    def progress_bar(iterable=None, total=None):
+        bar = original(iterable=iterable, total=total)
+        if total is None and hasattr(iterable, "__len__"):
+            total = len(iterable)
+        return _JobProgressBar(bar, job, stage, total)
+
+    pipe.progress_bar = progress_bar
+    try:
+        yield pipe
+    finally:
+        del pipe.progress_bar
+
+
+def latents_to_preview(latents):
+    """Cheap RGB thumbnail of SD1.5-style 4-channel latents, or None for other latent spaces."""
+    from PIL import Image
+
+    if latents.ndim != 4 or latents.shape[1] != len(SD15_LATENT_RGB_FACTORS):
+        return None
+    factors = torch.tensor(SD15_LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+    rgb = latents[0].permute(1, 2, 0) @ factors
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1).mul(255).to(device="cpu", dtype=torch.uint8)
+    return Image.fromarray(rgb.numpy())
+
+
+def preview_callback_kwargs(pipe, job, every=5):
+    """
+    Pipeline kwargs that push a latent preview to `job` every `every` steps,
+    for both the legacy `callback=` and the newer `callback_on_step_end=` API.
+    """
+    if job is None:
+        return {}
+
+    params = inspect.signature(pipe.__call__).parameters
+
+    if "callback_on_step_end" in params:
+        def on_step_end(_pipe, step, _timestep, callback_kwargs):
+            if step % every == 0:
+                job.progress(job.step, preview=latents_to_preview(callback_kwargs["latents"]))
+            return callback_kwargs
+        return {"callback_on_step_end": on_step_end}
+
+    if "callback" in params:
+        def callback(step, _timestep, latents):
+            job.progress(job.step, preview=latents_to_preview(latents))
+        return {"callback": callback, "callback_steps": every}
+
+    return {}
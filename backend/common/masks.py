@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+
+
+# -------------------------------------------------------
+# Edge-aware refinement
+# -------------------------------------------------------
+def guided_filter(guide, src, radius=8, eps=1e-3):
+    """
+    Guided filter (He et al.) with a grayscale guide: smooths `src` while
+    snapping its edges to the edges in `guide`. Both are float32 HxW in 0..1.
+    """
+    ksize = (2 * radius + 1, 2 * radius + 1)
+
+    def mean(x):
+        return cv2.boxFilter(x, -1, ksize, borderType=cv2.BORDER_REFLECT)
+
+    mean_i = mean(guide)
+    mean_p = mean(src)
+    cov_ip = mean(guide * src) - mean_i * mean_p
+    var_i = mean(guide * guide) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return mean(a) * guide + mean(b)
+
+
+def refine_soft_mask(guide, alpha, radius=8, eps=1e-3, band=(0.05, 0.95)):
+    """
+    Runs the guided filter on a soft mask (float32 HxW in 0..1) only where it is
+    uncertain, i.e. inside `band`. The filter is applied to the bounding box of
+    that band plus a margin, so a full-resolution mask costs about as much as
+    its edge region. `guide` may be uint8 (0..255) or float (0..1).
+    """
+    uncertain = (alpha > band[0]) & (alpha < band[1])
+    rows = np.flatnonzero(uncertain.any(axis=1))
+    cols = np.flatnonzero(uncertain.any(axis=0))
+    if rows.size == 0:
+        return alpha
+
+    pad = 2 * radius
+    h, w = alpha.shape
+    y0, y1 = max(0, rows[0] - pad), min(h, rows[-1] + pad + 1)
+    x0, x1 = max(0, cols[0] - pad), min(w, cols[-1] + pad + 1)
+
+    g = guide[y0:y1, x0:x1].astype(np.float32)
+    if guide.dtype == np.uint8:
+        g /= 255.0
+    region = alpha[y0:y1, x0:x1]
+    filtered = np.clip(guided_filter(g, region, radius, eps), 0.0, 1.0)
+
+    out = alpha.copy()
+    out[y0:y1, x0:x1] = np.where(uncertain[y0:y1, x0:x1], filtered, region)
+    return out
+
+
+# -------------------------------------------------------
+# Encoding
+# -------------------------------------------------------
+def mask_to_rle(mask):
+    """
+    COCO-style uncompressed RLE of a HxW boolean mask: run lengths in
+    column-major order, starting with a (possibly empty) run of 0s.
+    """
+    h, w = mask.shape
+    flat = mask.ravel(order="F")
+    if flat.size == 0:
+        return {"size": [h, w], "counts": []}
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size]))).tolist()
+    if flat[0]:
+        counts = [0] + counts
+    return {"size": [h, w], "counts": counts}
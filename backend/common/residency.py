@@ -0,0 +1,331 @@
+import asyncio
+import functools
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from fastapi import APIRouter
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# VRAM kept free for activations when deciding whether another model fits.
+VRAM_HEADROOM_BYTES = 2 * 1024 ** 3
+# Demoted models are kept in pinned host RAM up to this budget, then dropped.
+CPU_CACHE_BYTES = 24 * 1024 ** 3
+
+
+# -------------------------------------------------------
+# Helpers to find the torch weights behind a model object
+# -------------------------------------------------------
+def _modules(obj, depth=0):
+    """
+    Returns the torch modules owned by a model object: a plain nn.Module,
+    a diffusers pipeline, a SamPredictor / iopaint ModelManager wrapper or a dict of those.
+    """
+    if obj is None or depth > 3:
+        return []
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    if isinstance(obj, dict):
+        found = []
+        for value in obj.values():
+            found += _modules(value, depth + 1)
+        return found
+    components = getattr(obj, "components", None)
+    if isinstance(components, dict):
+        return [m for m in components.values() if isinstance(m, torch.nn.Module)]
+    return _modules(getattr(obj, "model", None), depth + 1)
+
+
+def _unique(modules):
+    seen = set()
+    out = []
+    for m in modules:
+        if id(m) not in seen:
+            seen.add(id(m))
+            out.append(m)
+    return out
+
+
+def _tensors(module):
+    yield from module.parameters()
+    yield from module.buffers()
+
+
+def model_nbytes(obj):
+    """Size of all parameters and buffers of a model object, in bytes."""
+    total = 0
+    for m in _unique(_modules(obj)):
+        total += sum(t.numel() * t.element_size() for t in _tensors(m))
+    return total
+
+
+def _default_to_device(obj, device):
+    for m in _unique(_modules(obj)):
+        m.to(device, non_blocking=True)
+        if device == "cpu" and torch.cuda.is_available():
+            # Pinned pages make the next promotion a fast async DMA copy.
+            for t in _tensors(m):
+                if not t.data.is_pinned():
+                    t.data = t.data.pin_memory()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _free_vram():
+    if not torch.cuda.is_available():
+        return float("inf")
+    free, _ = torch.cuda.mem_get_info()
+    # Blocks cached by our own allocator are reusable without asking the driver.
+    return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+
+def _release_cached_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
+
+
+# -------------------------------------------------------
+# Residency manager
+# -------------------------------------------------------
+class _Entry:
+    def __init__(self, name, loader, priority, size_hint_bytes, to_device):
+        self.name = name
+        self.loader = loader
+        self.priority = priority
+        self.size = size_hint_bytes or 0
+        self.to_device = to_device or _default_to_device
+        self.obj = None
+        self.location = None  # None (not loaded), "loading", "gpu" or "cpu"
+        self.loading = threading.Lock()  # one load / promotion of this model at a time
+        self.idle = False
+        self.last_used = 0.0
+        self.leases = 0  # jobs currently running on the model
+
+
+class ResidencyManager:
+    """
+    Keeps registered models on the GPU while they are in use and evicts when a
+    model that is being acquired does not fit (lowest priority, then least
+    recently used). /unload demotes right away, or as soon as the running job
+    finishes, so the VRAM goes back to the other services, which run in their
+    own processes. Demoted models sit in pinned CPU RAM so that re-promotion is
+    a memory copy instead of a checkpoint load.
+
+    Inference runs inside `lease(name)`: a leased model is never moved off the
+    GPU, eviction skips it and an explicit evict waits for the lease to end.
+
+    Loading a checkpoint or copying it to the GPU happens outside the manager
+    lock, so get() and the other models don't wait on it. Everything that moves
+    weights blocks, call it from a worker thread rather than the event loop.
+    """
+
+    def __init__(self, device=DEVICE, vram_headroom_bytes=VRAM_HEADROOM_BYTES, cpu_cache_bytes=CPU_CACHE_BYTES):
+        self.device = device
+        self.vram_headroom_bytes = vram_headroom_bytes
+        self.cpu_cache_bytes = cpu_cache_bytes
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._lease_done = threading.Condition(self._lock)
+
+    def register(self, name, loader, priority=0, size_hint_bytes=None, to_device=None):
+        """
+        Registers a model. `loader()` must return the model already placed on the GPU.
+        `to_device(obj, device)` can override how the model is moved between devices.
+        Re-registering an existing name keeps the loaded model.
+        """
+        with self._lock:
+            if name in self._entries:
+                return
+            self._entries[name] = _Entry(name, loader, priority, size_hint_bytes, to_device)
+
+    def acquire(self, name):
+        """Returns the model, loading or promoting it to the GPU first if needed."""
+        return self._acquire(name, lease=False)
+
+    @contextmanager
+    def lease(self, name):
+        """
+        Acquires the model and pins it on the GPU for the duration of the block.
+        A release() that arrived meanwhile is applied when the last lease ends.
+        """
+        obj = self._acquire(name, lease=True)
+        entry = self._entries[name]
+        try:
+            yield obj
+        finally:
+            with self._lock:
+                entry.leases -= 1
+                entry.last_used = time.monotonic()
+                if entry.leases == 0:
+                    if entry.idle and entry.location == "gpu":
+                        self._demote(entry)
+                    self._lease_done.notify_all()
+
+    def get(self, name):
+        """
+        Returns the model only if it is currently resident on the GPU, without
+        loading it. A lock-free snapshot, cheap enough for async handlers.
+        """
+        entry = self._entries.get(name)
+        if entry is None or entry.location != "gpu":
+            return None
+        return entry.obj
+
+    def release(self, name):
+        """
+        Unload: demotes the model to pinned CPU RAM now, or when its running job
+        ends if it is leased. Returns the location at the time of the call.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            location = entry.location
+            if location == "gpu":
+                entry.idle = True
+                if entry.leases == 0:
+                    self._demote(entry)
+            return location
+
+    def evict(self, name, drop=False):
+        """
+        Demotes a model to pinned CPU RAM, or frees it entirely with `drop=True`.
+        Waits for a load in progress and for running jobs on the model to finish first.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        with entry.loading, self._lock:
+            while entry.leases:
+                self._lease_done.wait()
+            if drop:
+                self._drop(entry)
+            elif entry.location == "gpu":
+                self._demote(entry)
+            return entry.location
+
+    def status(self):
+        with self._lock:
+            return {
+                "device": self.device,
+                "free_vram_bytes": None if self.device == "cpu" else int(_free_vram()),
+                "models": [
+                    {
+                        "name": e.name,
+                        "location": e.location,
+                        "size_bytes": e.size,
+                        "priority": e.priority,
+                        "idle": e.idle,
+                        "leases": e.leases,
+                    }
+                    for e in self._entries.values()
+                ],
+            }
+
+    # ---------------------------------------------------
+
+    def _acquire(self, name, lease):
+        entry = self._entries[name]
+        with entry.loading:
+            while True:
+                with self._lock:
+                    if entry.location == "gpu":
+                        # Counted under the lock, so nothing demotes it in between.
+                        if lease:
+                            entry.leases += 1
+                        entry.idle = False
+                        entry.last_used = time.monotonic()
+                        return entry.obj
+                    self._make_room(entry.size, exclude=entry)
+                    previous, entry.location = entry.location, "loading"
+                try:
+                    self._promote(entry, previous)
+                except torch.cuda.OutOfMemoryError:
+                    # Size was unknown or underestimated: clear everything else and retry once.
+                    with self._lock:
+                        self._make_room(float("inf"), exclude=entry)
+                        entry.location = "loading"
+                    self._promote(entry, previous)
+
+    def _promote(self, entry, previous):
+        # Runs without the manager lock; "loading" keeps the entry out of
+        # _make_room and the CPU cache trim meanwhile.
+        try:
+            if previous == "cpu":
+                entry.to_device(entry.obj, self.device)
+                obj, size = entry.obj, entry.size
+            else:
+                obj = entry.loader()
+                size = model_nbytes(obj) or entry.size
+        except BaseException:
+            with self._lock:
+                entry.location = previous
+            raise
+        with self._lock:
+            entry.obj, entry.size, entry.location = obj, size, "gpu"
+
+    def _demote(self, entry):
+        if self.device == "cpu":
+            return
+        entry.to_device(entry.obj, "cpu")
+        entry.location = "cpu"
+        entry.idle = False
+        _release_cached_memory()
+        self._trim_cpu_cache()
+
+    def _drop(self, entry):
+        entry.obj = None
+        entry.location = None
+        entry.idle = False
+        _release_cached_memory()
+
+    def _make_room(self, needed_bytes, exclude):
+        if self.device == "cpu":
+            return
+        while _free_vram() - self.vram_headroom_bytes < needed_bytes:
+            # Leased models are mid-inference on another thread, never move those.
+            candidates = [
+                e for e in self._entries.values()
+                if e.location == "gpu" and e is not exclude and e.leases == 0
+            ]
+            if not candidates:
+                return
+            victim = min(candidates, key=lambda e: (not e.idle, e.priority, e.last_used))
+            self._demote(victim)
+
+    def _trim_cpu_cache(self):
+        demoted = sorted(
+            (e for e in self._entries.values() if e.location == "cpu"),
+            key=lambda e: (e.priority, e.last_used),
+        )
+        total = sum(e.size for e in demoted)
+        for entry in demoted:
+            if total <= self.cpu_cache_bytes:
+                break
+            total -= entry.size
+            self._drop(entry)
+
+
+# One manager per process, shared by every model the service registers.
+residency = ResidencyManager()
+
+
+async def off_loop(fn, *args):
+    """
+    Runs a residency call that can move weights (release, acquire, evict) on a
+    worker thread, so an async handler doesn't stall the event loop on it.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+router = APIRouter()
+
+
+@router.get("/residency")
+def residency_status():
+    return residency.status()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi import APIRouter
+
+# Set RESULT_CACHE=0 to turn every cache off, e.g. while benchmarking the models.
+ENABLED = os.environ.get("RESULT_CACHE", "1") != "0"
+CACHE_DIR = os.environ.get(
+    "RESULT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "submission", "results")
+)
+
+
+def cache_key(model_id, revision, *inputs, **params):
+    """
+    Content hash of everything that determines a deterministic endpoint's output:
+    the model id and revision, the raw input bytes and the request parameters.
+    """
+    h = hashlib.sha256()
+    h.update(f"{model_id}@{revision}".encode())
+    for data in inputs:
+        if isinstance(data, str):
+            data = data.encode()
+        # Length prefix so (b"ab", b"c") and (b"a", b"bc") hash differently.
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return b"B" + bytes(value)
+    return b"J" + json.dumps(value).encode()
+
+
+def _decode(blob):
+    if blob[:1] == b"B":
+        return blob[1:]
+    return json.loads(blob[1:])
+
+
+class ResultCache:
+    """
+    Two-tier cache for endpoint results: an in-memory LRU bounded by
+    `memory_bytes`, backed by files under RESULT_CACHE_DIR/<name> bounded by
+    `disk_bytes` (oldest files go first). Values are bytes (encoded images,
+    GLBs) or JSON-able dicts/lists.
+    """
+
+    def __init__(self, name, memory_bytes=256 * 1024 ** 2, disk_bytes=2 * 1024 ** 3):
+        self.name = name
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.dir = os.path.join(CACHE_DIR, name) if disk_bytes else None
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None  # scanned on first use
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        _caches[name] = self
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        if not ENABLED:
+            return None
+        with self._lock:
+            blob = self._memory.get(key)
+            if blob is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return _decode(blob)
+
+            blob = self._read_disk(key)
+            if blob is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._put_memory(key, blob)
+            return _decode(blob)
+
+    def put(self, key, value):
+        if not ENABLED:
+            return
+        blob = _encode(value)
+        with self._lock:
+            self._put_memory(key, blob)
+            self._write_disk(key, blob)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_items": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size,
+            "enabled": ENABLED,
+        }
+
+    # ---------------------------------------------------
+
+    def _put_memory(self, key, blob):
+        if len(blob) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = blob
+        self._memory_size += len(blob)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.dir, key[:2], key)
+
+    def _read_disk(self, key):
+        if self.dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            # mtime doubles as the disk tier's LRU clock.
+            os.utime(path)
+            return blob
+        except OSError:
+            return None
+
+    def _write_disk(self, key, blob):
+        if self.dir is None or len(blob) > self.disk_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self._disk_size is None:
+                self._disk_size = sum(size for _, size, _ in self._disk_files())
+            if os.path.exists(path):
+                self._disk_size -= os.path.getsize(path)
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(blob)
+            os.replace(tmp, path)
+            self._disk_size += len(blob)
+            if self._disk_size > self.disk_bytes:
+                self._trim_disk()
+        except OSError as e:
+            print(f"[{self.name}] result cache write failed: {e}")
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.dir):
+            for fname in files:
+                path = os.path.join(root, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _trim_disk(self):
+        for path, size, _ in sorted(self._disk_files(), key=lambda f: f[2]):
+            if self._disk_size <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+                self._disk_size -= size
+            except OSError:
+                pass
+
+
+_caches = {}
+
+router = APIRouter()
+
+
+@router.get("/cache")
+def cache_status():
+    return {"caches": [c.stats() for c in _caches.values()]}
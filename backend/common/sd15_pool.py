@@ -0,0 +1,148 @@
+import threading
+from contextlib import contextmanager
+
+import torch
+
+from .residency import residency
+
+SD15_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+IOPAINT_KEY = f"iopaint:{SD15_MODEL_ID}"
+
+
+class SD15ComponentPool:
+    """
+    Loads the SD1.5 UNet, VAE, CLIP text encoder and tokenizer once per process and
+    hands out lightweight pipeline views over them. A view only owns its scheduler
+    (and any extra module passed in, e.g. an inpainting UNet), so ledits, style
+    transfer and inpaint4Drag can be co-hosted without each holding a full copy.
+    """
+
+    def __init__(self, model_id=SD15_MODEL_ID, dtype=torch.float16, device=DEVICE):
+        self.model_id = model_id
+        self.dtype = dtype
+        self.device = device
+        self.key = f"{model_id}:{str(dtype).replace('torch.', '')}"
+        # LoRA weights are patched into the shared UNet / text encoder, so jobs
+        # on different views must not interleave.
+        self.lock = threading.RLock()
+        self._scheduler_config = None
+        residency.register(self.key, self._load_components, priority=1)
+
+    def _load_components(self):
+        from diffusers import AutoencoderKL, UNet2DConditionModel
+        from transformers import CLIPTextModel, CLIPTokenizer
+
+        print(f"Loading shared SD1.5 components from {self.model_id}...")
+        return {
+            "vae": AutoencoderKL.from_pretrained(
+                self.model_id, subfolder="vae", torch_dtype=self.dtype
+            ).to(self.device),
+            "text_encoder": CLIPTextModel.from_pretrained(
+                self.model_id, subfolder="text_encoder", torch_dtype=self.dtype
+            ).to(self.device),
+            "tokenizer": CLIPTokenizer.from_pretrained(self.model_id, subfolder="tokenizer"),
+            "unet": UNet2DConditionModel.from_pretrained(
+                self.model_id, subfolder="unet", torch_dtype=self.dtype
+            ).to(self.device),
+        }
+
+    def components(self):
+        """Returns the shared modules, promoting them back to the GPU if they were evicted."""
+        return dict(residency.acquire(self.key))
+
+    def scheduler(self, scheduler_cls=None, **overrides):
+        """Builds a fresh scheduler from the model's scheduler config."""
+        from diffusers import PNDMScheduler
+
+        if self._scheduler_config is None:
+            self._scheduler_config = PNDMScheduler.load_config(self.model_id, subfolder="scheduler")
+        scheduler_cls = scheduler_cls or PNDMScheduler
+        return scheduler_cls.from_config(self._scheduler_config, **overrides)
+
+    def pipeline(self, pipeline_cls, scheduler=None, **overrides):
+        """
+        Builds a pipeline view over the shared components. Views hold no weights of
+        their own, so building one per request is cheap. `overrides` replaces any
+        shared component, e.g. `unet=` for an inpainting UNet.
+        """
+        parts = self.components()
+        parts.update(overrides)
+        return pipeline_cls(
+            **parts,
+            scheduler=scheduler or self.scheduler(),
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+        )
+
+    @contextmanager
+    def use(self, view, lora_path=None):
+        """
+        Runs one job on a view, with an optional LoRA that is removed again
+        afterwards. The shared components are leased for the job, so they stay
+        on the GPU until it ends.
+        """
+        with self.lock, residency.lease(self.key):
+            if lora_path:
+                view.load_lora_weights(lora_path)
+            try:
+                yield view
+            finally:
+                if lora_path:
+                    view.unload_lora_weights()
+
+    def release(self):
+        return residency.release(self.key)
+
+    def evict(self):
+        return residency.evict(self.key)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(model_id=SD15_MODEL_ID, dtype=torch.float16):
+    """Returns the process-wide pool for a model id and dtype."""
+    with _pools_lock:
+        pool = _pools.get((model_id, dtype))
+        if pool is None:
+            pool = _pools[(model_id, dtype)] = SD15ComponentPool(model_id, dtype)
+        return pool
+
+
+# -------------------------------------------------------
+# iopaint keeps its own pipelines inside ModelManager, so inpaint and
+# outpaint share one manager instance instead of pooled components.
+# -------------------------------------------------------
+def _load_iopaint_manager():
+    from iopaint.download import cli_download_model
+    from iopaint.model_manager import ModelManager
+
+    cli_download_model(SD15_MODEL_ID)
+
+    return ModelManager(
+        name=SD15_MODEL_ID,
+        device=torch.device(DEVICE),
+        enable_powerpoint_v2=True,
+        disable_nsfw=True,
+        sd_cpu_textencoder=False,
+        cpu_offload=False,
+        local_files_only=False,
+        enable_brushnet=False
+    )
+
+
+residency.register(IOPAINT_KEY, _load_iopaint_manager, priority=1)
+
+
+def get_iopaint_manager():
+    """Returns the process-wide iopaint SD1.5 ModelManager used by inpaint and outpaint."""
+    return residency.acquire(IOPAINT_KEY)
+
+
+def iopaint_manager():
+    """Context manager leasing the ModelManager for one job, see residency.lease."""
+    return residency.lease(IOPAINT_KEY)
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import numpy as np
+from fastapi import APIRouter
+
+# -------------------------------------------------------
+# Latency presets for the iopaint SD1.5 manager (inpaint + outpaint)
+# -------------------------------------------------------
+# max_side caps the longest side the model runs at; larger inputs are
+# downscaled for the model and the result is resized back.
+PRESETS = {
+    "fast": {"sd_steps": 6, "sd_sampler": "LCM", "sd_lcm_lora": True, "sd_guidance_scale": 1.5, "max_side": 512},
+    "balanced": {"sd_steps": 20, "sd_sampler": "UniPC", "sd_lcm_lora": False, "sd_guidance_scale": 7.5, "max_side": 768},
+    "quality": {"sd_steps": 50, "sd_sampler": "UniPC", "sd_lcm_lora": False, "sd_guidance_scale": 7.5, "max_side": 1024},
+}
+# Cheapest first, used when picking for a millisecond budget.
+PRESET_ORDER = ("fast", "balanced", "quality")
+DEFAULT_PRESET = "balanced"
+
+# Used when LCM-LoRA can't be enabled for the loaded pipeline.
+FAST_FALLBACK = {"sd_steps": 8, "sd_sampler": "UniPC", "sd_lcm_lora": False, "sd_guidance_scale": 7.5, "max_side": 512}
+# Presets replaced for the loaded pipeline (fast -> FAST_FALLBACK), set by calibrate.
+_overrides = {}
+
+CALIBRATION_SIDE = 512
+
+# Measured milliseconds per preset at CALIBRATION_SIDE x CALIBRATION_SIDE,
+# refined by real runs afterwards.
+calibration = {}
+_calibration_lock = threading.Lock()
+
+
+def preset(name):
+    """A preset as it runs on the loaded pipeline."""
+    return _overrides.get(name, PRESETS[name])
+
+
+def settings(name):
+    """The iopaint request fields for a preset (without max_side)."""
+    return {k: v for k, v in preset(name).items() if k != "max_side"}
+
+
+def model_size(name, width, height):
+    """(w, h) the model runs at for an input of width x height under a preset."""
+    scale = min(1.0, preset(name)["max_side"] / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_ms(name, width, height):
+    """Expected run time, scaled from the calibration run by pixel count; None before calibration."""
+    ms = calibration.get(name)
+    if ms is None:
+        return None
+    w, h = model_size(name, width, height)
+    return ms * (w * h) / (CALIBRATION_SIDE * CALIBRATION_SIDE)
+
+
+def choose(name=None, budget_ms=None, size=None, estimate=estimate_ms):
+    """
+    Resolves the preset for a request. An explicit preset wins; otherwise the
+    highest-quality preset whose estimate for `size` fits `budget_ms`, falling
+    back to the fastest one when none does. Before calibrate() has run there
+    are no estimates, so budget_ms requests get DEFAULT_PRESET.
+    `estimate(name, w, h)` can be swapped for callers that run several passes
+    per request.
+    """
+    if name:
+        if name not in PRESETS:
+            raise ValueError(f"Unknown preset '{name}', expected one of {', '.join(PRESET_ORDER)}")
+        return name
+    if budget_ms is None or size is None or not calibration:
+        return DEFAULT_PRESET
+
+    fitting = [p for p in PRESET_ORDER if (estimate(p, *size) or float("inf")) <= budget_ms]
+    return fitting[-1] if fitting else PRESET_ORDER[0]
+
+
+def record(name, width, height, elapsed_s):
+    """Folds a real run into the calibration table (EMA, normalized to CALIBRATION_SIDE)."""
+    w, h = model_size(name, width, height)
+    ms = elapsed_s * 1000.0 * (CALIBRATION_SIDE * CALIBRATION_SIDE) / (w * h)
+    previous = calibration.get(name)
+    calibration[name] = ms if previous is None else 0.8 * previous + 0.2 * ms
+
+
+def calibrate(model, make_request, force=False):
+    """
+    Times every preset once on the loaded manager with a synthetic
+    CALIBRATION_SIDE square and a centered mask, after one warm-up pass.
+    `make_request(**fields)` builds the iopaint request. Runs once per process
+    unless `force`; call it on the model's worker thread, from /load_model
+    rather than on a request.
+    """
+    with _calibration_lock:
+        if calibration and not force:
+            return dict(calibration)
+
+        side = CALIBRATION_SIDE
+        gradient = np.linspace(0, 255, side, dtype=np.uint8)
+        image = np.dstack([np.tile(gradient, (side, 1))] * 3)
+        mask = np.zeros((side, side), np.uint8)
+        mask[side // 4: 3 * side // 4, side // 4: 3 * side // 4] = 255
+
+        def timed(fields):
+            start = time.monotonic()
+            model(image, mask, make_request(**fields))
+            return (time.monotonic() - start) * 1000.0
+
+        timed({**settings(DEFAULT_PRESET), "sd_steps": 2})
+
+        # Filled in locally, so a failed run leaves no partial table behind.
+        measured = {}
+        for name in PRESET_ORDER:
+            try:
+                measured[name] = timed(settings(name))
+            except Exception as e:
+                if name != "fast":
+                    raise
+                # No LCM-LoRA for this pipeline: fall back to a short UniPC run.
+                print(f"LCM-LoRA unavailable ({e}), fast preset uses {FAST_FALLBACK['sd_steps']} UniPC steps")
+                _overrides["fast"] = FAST_FALLBACK
+                measured[name] = timed(settings(name))
+        calibration.update(measured)
+
+        print("Preset calibration (ms @ %dpx): %s" % (side, {k: round(v) for k, v in calibration.items()}))
+        return dict(calibration)
+
+
+router = APIRouter()
+
+
+@router.get("/presets")
+def presets():
+    return {
+        "default": DEFAULT_PRESET,
+        "presets": {name: preset(name) for name in PRESET_ORDER},
+        "calibration_side": CALIBRATION_SIDE,
+        "calibration_ms": {k: round(v, 1) for k, v in calibration.items()},
+    }
@@ -0,0 +1,94 @@
+import base64
+import io
+import uuid
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.responses import Response
+from PIL import Image
+
+# `format=` values accepted by endpoints that return images. "json" keeps the
+# old base64-in-JSON body so existing clients do not change.
+IMAGE_FORMATS = ("json", "png", "webp", "npy")
+
+MEDIA_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "npy": "application/x-npy",
+    "glb": "model/gltf-binary",
+}
+
+NPY_MAGIC = b"\x93NUMPY"
+
+
+# -------------------------------------------------------
+# Encoding
+# -------------------------------------------------------
+def encode_image(image, fmt="png"):
+    """
+    Encodes a PIL image with a fast lossless codec: PNG at zlib level 1 (a few
+    percent larger than the default, several times faster), lossless WebP at
+    the fastest method, or the raw uint8 array as .npy for chained calls.
+    """
+    buf = io.BytesIO()
+    if fmt == "npy":
+        np.save(buf, np.asarray(image), allow_pickle=False)
+    elif fmt == "webp":
+        image.save(buf, format="WEBP", lossless=True, method=0)
+    else:
+        image.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def check_format(fmt):
+    if fmt not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(IMAGE_FORMATS)}")
+
+
+def image_response(image, fmt="json", key="image_base64", extra=None):
+    """
+    Returns `image` as a raw image/png, image/webp or .npy body, or for
+    fmt="json" as `{key: base64 PNG, **extra}` like the endpoints always did.
+    """
+    check_format(fmt)
+    if fmt == "json":
+        return {key: base64.b64encode(encode_image(image, "png")).decode("utf-8"), **(extra or {})}
+    return Response(content=encode_image(image, fmt), media_type=MEDIA_TYPES[fmt])
+
+
+def bytes_response(data, fmt="json", media_type="image/png", key="image_base64", extra=None):
+    """Same as image_response for output that is already encoded (e.g. a GLB or iopaint's PNG)."""
+    if fmt == "json":
+        return {key: base64.b64encode(data).decode("utf-8"), **(extra or {})}
+    return Response(content=data, media_type=media_type)
+
+
+def multipart_response(parts):
+    """
+    One multipart/mixed body for endpoints with several outputs. `parts` is a
+    list of (name, bytes, media_type).
+    """
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, data, media_type in parts:
+        body.write(f"--{boundary}\r\n".encode())
+        body.write(f'Content-Disposition: attachment; name="{name}"\r\n'.encode())
+        body.write(f"Content-Type: {media_type}\r\n\r\n".encode())
+        body.write(data)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode())
+    return Response(content=body.getvalue(), media_type=f"multipart/mixed; boundary={boundary}")
+
+
+# -------------------------------------------------------
+# Decoding
+# -------------------------------------------------------
+def decode_image(data):
+    """
+    Opens uploaded bytes as a PIL image. Besides the usual image formats this
+    accepts the .npy arrays returned with format=npy, so one service's output
+    can be fed into the next without a PNG encode/decode in between.
+    """
+    if data[:len(NPY_MAGIC)] == NPY_MAGIC:
+        return Image.fromarray(np.load(io.BytesIO(data), allow_pickle=False))
+    return Image.open(io.BytesIO(data))
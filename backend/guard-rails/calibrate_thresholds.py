@@ -0,0 +1,109 @@
+"""
+Calibrates the per-label violation thresholds for guard-rails and writes
+label_thresholds.json next to main.py.
+
+    python calibrate_thresholds.py --negatives /data/safe [--positives /data/unsafe] [--fpr 0.005]
+
+--negatives is a folder of benign images. For every label the threshold is set
+so that at most `fpr` of them would be flagged for it. --positives optionally
+holds one subfolder per label (e.g. unsafe/weapon/*.jpg); labels with examples
+there get the threshold that maximizes F1 against the negatives instead, never
+below the FPR-based one. Scores come from the same ensembled label index the
+service uses, and the file records its key, so main.py ignores the thresholds
+once the labels or templates change.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+
+import torch
+from PIL import Image
+
+import main
+from common import clip_service
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def _image_paths(folder):
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+async def _scores(paths):
+    """(images x labels) similarity matrix for a list of image files."""
+    rows = []
+    paths = list(paths)
+    for start in range(0, len(paths), main.BULK_BATCH_SIZE):
+        chunk = []
+        for path in paths[start:start + main.BULK_BATCH_SIZE]:
+            with open(path, "rb") as f:
+                chunk.append(f.read())
+        # Concurrent embeds fill one clip_service batch.
+        embedded = await asyncio.gather(
+            *(clip_service.embed(data, image=Image.open(io.BytesIO(data))) for data in chunk)
+        )
+        rows += [main.moderation_index.scores(embedding) for _, embedding in embedded]
+    return torch.stack(rows) if rows else torch.empty(0, len(main.texts))
+
+
+def _best_f1(positives, negatives, floor):
+    """Threshold among the observed scores that maximizes F1, not below `floor`."""
+    best, best_f1 = floor, -1.0
+    for t in torch.cat([positives, negatives]).unique().tolist():
+        if t < floor:
+            continue
+        tp = int((positives >= t).sum())
+        fp = int((negatives >= t).sum())
+        fn = len(positives) - tp
+        f1 = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+        if f1 > best_f1:
+            best, best_f1 = t, f1
+    return best
+
+
+async def calibrate(negatives_dir, positives_dir, fpr):
+    negatives = await _scores(_image_paths(negatives_dir))
+    if not len(negatives):
+        raise SystemExit(f"No images found in {negatives_dir}")
+    print(f"Scored {len(negatives)} negative images")
+
+    thresholds = {}
+    for i, label in enumerate(main.texts):
+        neg = negatives[:, i]
+        threshold = float(torch.quantile(neg, 1.0 - fpr))
+
+        label_dir = os.path.join(positives_dir, label) if positives_dir else None
+        if label_dir and os.path.isdir(label_dir):
+            positives = (await _scores(_image_paths(label_dir)))[:, i]
+            if len(positives):
+                threshold = _best_f1(positives, neg, threshold)
+                print(f"{label}: {len(positives)} positives, threshold {threshold:.4f}")
+        thresholds[label] = round(threshold, 4)
+    return thresholds
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--negatives", required=True, help="folder of benign images")
+    parser.add_argument("--positives", help="folder with one subfolder of examples per label")
+    parser.add_argument("--fpr", type=float, default=0.005, help="allowed false-positive rate per label")
+    parser.add_argument("--output", default=main.THRESHOLDS_PATH)
+    args = parser.parse_args()
+
+    thresholds = asyncio.run(calibrate(args.negatives, args.positives, args.fpr))
+    with open(args.output, "w") as f:
+        json.dump({
+            "index_key": main.moderation_index.key,
+            "fpr": args.fpr,
+            "thresholds": thresholds,
+        }, f, indent=2)
+    print(f"Wrote {len(thresholds)} thresholds to {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
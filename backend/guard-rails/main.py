@@ -1,10 +1,22 @@
+import io
+import os
+import sys
+import json
+import asyncio
+import itertools
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 import uvicorn
 import torch
-import clip
 from PIL import Image
 from fastapi import FastAPI, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
-import numpy as np
+from fastapi.responses import StreamingResponse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import clip_service
+from common.result_cache import ResultCache, cache_key, router as cache_router
 
 # -----------------------
 # 1. DEFINE LABELS
@@ -36,14 +48,71 @@ texts = [
 ]
 
 
+# Every label is embedded with each template and the normalized embeddings are
+# averaged (CLIP prompt ensembling), which is steadier than the bare label.
+TEMPLATES = [
+    "{}",
+    "a photo of {}.",
+    "an image showing {}.",
+    "a picture containing {}.",
+]
+
+# A label counts as a violation when its similarity reaches its threshold.
+# Per-label values come from label_thresholds.json, written by
+# calibrate_thresholds.py for the current labels and templates; labels without
+# one (or every label, before calibration) use the default.
+DEFAULT_THRESHOLD = float(os.environ.get("GUARDRAILS_THRESHOLD", "0.26"))
+THRESHOLDS_PATH = os.environ.get(
+    "GUARDRAILS_THRESHOLDS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "label_thresholds.json")
+)
+
+
+def load_thresholds(index_key):
+    overrides = {}
+    if os.path.exists(THRESHOLDS_PATH):
+        with open(THRESHOLDS_PATH) as f:
+            overrides = json.load(f)
+        if "thresholds" in overrides:
+            if overrides.get("index_key") != index_key:
+                # Scores from another label set or template ensemble aren't comparable.
+                print(f"{THRESHOLDS_PATH} was calibrated for other labels or templates, rerun calibrate_thresholds.py")
+                overrides = {"thresholds": {}}
+            overrides = overrides["thresholds"]
+        else:
+            print(f"{THRESHOLDS_PATH} has no index_key, assuming it matches the current labels")
+        unknown = set(overrides) - set(texts)
+        if unknown:
+            print(f"Ignoring thresholds for unknown labels: {sorted(unknown)}")
+    return [float(overrides.get(label, DEFAULT_THRESHOLD)) for label in texts]
+
+
 # -----------------------
 # 2. LOAD MODEL ON STARTUP
 # -----------------------
-device = "cuda" if torch.cuda.is_available() else "cpu"
-clip_model, preprocess = clip.load("ViT-B/32", device=device)
+# CLIP and the image-embedding cache live in common/clip_service.py, shared with
+# the defect detector when both run in one process.
+clip_service.get_model()
+
+# The label index is built once and kept in the result cache; see LabelIndex.
+moderation_index = clip_service.LabelIndex(
+    "moderation", texts, TEMPLATES, phrase=lambda label: label.replace("_", " ")
+)
+moderation_index.features()
+
+# Label set, templates and thresholds are part of the result key, so editing
+# any of them invalidates old results.
+thresholds = load_thresholds(moderation_index.key)
+if not os.path.exists(THRESHOLDS_PATH):
+    print(f"No {os.path.basename(THRESHOLDS_PATH)}, every label uses {DEFAULT_THRESHOLD}; see calibrate_thresholds.py")
+THRESHOLDS_KEY = json.dumps(thresholds)
+threshold_tensor = torch.tensor(thresholds)
+detect_cache = ResultCache("guardrails_detect", disk_bytes=64 * 1024 ** 2)
+
+# A full chunk fills one clip_service batch, so it runs as a single GPU pass.
+BULK_BATCH_SIZE = clip_service.image_batcher.max_batch_size
 
-# Tokenize text once (for speed)
-text_tokens = clip.tokenize(texts).to(device)
+# JPEG/PNG decode and CLIP preprocessing for /detect_bulk, off the event loop.
+decode_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="guardrails-decode")
 
 app = FastAPI(title="CLIP Content Detection API")
 
@@ -53,40 +122,166 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(cache_router)
+app.include_router(clip_service.router)
+
+
+def _detect_key(image_bytes, topk):
+    return cache_key(
+        clip_service.CLIP_KEY, clip_service.CLIP_REVISION, image_bytes, moderation_index.key, THRESHOLDS_KEY, topk=topk
+    )
+
+
+def verdict(sims, topk):
+    # Top-K labels
+    values, indices = sims.topk(topk)
+
+    # Every label at or above its own threshold, strongest first.
+    flagged = (sims >= threshold_tensor).nonzero().flatten().tolist()
+    flagged.sort(key=lambda i: -float(sims[i]))
+    return {
+        "top_k": topk,
+        "labels": [texts[i] for i in indices.tolist()],
+        "scores": [float(v) for v in values.tolist()],
+        "thresholds": [thresholds[i] for i in indices.tolist()],
+        "violations": [texts[i] for i in flagged],
+        "flagged": bool(flagged),
+    }
 
 
 # -----------------------
-# 3. API ROUTE
+# 4. API ROUTE
 # -----------------------
 @app.post("/detect")
 async def detect_content(
     file: UploadFile = File(...), 
     topk: int = Form(3)
 ):
-    # Load image
-    image = Image.open(file.file).convert("RGB")
-    image_input = preprocess(image).unsqueeze(0).to(device)
+    image_bytes = await file.read()
+    key = _detect_key(image_bytes, topk)
+    cached = detect_cache.get(key)
+    if cached is not None:
+        return cached
 
-    with torch.no_grad():
-        image_features = clip_model.encode_image(image_input)
-        text_features = clip_model.encode_text(text_tokens)
+    # Concurrent requests share one image-encoder forward pass; an image the
+    # defect detector already saw is not encoded again.
+    _, embedding = await clip_service.embed(image_bytes)
+    sims = moderation_index.scores(embedding)
 
-    # Normalize
-    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-    
-    # Similarity
-    sims = (image_features @ text_features.T).squeeze(0)
+    result = verdict(sims, topk)
+    detect_cache.put(key, result)
+    return result
 
-    # Top-K labels
-    values, indices = sims.topk(topk)
-    labels = [texts[i] for i in indices.tolist()]
-    scores = [float(v) for v in values.tolist()]
 
-    return {
-        "top_k": topk,
-        "labels": labels,
-        "scores": scores
-    }
+# -----------------------
+# 5. BULK MODERATION
+# -----------------------
+def _preprocess_bytes(image_bytes):
+    return clip_service.preprocess(Image.open(io.BytesIO(image_bytes)))
+
+
+def _tar_images(fileobj):
+    # Streaming mode ("r|*"): members are read in order, plain or compressed.
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member).read()
+
+
+async def _upload_chunks(files):
+    chunk = []
+    for f in files:
+        chunk.append((f.filename, await f.read()))
+        if len(chunk) == BULK_BATCH_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def _tar_chunks(fileobj):
+    loop = asyncio.get_running_loop()
+    members = _tar_images(fileobj)
+    while True:
+        chunk = await loop.run_in_executor(
+            decode_pool, lambda: list(itertools.islice(members, BULK_BATCH_SIZE))
+        )
+        if not chunk:
+            return
+        yield chunk
 
 
+async def _decode_chunk(chunk, start, topk):
+    loop = asyncio.get_running_loop()
+    items = []
+    for offset, (name, image_bytes) in enumerate(chunk):
+        key = _detect_key(image_bytes, topk)
+        items.append({
+            "index": start + offset, "name": name, "image_bytes": image_bytes,
+            "key": key, "cached": detect_cache.get(key),
+        })
+
+    todo = [(item, image_bytes) for item, (_, image_bytes) in zip(items, chunk) if item["cached"] is None]
+    inputs = await asyncio.gather(
+        *(loop.run_in_executor(decode_pool, _preprocess_bytes, image_bytes) for _, image_bytes in todo),
+        return_exceptions=True,
+    )
+    for (item, _), image_input in zip(todo, inputs):
+        item["input"] = image_input
+    return items
+
+
+async def _score_chunk(items, topk):
+    todo = [item for item in items if item["cached"] is None and not isinstance(item["input"], Exception)]
+    embedded = await asyncio.gather(
+        *(clip_service.embed(item["image_bytes"], image_input=item["input"]) for item in todo)
+    )
+    for item, (_, embedding) in zip(todo, embedded):
+        item["cached"] = verdict(moderation_index.scores(embedding), topk)
+        detect_cache.put(item["key"], item["cached"])
+
+    lines = []
+    for item in items:
+        line = {"index": item["index"], "name": item["name"]}
+        if item["cached"] is None:
+            line["error"] = f"Could not decode image: {item['input']}"
+        else:
+            line.update(item["cached"])
+        lines.append(json.dumps(line) + "\n")
+    return lines
+
+
+async def _bulk_verdicts(chunks, topk):
+    # The next chunk is decoded on the thread pool while the current one is on
+    # the GPU; at most two chunks of images are held in memory.
+    start = 0
+    pending = None
+    async for chunk in chunks:
+        decoding = asyncio.ensure_future(_decode_chunk(chunk, start, topk))
+        start += len(chunk)
+        if pending is not None:
+            for line in await _score_chunk(await pending, topk):
+                yield line
+        pending = decoding
+    if pending is not None:
+        for line in await _score_chunk(await pending, topk):
+            yield line
+
+
+@app.post("/detect_bulk")
+async def detect_bulk(
+    files: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    topk: int = Form(3)
+):
+    # Many images as repeated `files` parts, or one tar (optionally gzipped) as
+    # `archive`. Streams one JSON verdict per line, in input order, as each
+    # batch of BULK_BATCH_SIZE images finishes.
+    if archive is not None:
+        chunks = _tar_chunks(archive.file)
+    elif files:
+        chunks = _upload_chunks(files)
+    else:
+        return {"error": "Send images as files or a tar archive."}
+
+    return StreamingResponse(_bulk_verdicts(chunks, topk), media_type="application/x-ndjson")
@@ -1,17 +1,20 @@
 import io
-import base64
-import numpy as np
-import cv2
+import os
+import sys
 import torch
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional
 from PIL import Image
 from pydantic import BaseModel
-from iopaint.download import cli_download_model
-from iopaint.model_manager import ModelManager
-from iopaint.helper import decode_base64_to_image, pil_to_bytes, concat_alpha_channel
-from iopaint.model.utils import torch_gc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.sd15_pool import IOPAINT_KEY, iopaint_manager
+from common.executor import ModelExecutor, router as executor_router
+from common.transport import bytes_response, check_format, image_response
+from common.inpaint_roi import inpaint_upload
+from common import sd_presets
 
 app = FastAPI(title="IOPaint SD1.5 API")
 
@@ -22,110 +25,91 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(residency_router)
+app.include_router(executor_router)
+app.include_router(sd_presets.router)
 
 device = torch.device("cuda")
-MODEL = None  
+# Shared with outpaint so both tools can be co-hosted on one SD1.5 ModelManager.
+MODEL_KEY = IOPAINT_KEY
+executor = ModelExecutor("iopaint", max_queue=4)
 
 
 @app.post("/load_model")
 async def load_model():
-    global MODEL
-
-    if MODEL is not None:
+    # Advisory: /run_inpaint loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None and sd_presets.calibration:
         return {"status": "already_loaded"}
 
-    cli_download_model("runwayml/stable-diffusion-v1-5")
-
-    MODEL = ModelManager(
-        name="runwayml/stable-diffusion-v1-5",
-        device=device,
-        enable_powerpoint_v2=True,
-        disable_nsfw=True,
-        sd_cpu_textencoder=False,
-        cpu_offload=False,
-        local_files_only=False,
-        enable_brushnet=False
-    )
-
-    return {"status": "loaded"}
-
-
-
-
-def inpaint(image: str, mask: str, positive_prompt: str, negative_prompt: str):
-
-    class InpaintRequest(BaseModel):
-        image: Optional[str]
-        mask: Optional[str]
-        ldm_steps: int = 20
-        ldm_sampler: str = "plms"
-        zits_wireframe: bool = True
-        hd_strategy: str = "Crop"
-        hd_strategy_crop_trigger_size: int = 800
-        hd_strategy_crop_margin: int = 128
-        hd_strategy_resize_limit: int = 1280
-        prompt: str = ""
-        negative_prompt: str = ""
-        use_croper: bool = False
-        croper_x: int = 0
-        croper_y: int = 0
-        croper_height: int = 512
-        croper_width: int = 512
-        use_extender: bool = False
-        extender_x: int = 0
-        extender_y: int = 0
-        extender_width: int = 640
-        extender_height: int = 640
-        sd_scale: float = 1.0
-        sd_mask_blur: int = 12
-        sd_strength: float = 1.0
-        sd_steps: int = 50
-        sd_guidance_scale: float = 7.5
-        sd_sampler: str = "UniPC"
-        sd_seed: int = 42
-        sd_match_histograms: bool = False
-        sd_outpainting_softness: float = 20.0
-        sd_outpainting_space: float = 20.0
-        sd_lcm_lora: bool = False
-        sd_keep_unmasked_area: bool = True
-        cv2_flag: str = "INPAINT_NS"
-        cv2_radius: int = 4
-        paint_by_example_example_image: Optional[str] = None
-        p2p_image_guidance_scale: float = 1.5
-        enable_controlnet: bool = False
-        controlnet_conditioning_scale: float = 0.4
-        controlnet_method: str = "lllyasviel/control_v11p_sd15_canny"
-        enable_brushnet: bool = False
-        brushnet_method: str = "Sanster/brushnet_random_mask"
-        brushnet_conditioning_scale: float = 1.0
-        enable_powerpaint_v2: bool = True
-        powerpaint_task: str = "object-remove"
-        fitting_degree: float = 1.0
-
-    request = InpaintRequest(
-        image=image,
-        mask=mask,
-        prompt=positive_prompt,
-        negative_prompt=negative_prompt
-    )
-
-    
-    image_np, alpha_channel, infos, ext = decode_base64_to_image(image)
-    mask_np, _, _, _ = decode_base64_to_image(mask, gray=True)
-
-    mask_np = cv2.threshold(mask_np, 127, 255, cv2.THRESH_BINARY)[1]
-    mask_np = cv2.dilate(mask_np, np.ones((15, 15), np.uint8), iterations=1)
-
-    out_np = MODEL(image_np, mask_np, request)
-    torch_gc()
-
-    out_rgb = cv2.cvtColor(out_np.astype(np.uint8), cv2.COLOR_BGR2RGB)
-    out_rgba = concat_alpha_channel(out_rgb, alpha_channel)
-
-    out_bytes = pil_to_bytes(Image.fromarray(out_rgba), ext=ext, quality=100, infos=infos)
-    return out_bytes
-
-
+    # Loading also times each preset on this GPU, for budget_ms requests.
+    calibration = await executor.run(calibrate)
+
+    return {"status": "loaded", "calibration_ms": calibration}
+
+# Step count, sampler, LCM-LoRA and resolution come from common/sd_presets.py.
+class InpaintRequest(BaseModel):
+    image: Optional[str]
+    mask: Optional[str]
+    ldm_steps: int = 20
+    ldm_sampler: str = "plms"
+    zits_wireframe: bool = True
+    hd_strategy: str = "Crop"
+    hd_strategy_crop_trigger_size: int = 800
+    hd_strategy_crop_margin: int = 128
+    hd_strategy_resize_limit: int = 1280
+    prompt: str = ""
+    negative_prompt: str = ""
+    use_croper: bool = False
+    croper_x: int = 0
+    croper_y: int = 0
+    croper_height: int = 512
+    croper_width: int = 512
+    use_extender: bool = False
+    extender_x: int = 0
+    extender_y: int = 0
+    extender_width: int = 640
+    extender_height: int = 640
+    sd_scale: float = 1.0
+    sd_mask_blur: int = 12
+    sd_strength: float = 1.0
+    sd_steps: int = 20
+    sd_guidance_scale: float = 7.5
+    sd_sampler: str = "UniPC"
+    sd_seed: int = 42
+    sd_match_histograms: bool = False
+    sd_outpainting_softness: float = 20.0
+    sd_outpainting_space: float = 20.0
+    sd_lcm_lora: bool = False
+    sd_keep_unmasked_area: bool = True
+    cv2_flag: str = "INPAINT_NS"
+    cv2_radius: int = 4
+    paint_by_example_example_image: Optional[str] = None
+    p2p_image_guidance_scale: float = 1.5
+    enable_controlnet: bool = False
+    controlnet_conditioning_scale: float = 0.4
+    controlnet_method: str = "lllyasviel/control_v11p_sd15_canny"
+    enable_brushnet: bool = False
+    brushnet_method: str = "Sanster/brushnet_random_mask"
+    brushnet_conditioning_scale: float = 1.0
+    enable_powerpaint_v2: bool = True
+    powerpaint_task: str = "object-remove"
+    fitting_degree: float = 1.0
+
+
+def _make_request(**fields):
+    # The model only reads the decoded arrays, so the request carries no image copies.
+    # The ROI engine does its own cropping, so iopaint runs on the crop as given.
+    return InpaintRequest(image=None, mask=None, hd_strategy="Original", **fields)
+
+
+def calibrate():
+    with iopaint_manager() as model:
+        return sd_presets.calibrate(model, _make_request)
+
+
+def inpaint(image: bytes, mask: bytes, positive_prompt: str, negative_prompt: str,
+            preset: Optional[str] = None, budget_ms: Optional[float] = None, steps: Optional[int] = None):
+    return inpaint_upload(image, mask, _make_request, positive_prompt, negative_prompt, preset, budget_ms, steps)
 
 
 @app.post("/run_inpaint")
@@ -133,28 +117,36 @@ async def run_inpaint(
     image: UploadFile = File(...),
     mask: UploadFile = File(...),
     prompt: str = Form(""),
-    negative: str = Form("")
+    negative: str = Form(""),
+    preset: Optional[str] = Form(None),
+    budget_ms: Optional[float] = Form(None),
+    steps: Optional[int] = Form(None),
+    format: str = "json"
 ):
-    global MODEL
-    if MODEL is None:
-        return {"error": "Model not loaded. Call /load_model first."}
-
+    # format=json returns the result base64-encoded in the upload's format;
+    # png/webp/npy return a raw body in that format (transcoded if needed).
+    # preset is fast|balanced|quality; budget_ms picks the best preset expected
+    # to finish in time instead; steps overrides the preset's step count.
     try:
-        
-        img_b64 = base64.b64encode(await image.read()).decode("utf-8")
-        mask_b64 = base64.b64encode(await mask.read()).decode("utf-8")
+        check_format(format)
+        if preset and preset not in sd_presets.PRESETS:
+            return {"error": f"preset must be one of {', '.join(sd_presets.PRESET_ORDER)}"}
+        img_bytes = await image.read()
+        mask_bytes = await mask.read()
 
         
-        result_bytes = inpaint(img_b64, mask_b64, prompt, negative)
-
-        
-        out_b64 = base64.b64encode(result_bytes).decode("utf-8")
-
-        return {
-            "status": "success",
-            "image_base64": out_b64
-        }
-
+        result_bytes, ext, used = await executor.run(
+            inpaint, img_bytes, mask_bytes, prompt, negative, preset, budget_ms, steps
+        )
+
+        if format not in ("json", ext):
+            return image_response(Image.open(io.BytesIO(result_bytes)), format)
+        return bytes_response(
+            result_bytes, format, media_type=f"image/{ext}", extra={"status": "success", "preset": used}
+        )
+
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
@@ -162,21 +154,19 @@ async def run_inpaint(
 
 
 @app.post("/unload_model")
-async def unload_model():
-    global MODEL
-
-    if MODEL is None:
-        return {"status": "already_empty"}
-
+async def unload_model(force: bool = False):
+    # Demotes the model to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued jobs first.
     try:
-        del MODEL
-        MODEL = None
+        if force:
+            location = await executor.run(residency.evict, MODEL_KEY)
+        else:
+            location = await off_loop(residency.release, MODEL_KEY)
 
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
-        torch_gc()
+        if location is None:
+            return {"status": "already_empty"}
 
-        return {"status": "freed"}
+        return {"status": "freed", "location": location}
 
     except Exception as e:
         return {"error": str(e)}
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import numpy as np
 import torch
@@ -6,36 +7,41 @@ from PIL import Image
 import argparse
 
 import ledits_patch
-from diffusers import AutoPipelineForInpainting
+from diffusers import StableDiffusionInpaintPipeline, UNet2DConditionModel
 
 from inpaint4drag_utils.drag import bi_warp
 from inpaint4drag_utils.refine_mask import SamMaskRefiner
 
-__all__ = ['get_inpaint_pipeline', 'drag_inpaint']
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import residency
+from common.sd15_pool import get_pool
 
-_PIPE = None
+__all__ = ['get_inpaint_pipeline', 'drag_inpaint', 'MODEL_KEY']
+
+MODEL_KEY = 'runwayml/stable-diffusion-inpainting'
 _SAM_REFINER = None
 
 
-def get_inpaint_pipeline(device: str = 'cuda'):
-    global _PIPE
-    if _PIPE is not None:
-        return _PIPE
+def _load_inpaint_unet(device, dtype):
+    # Only the 9-channel inpainting UNet is specific to this checkpoint; its VAE and
+    # text encoder are the SD1.5 ones, which come from the shared component pool.
+    return UNet2DConditionModel.from_pretrained(
+        MODEL_KEY,
+        subfolder='unet',
+        torch_dtype=dtype,
+    ).to(device)
 
-    model_id = 'runwayml/stable-diffusion-inpainting'
 
+def get_inpaint_pipeline(device: str = 'cuda'):
     if device.startswith('cuda') and not torch.cuda.is_available():
         device = 'cpu'
 
     dtype = torch.float16 if (device.startswith('cuda') and torch.cuda.is_available()) else torch.float32
-    pipe = AutoPipelineForInpainting.from_pretrained(
-        model_id,
-        torch_dtype=dtype,
-        safety_checker=None,
-    ).to(device)
+    pool = get_pool(dtype=dtype)
 
-    _PIPE = pipe
-    return _PIPE
+    residency.register(MODEL_KEY, lambda: _load_inpaint_unet(device, dtype))
+    unet = residency.acquire(MODEL_KEY)
+    return pool.pipeline(StableDiffusionInpaintPipeline, unet=unet)
 
 
 def _refine_mask_if_enabled(image, mask, use_sam, kernel_size):
@@ -123,9 +129,10 @@ def drag_inpaint(
     inpaint_mask255 = (inpaint_mask01 * 255).astype(np.uint8)
 
     pipe = get_inpaint_pipeline(device=device)
-    result = _run_inpaint(
-        pipe, warped, inpaint_mask255, num_steps=num_steps, guidance_scale=guidance_scale, strength=strength
-    )
+    with get_pool(dtype=pipe.unet.dtype).use(pipe), residency.lease(MODEL_KEY):
+        result = _run_inpaint(
+            pipe, warped, inpaint_mask255, num_steps=num_steps, guidance_scale=guidance_scale, strength=strength
+        )
 
     if output_dir is not None:
         os.makedirs(output_dir, exist_ok=True)
@@ -1,14 +1,18 @@
-import io
-import base64
 import numpy as np
-import torch
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image
-from helper_functions import get_inpaint_pipeline, drag_inpaint
-import gc
+from helper_functions import get_inpaint_pipeline, drag_inpaint, MODEL_KEY
+from common.residency import off_loop, residency, router as residency_router
+from common.sd15_pool import get_pool
+from common.executor import ModelExecutor, router as executor_router
+from common.transport import check_format, decode_image, image_response
 
 app = FastAPI(title="Inpaint4Drag API")
+app.include_router(residency_router)
+app.include_router(executor_router)
+
+executor = ModelExecutor("inpaint4drag", max_queue=4)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,19 +22,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-_PIPE = None
-
 @app.post("/load_model")
 async def load_model():
-    global _PIPE
-
-    if _PIPE is not None:
+    # Advisory: /run_drag loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
         return {"status": "already_loaded"}
 
     try:
-        _PIPE = get_inpaint_pipeline(device="cuda")
+        await executor.run(get_inpaint_pipeline, device="cuda")
         return {"status": "loaded", "device": "cuda"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
@@ -47,19 +50,16 @@ async def run_drag(
     num_steps: int = Form(8),
     guidance_scale: float = Form(1.0),
     strength: float = Form(1.0),
+    format: str = "json",
 ):
-    global _PIPE
-    if _PIPE is None:
-        return {"error": "Model not loaded. Call /load_model first."}
-
-    
+    check_format(format)
     img_bytes = await image.read()
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+    img = decode_image(img_bytes).convert("RGB")
     img_np = np.array(img)
 
     
     mask_bytes = await mask.read()
-    mask_img = Image.open(io.BytesIO(mask_bytes)).convert("L")
+    mask_img = decode_image(mask_bytes).convert("L")
     mask_np = np.array(mask_img)
     H, W = mask_np.shape
 
@@ -71,7 +71,8 @@ async def run_drag(
 
     try:
         
-        result = drag_inpaint(
+        result = await executor.run(
+            drag_inpaint,
             image=img_np,
             mask=mask_np,
             points=points,
@@ -84,38 +85,33 @@ async def run_drag(
 
         
         out_img = Image.fromarray(result)
-        buffer = io.BytesIO()
-        out_img.save(buffer, format="PNG")
-        img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
-        return {
-            "status": "success",
-            "image_base64": img_base64
-        }
+        return image_response(out_img, format, extra={"status": "success"})
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
 
 
 @app.post("/unload_model")
-async def unload_model():
-    global _PIPE
-
-    if _PIPE is None:
-        return {"status": "already_empty"}
-
+async def unload_model(force: bool = False):
+    # Demotes the pipeline to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued jobs first.
     try:
-        del _PIPE
-        _PIPE = None
-        gc.collect()
-
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
-            torch.cuda.synchronize()
-
-        return {"status": "freed_all_gpu_memory"}
+        # The VAE / text encoder live in the shared SD1.5 pool.
+        if force:
+            location = await executor.run(residency.evict, MODEL_KEY)
+            await executor.run(get_pool().evict)
+        else:
+            location = await off_loop(residency.release, MODEL_KEY)
+            await off_loop(get_pool().release)
+
+        if location is None:
+            return {"status": "already_empty"}
+
+        return {"status": "freed_all_gpu_memory", "location": location}
 
     except Exception as e:
         return {"error": str(e)}
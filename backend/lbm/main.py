@@ -1,11 +1,16 @@
-import io
+import os
+import sys
 import torch
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from diffusers.utils import load_image
 from lbm.inference import evaluate, get_model
-from PIL import Image
-import base64
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.executor import ModelExecutor, router as executor_router
+from common.transport import check_format, decode_image, image_response
+
 app = FastAPI(title="LBM Relighting API")
 app.add_middleware(
     CORSMiddleware,
@@ -14,29 +19,49 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(residency_router)
+app.include_router(executor_router)
 
-MODEL = None
+MODEL_KEY = "jasperai/LBM_relighting"
 DEVICE = "cuda"
 
+
+def _load_lbm():
+    return get_model(
+        MODEL_KEY,
+        torch_dtype=torch.bfloat16,
+        device=DEVICE,
+    )
+
+
+residency.register(MODEL_KEY, _load_lbm, priority=1)
+
+executor = ModelExecutor("lbm", max_queue=8)
+
+
+def _relight(input_pil, steps):
+    print("[INFO] Running evaluate()")
+
+    with residency.lease(MODEL_KEY) as MODEL:
+        return evaluate(MODEL, input_pil, num_sampling_steps=steps)
+
+
 @app.post("/load_model")
 async def load_model():
-    global MODEL
-
-    if MODEL is not None:
+    # Advisory: /run_relighting loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
         return {"status": "already_loaded"}
 
     try:
-        MODEL = get_model(
-            "jasperai/LBM_relighting",
-            torch_dtype=torch.bfloat16,
-            device=DEVICE,
-        )
+        await executor.run(residency.acquire, MODEL_KEY)
         return {
             "status": "loaded",
-            "model": "jasperai/LBM_relighting",
+            "model": MODEL_KEY,
             "device": DEVICE
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
@@ -46,55 +71,46 @@ async def load_model():
 @app.post("/run_relighting")
 async def run_relighting(
     image: UploadFile = File(...),
-    steps: int = Form(1)
+    steps: int = Form(1),
+    format: str = "json"
 ):
-    global MODEL
-    if MODEL is None:
-        return {"error": "Model is not loaded. Call /load_model first."}
-
-    
+    check_format(format)
     image_bytes = await image.read()
-    input_pil = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    input_pil = decode_image(image_bytes).convert("RGB")
 
     try:
-        print("[INFO] Running evaluate()")
-
-        out_pil = evaluate(MODEL, input_pil, num_sampling_steps=steps)
+        out_pil = await executor.run(_relight, input_pil, steps)
 
         
         w, h = input_pil.size
         out_pil = out_pil.resize((w, h))
 
-       
-        buf = io.BytesIO()
-        out_pil.save(buf, format="PNG")
-        out_b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-
-        return {
-            "status": "success",
-            "image_base64": out_b64
-        }
+        return image_response(out_pil, format, extra={"status": "success"})
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
 
 
 @app.post("/unload_model")
-async def unload_model():
-    global MODEL
-    if MODEL is None:
-        return {"status": "already_empty"}
-
+async def unload_model(force: bool = False):
+    # Demotes the model to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued jobs first.
     try:
-        del MODEL
-        MODEL = None
+        if force:
+            location = await executor.run(residency.evict, MODEL_KEY)
+        else:
+            location = await off_loop(residency.release, MODEL_KEY)
 
-        torch.cuda.empty_cache()
-        torch.cuda.ipc_collect()
+        if location is None:
+            return {"status": "already_empty"}
 
-        return {"status": "freed_gpu_memory"}
+        return {"status": "freed_gpu_memory", "location": location}
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
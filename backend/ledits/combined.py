@@ -0,0 +1,64 @@
+import importlib.util
+import os
+import sys
+
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(HERE)
+sys.path.append(BACKEND)
+from common.residency import router as residency_router
+from common.executor import router as executor_router
+
+# The SD1.5 pool is only shared by views of the same dtype, so LEDITS++ runs in
+# fp16 here like the other two tools (its standalone default is fp32).
+os.environ.setdefault("LEDITS_DTYPE", "fp16")
+
+
+def _load_service(name, folder):
+    # Every tool's entrypoint is a main.py next to its own helper modules, so
+    # put the folder on the path and load main.py under a unique name.
+    path = os.path.join(BACKEND, folder)
+    if path not in sys.path:
+        sys.path.append(path)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(path, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+ledits = _load_service("ledits_main", "ledits")
+style_transfer = _load_service("style_transfer_main", "style_transfer")
+inpaint4drag = _load_service("inpaint4drag_main", "inpaint4Drag")
+
+# ============================================================
+# APP INIT
+# ============================================================
+# LEDITS++, style transfer and Inpaint4Drag in one process: all three build
+# their pipelines from one copy of the SD1.5 UNet / VAE / text encoder in
+# common/sd15_pool.py, so co-hosting them needs a single SD1.5 in VRAM instead
+# of three. Each tool keeps its own worker; jobs on the shared weights take
+# turns through the pool lock. Unloading any of them demotes the shared
+# weights once the running job ends; the next request promotes them again.
+app = FastAPI(title="SD1.5 tools (LEDITS++ + Style Transfer + Inpaint4Drag)")
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.include_router(residency_router)
+app.include_router(executor_router)
+
+# style_transfer and inpaint4Drag both have /load_model and /unload_model, so
+# every tool keeps its routes under its own prefix.
+app.mount("/ledits", ledits.app)
+app.mount("/style_transfer", style_transfer.app)
+app.mount("/inpaint4drag", inpaint4drag.app)
+
+
+@app.get("/")
+def root():
+    return {"message": "SD1.5 tools running", "tools": ["/ledits", "/style_transfer", "/inpaint4drag"]}
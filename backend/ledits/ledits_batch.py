@@ -0,0 +1,207 @@
+# ledits_batch.py — several LEDITS++ edits of one inverted image in one denoising loop
+import torch
+import torch.nn.functional as F
+
+from common.jobs import latents_to_preview
+
+
+# -------------------------------------------------------
+# Cross-attention maps
+# -------------------------------------------------------
+class _AttentionMaps:
+    """Per-step sum of the edit concepts' cross-attention maps at one resolution."""
+
+    def __init__(self, first_row, num_pixels):
+        self.first_row = first_row  # UNet batch rows before this are the uncond ones
+        self.num_pixels = num_pixels
+        self.reset()
+
+    def reset(self):
+        self.total = None
+        self.layers = 0
+
+    def add(self, probs, batch):
+        # probs: (batch * heads, pixels, tokens), batch-major like head_to_batch_dim.
+        probs = probs.reshape(batch, -1, *probs.shape[1:])[self.first_row:].mean(1)
+        self.total = probs if self.total is None else self.total + probs
+        self.layers += 1
+
+    def mean(self, resolution):
+        return (self.total / self.layers).reshape(self.total.shape[0], *resolution, -1)
+
+
+class _StoreCrossAttention:
+    """
+    Cross-attention that also records the attention probabilities of the layers
+    at the mask resolution. Other layers go to the UNet's own processor.
+    """
+
+    def __init__(self, maps, fallback):
+        self.maps = maps
+        self.fallback = fallback
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, **kwargs):
+        if encoder_hidden_states is None or hidden_states.shape[1] != self.maps.num_pixels:
+            return self.fallback(attn, hidden_states, encoder_hidden_states, attention_mask, **kwargs)
+
+        batch, sequence_length, _ = encoder_hidden_states.shape
+        attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch)
+        query = attn.to_q(hidden_states)
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        key = attn.head_to_batch_dim(attn.to_k(encoder_hidden_states))
+        value = attn.head_to_batch_dim(attn.to_v(encoder_hidden_states))
+
+        probs = attn.get_attention_scores(attn.head_to_batch_dim(query), key, attention_mask)
+        self.maps.add(probs, batch)
+
+        hidden_states = attn.batch_to_head_dim(torch.bmm(probs, value))
+        hidden_states = attn.to_out[1](attn.to_out[0](hidden_states))
+        return hidden_states / attn.rescale_output_factor
+
+
+def _store_processors(unet, maps):
+    processors = {}
+    for name, processor in unet.attn_processors.items():
+        if "attn2" in name and name.startswith(("down_blocks", "up_blocks")):
+            processor = _StoreCrossAttention(maps, processor)
+        processors[name] = processor
+    return processors
+
+
+# -------------------------------------------------------
+# Masking
+# -------------------------------------------------------
+def _gaussian_kernel(device, dtype, size=3, sigma=0.5):
+    x = torch.arange(size, dtype=torch.float32) - (size - 1) / 2
+    g = torch.exp(-((x / (2 * sigma)) ** 2))
+    kernel = g[:, None] * g[None, :]
+    return (kernel / kernel.sum()).to(device=device, dtype=dtype)[None, None]
+
+
+def _row_quantile(x, q):
+    """torch.quantile (linear) of every row of `x` at its own level q[row]."""
+    x = x.float().sort(dim=1).values
+    pos = q.float() * (x.shape[1] - 1)
+    lo = pos.floor().long()[:, None]
+    hi = pos.ceil().long()[:, None]
+    frac = (pos - pos.floor())[:, None]
+    low = x.gather(1, lo)
+    return (low + frac * (x.gather(1, hi) - low)).squeeze(1)
+
+
+def _edit_guidance(concept_pred, uncond_pred, t, maps, attn_res, kernel, tokens, scale, threshold):
+    """
+    LEDITS++ guidance of every concept row, masked by the intersection of its
+    smoothed cross-attention map and the largest guidance values (the
+    use_intersect_mask path).
+    """
+    guidance = (concept_pred - uncond_pred) * scale[:, None, None, None]
+
+    # Attention map of the concept's own tokens (after startoftext).
+    attn = maps.mean(attn_res)
+    positions = torch.arange(attn.shape[-1], device=attn.device)
+    token_mask = (positions >= 1) & (positions[None] <= tokens[:, None])
+    attn = (attn * token_mask[:, None, None, :]).sum(-1)
+    attn = F.conv2d(F.pad(attn.unsqueeze(1), (1, 1, 1, 1), mode="reflect"), kernel).squeeze(1)
+    cutoff = _row_quantile(attn.flatten(1), threshold).to(attn.dtype)
+    attn_mask = (attn >= cutoff[:, None, None]).to(guidance.dtype)
+    attn_mask = F.interpolate(attn_mask.unsqueeze(1), guidance.shape[-2:])
+
+    if t > 800:
+        return guidance * attn_mask
+
+    magnitude = guidance.abs().sum(dim=1, keepdim=True)
+    cutoff = _row_quantile(magnitude.flatten(1), threshold).to(magnitude.dtype)
+    return guidance * (magnitude >= cutoff[:, None, None, None]).to(guidance.dtype) * attn_mask
+
+
+# -------------------------------------------------------
+# Batched edit
+# -------------------------------------------------------
+@torch.no_grad()
+def edit_batch(pipe, variants, job=None, preview_every=5):
+    """
+    Runs every (prompts, thresholds, guidance, reverse) variant on the image
+    `pipe` was just inverted on, and returns one PIL image per variant.
+
+    The edit prompts of all variants go through the text encoder once, and each
+    denoising step is one UNet call over [uncond of every variant, every
+    concept of every variant], so N variants cost one loop instead of N.
+    Uses the init latents and noise maps that invert() leaves on the pipeline.
+    """
+    device, dtype = pipe.unet.device, pipe.unet.dtype
+    n = len(variants)
+
+    # Which variant every concept row belongs to, and its settings.
+    owner, prompts, scale, threshold = [], [], [], []
+    for v, (edit_prompt, edit_thresholds, edit_guidance, reverse_edit) in enumerate(variants):
+        for c, prompt in enumerate(edit_prompt):
+            owner.append(v)
+            prompts.append(prompt)
+            sign = -1.0 if c < len(reverse_edit) and reverse_edit[c] else 1.0
+            scale.append(sign * edit_guidance[min(c, len(edit_guidance) - 1)])
+            threshold.append(edit_thresholds[min(c, len(edit_thresholds) - 1)])
+    owner = torch.tensor(owner, device=device)
+    scale = torch.tensor(scale, device=device, dtype=dtype)
+    threshold = torch.tensor(threshold, device=device)
+
+    # One text-encoder pass: the empty prompt plus every distinct edit prompt.
+    unique = list(dict.fromkeys(prompts))
+    text = pipe.tokenizer(
+        [""] + unique,
+        padding="max_length",
+        max_length=pipe.tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    )
+    embeds = pipe.text_encoder(text.input_ids.to(device))[0].to(dtype)
+    rows = torch.tensor([1 + unique.index(p) for p in prompts], device=device)
+    text_embeddings = torch.cat([embeds[:1].expand(n, -1, -1), embeds[rows]])
+    tokens = (text.attention_mask.sum(1).to(device) - 2)[rows]  # without startoftext / endoftext
+
+    latents = pipe.init_latents[:1].to(device=device, dtype=dtype).expand(n, -1, -1, -1).contiguous()
+    zs = pipe.zs.to(device=device, dtype=dtype)
+    timesteps = getattr(pipe, "inversion_steps", None)
+    if timesteps is None:
+        timesteps = pipe.scheduler.timesteps[-zs.shape[0]:]
+    t_to_idx = {int(t): i for i, t in enumerate(timesteps[-zs.shape[0]:])}
+
+    # Fresh solver state (model_outputs, lower_order_nums, step index) for this
+    # loop, like the pipeline's own __call__.
+    pipe.scheduler.set_timesteps(len(pipe.scheduler.timesteps))
+
+    attn_res = (latents.shape[-2] // 4, latents.shape[-1] // 4)
+    maps = _AttentionMaps(first_row=n, num_pixels=attn_res[0] * attn_res[1])
+    kernel = _gaussian_kernel(device, dtype)
+    model_rows = torch.cat([torch.arange(n, device=device), owner])
+
+    original = pipe.unet.attn_processors
+    pipe.unet.set_attn_processor(_store_processors(pipe.unet, maps))
+    try:
+        for i, t in enumerate(timesteps):
+            maps.reset()
+            model_input = pipe.scheduler.scale_model_input(latents[model_rows], t)
+            noise_pred = pipe.unet(model_input, t, encoder_hidden_states=text_embeddings).sample
+            uncond_pred, concept_pred = noise_pred[:n], noise_pred[n:]
+
+            guidance = _edit_guidance(
+                concept_pred, uncond_pred[owner], t, maps, attn_res, kernel, tokens, scale, threshold
+            )
+            noise_pred = uncond_pred.index_add(0, owner, guidance)
+
+            noise = zs[t_to_idx[int(t)]].expand_as(latents)
+            latents = pipe.scheduler.step(noise_pred, t, latents, variance_noise=noise).prev_sample
+
+            if job is not None:
+                preview = latents_to_preview(latents) if i % preview_every == 0 else None
+                job.progress(i + 1, len(timesteps), stage=f"edit {n} variants", preview=preview)
+    finally:
+        pipe.unet.set_attn_processor(original)
+
+    # Decode one at a time, the VAE at full resolution dominates peak memory.
+    images = []
+    for latent in latents.split(1):
+        image = pipe.vae.decode(latent / pipe.vae.config.scaling_factor).sample
+        images += pipe.image_processor.postprocess(image, output_type="pil")
+    return images
@@ -1,17 +1,37 @@
 import io
+import os
+import sys
 import base64
+import copy
+import hashlib
+import json
+from collections import OrderedDict
 import torch
 from typing import Optional, List
 from PIL import Image
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 import ledits_patch
+from ledits_batch import edit_batch
 from leditspp import StableDiffusionPipeline_LEDITS
 from leditspp.scheduling_dpmsolver_multistep_inject import DPMSolverMultistepSchedulerInject
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.sd15_pool import get_pool
+from common.executor import ModelExecutor, router as executor_router
+from common.jobs import JobManager, pipeline_progress, preview_callback_kwargs
+from common.transport import encode_image
+
 
 app = FastAPI(title="LEDITS++ Manager API")
-pipe = None
+# UNet / VAE / text encoder are shared with the other SD1.5 tools in this process.
+# fp32 like the original LEDITS++ pipeline; LEDITS_DTYPE=fp16 shares the fp16
+# pool with style transfer and inpaint4Drag (see combined.py), at the cost of
+# slightly different edits.
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16}
+pool = get_pool(dtype=DTYPES[os.environ.get("LEDITS_DTYPE", "fp32")])
+MODEL_KEY = pool.key
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -20,100 +40,419 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/load_ledits")
-async def load_ledits():
-    global pipe
+app.include_router(residency_router)
+app.include_router(executor_router)
 
-    if pipe is not None:
-        return {"status": "already_loaded"}
+# Inversion + editing takes tens of seconds, so only a couple of jobs may wait.
+executor = ModelExecutor("ledits", max_queue=3)
+jobs = JobManager(executor)
+app.include_router(jobs.router())
 
-    pipe = StableDiffusionPipeline_LEDITS.from_pretrained(
-        "runwayml/stable-diffusion-v1-5",
-        safety_checker=None
-    )
 
-    pipe.scheduler = DPMSolverMultistepSchedulerInject.from_pretrained(
-        "runwayml/stable-diffusion-v1-5",
-        subfolder="scheduler",
+def _ledits_view():
+    scheduler = pool.scheduler(
+        DPMSolverMultistepSchedulerInject,
         algorithm_type="sde-dpmsolver++",
         solver_order=2
     )
+    return pool.pipeline(StableDiffusionPipeline_LEDITS, scheduler=scheduler)
+
+
+# -------------------------------------------------------
+# Inversion cache
+# -------------------------------------------------------
+# Inversion costs as much as the edit itself and only depends on the image and
+# these settings, so iterating on edit prompts for one image reuses it.
+INVERSION_STEPS = 50
+INVERSION_SKIP = 0.15
+INVERSION_SEED = 42
+INVERSION_CACHE_ENTRIES = 8  # a few MB each (latents + noise maps), kept in CPU RAM
+
+
+def image_id_for(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class InversionCache:
+    """LRU of inversion results keyed by (image hash, steps, skip, seed)."""
+
+    def __init__(self, entries=INVERSION_CACHE_ENTRIES):
+        self.entries = entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        state = self._entries.get(key)
+        if state is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return state
+
+    def put(self, key, state):
+        self._entries[key] = state
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"entries": len(self._entries), "max_entries": self.entries, "hits": self.hits, "misses": self.misses}
+
+
+inversions = InversionCache()
+
+
+def _copy(value, device):
+    # Deep copies, so in-place updates during an edit (the scheduler's
+    # model_outputs list, lower_order_nums, ...) never reach the cached state.
+    if torch.is_tensor(value):
+        return value.to(device, copy=True)
+    if isinstance(value, list):
+        return [_copy(v, device) for v in value]
+    if isinstance(value, dict):
+        return {k: _copy(v, device) for k, v in value.items()}
+    return copy.deepcopy(value)
+
+
+def _changed(obj, before):
+    # invert() stores its results (init latents, zs, timesteps, eta, ...) as
+    # attributes on the pipeline; which ones differs between leditspp
+    # versions, so take whatever it set.
+    return {k: _copy(v, "cpu") for k, v in vars(obj).items() if k not in before or before[k] is not v}
+
+
+def _rng_state():
+    return torch.get_rng_state(), torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+
+
+def _set_rng_state(state):
+    cpu, cuda = state
+    torch.set_rng_state(cpu)
+    if cuda is not None:
+        torch.cuda.set_rng_state_all(cuda)
+
+
+def _invert(pipe, img, key, job=None):
+    """
+    Leaves `pipe` in its post-inversion state, from the cache when possible.
+    Returns True on a cache hit. Call inside pool.use(pipe).
+    """
+    image_id, steps, skip, seed = key
+    cached = inversions.get(key)
+    if cached is not None:
+        pipe_state, scheduler_state, rng = cached
+        for k, v in pipe_state.items():
+            setattr(pipe, k, _copy(v, pipe.device))
+        for k, v in scheduler_state.items():
+            setattr(pipe.scheduler, k, _copy(v, pipe.device))
+        # Same RNG position as right after a real inversion, so hits and misses
+        # produce identical edits.
+        _set_rng_state(rng)
+        return True
+
+    if img is None:
+        raise ValueError("Inversion for this image_id is no longer cached, send the file again.")
+
+    gen = torch.manual_seed(seed)
+    with pipeline_progress(pipe, job, stage="invert"):
+        before = dict(vars(pipe))
+        _ = pipe.invert(
+            img,
+            num_inversion_steps=steps,
+            generator=gen,
+            verbose=False,
+            skip=skip
+        )
+        # The whole scheduler, not just the attributes invert() replaced: the
+        # solver also counts and appends in place.
+        scheduler_state = {k: _copy(v, "cpu") for k, v in vars(pipe.scheduler).items()}
+        state = _changed(pipe, before), scheduler_state, _rng_state()
+    inversions.put(key, state)
+    return False
+
+
+def _invert_only(img, key):
+    pipe = _ledits_view()
+    with pool.use(pipe), torch.no_grad():
+        return _invert(pipe, img, key)
+
+
+def _edit(img, key, edit_prompt, edit_thresholds, edit_guidance, reverse_edit, job=None):
+    pipe = _ledits_view()
+
+    with pool.use(pipe), torch.no_grad():
+        _invert(pipe, img, key, job)
+
+        with pipeline_progress(pipe, job, stage="edit"):
+            out = pipe(
+                editing_prompt=edit_prompt,
+                edit_threshold=edit_thresholds,
+                edit_guidance_scale=edit_guidance,
+                reverse_editing_direction=reverse_edit,
+                use_intersect_mask=True,
+                **preview_callback_kwargs(pipe, job),
+            )
+
+    return out.images[0]
+
+
+def _edit_variants(img, key, variants, job=None):
+    """
+    Runs several edit configurations on one image under a single job: one
+    inversion, one pool checkout and one batched denoising loop. The variants
+    are stacked along the UNet batch (see ledits_batch.edit_batch), so N
+    variants cost one pass with a larger batch rather than N passes.
+    """
+    pipe = _ledits_view()
+
+    with pool.use(pipe), torch.no_grad():
+        _invert(pipe, img, key, job)
+        return edit_batch(pipe, variants, job=job)
+
+
+async def _read_image(file, image_id, steps, skip, seed):
+    """
+    Returns (img, inversion key) for an upload, or (None, key) for an image_id
+    whose inversion is cached. (None, error dict) otherwise.
+    """
+    if file is not None:
+        image_bytes = await file.read()
+        img = Image.open(io.BytesIO(image_bytes)).convert("RGB").resize((512, 512))
+        return img, (image_id_for(image_bytes), steps, skip, seed)
+    if image_id is not None:
+        key = (image_id, steps, skip, seed)
+        if key not in inversions:
+            return None, {"error": "Unknown image_id for these inversion settings, send the file or call /invert."}
+        return None, key
+    return None, {"error": "Send either file or image_id."}
+
+
+def _read_edit_form(prompt, thresholds, guidance, reverse):
+    edit_prompt = [p.strip() for p in prompt.split(",")]
+    edit_thresholds = [float(x) for x in thresholds.split(",")]
+    edit_guidance = [float(x) for x in guidance.split(",")]
+    reverse_edit = [(x.lower() == "true") for x in reverse.split(",")]
+    return edit_prompt, edit_thresholds, edit_guidance, reverse_edit
+
+
+MAX_VARIANTS = 8
+
 
-    pipe.to("cuda")
+def _parse_variants(variants):
+    """
+    `variants` is a JSON list of objects with prompt, thresholds, guidance and
+    reverse, each a list or a comma-separated string like the /run_ledits form.
+    Returns (list of edit args, None) or (None, error message).
+    """
+    try:
+        items = json.loads(variants)
+    except ValueError:
+        return None, "variants must be a JSON list."
+    if not isinstance(items, list) or not items:
+        return None, "variants must be a non-empty JSON list."
+    if len(items) > MAX_VARIANTS:
+        return None, f"At most {MAX_VARIANTS} variants per request."
+
+    def csv(value):
+        return ",".join(str(v) for v in value) if isinstance(value, list) else str(value)
+
+    parsed = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("prompt"):
+            return None, "Each variant must be an object with a prompt."
+        try:
+            parsed.append(_read_edit_form(
+                csv(item["prompt"]),
+                csv(item.get("thresholds", "0.7,0.9")),
+                csv(item.get("guidance", "3,4")),
+                csv(item.get("reverse", "false,false")),
+            ))
+        except ValueError:
+            return None, "thresholds and guidance must be numbers."
+    return parsed, None
+
+
+def _variants_result(images):
+    return {
+        "message": f"LEDITS++ produced {len(images)} variants",
+        "images_base64": [base64.b64encode(encode_image(img)).decode() for img in images]
+    }
+
+
+@app.post("/load_ledits")
+async def load_ledits():
+    # Advisory: /run_ledits loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
+        return {"status": "already_loaded"}
+
+    await executor.run(pool.components)
 
     return {"status": "loaded", "device": "cuda"}
 
 
 
+@app.post("/invert")
+async def invert(
+    file: UploadFile = File(...),
+    inversion_steps: int = Form(INVERSION_STEPS),
+    skip: float = Form(INVERSION_SKIP),
+    seed: int = Form(INVERSION_SEED)
+):
+    # Warms the inversion cache on upload; later edits can send the returned
+    # image_id instead of the file.
+    img, key = await _read_image(file, None, inversion_steps, skip, seed)
+    cached = await executor.run(_invert_only, img, key)
+    return {"status": "cached" if cached else "inverted", "image_id": key[0]}
+
+
+@app.get("/inversions")
+def inversion_stats():
+    return inversions.stats()
+
+
 @app.post("/run_ledits")
 async def run_ledits(
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
     prompt: str = Form(...),
     thresholds: str = Form("0.7,0.9"),
     guidance: str = Form("3,4"),
     reverse: str = Form("false,false"),
+    inversion_steps: int = Form(INVERSION_STEPS),
+    skip: float = Form(INVERSION_SKIP),
+    seed: int = Form(INVERSION_SEED),
     save_result: bool = Form(True)  
 ):
-    global pipe
-
-    if pipe is None:
-        return {"error": "Model not loaded. Call /load_ledits first."}
+    img, key = await _read_image(file, image_id, inversion_steps, skip, seed)
+    if isinstance(key, dict):
+        return key
+    edit_args = _read_edit_form(prompt, thresholds, guidance, reverse)
 
-    
-    image_bytes = await file.read()
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    img = img.resize((512, 512))
+    try:
+        result_img = await executor.run(_edit, img, key, *edit_args)
+    except ValueError as e:
+        return {"error": str(e)}
 
-    
-    edit_prompt = [p.strip() for p in prompt.split(",")]
-    edit_thresholds = [float(x) for x in thresholds.split(",")]
-    edit_guidance = [float(x) for x in guidance.split(",")]
-    reverse_edit = [(x.lower() == "true") for x in reverse.split(",")]
+    save_path = "ledits_output.png"
+    result_img.save(save_path)
 
-    
-    gen = torch.manual_seed(42)
+    return {
+        "message": "LEDITS++ edit complete",
+        "saved_to": save_path
+    }
 
-    with torch.no_grad():
-        _ = pipe.invert(
-            img,
-            num_inversion_steps=50,
-            generator=gen,
-            verbose=False,
-            skip=0.15
-        )
 
-        out = pipe(
-            editing_prompt=edit_prompt,
-            edit_threshold=edit_thresholds,
-            edit_guidance_scale=edit_guidance,
-            reverse_editing_direction=reverse_edit,
-            use_intersect_mask=True,
-        )
 
-    result_img = out.images[0]
+def _edit_job(job, *edit_args):
+    result_img = _edit(*edit_args, job=job)
 
     save_path = "ledits_output.png"
     result_img.save(save_path)
 
+    buf = io.BytesIO()
+    result_img.save(buf, format="PNG")
     return {
         "message": "LEDITS++ edit complete",
-        "saved_to": save_path
+        "saved_to": save_path,
+        "image_base64": base64.b64encode(buf.getvalue()).decode()
     }
 
 
+@app.post("/jobs/run_ledits")
+async def submit_ledits(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    prompt: str = Form(...),
+    thresholds: str = Form("0.7,0.9"),
+    guidance: str = Form("3,4"),
+    reverse: str = Form("false,false"),
+    inversion_steps: int = Form(INVERSION_STEPS),
+    skip: float = Form(INVERSION_SKIP),
+    seed: int = Form(INVERSION_SEED),
+    supersede: Optional[str] = Form(None)
+):
+    # Same edit as /run_ledits, but returns a job id right away. Progress is on
+    # /jobs/{id}/events, the image on /jobs/{id}/result. Jobs sharing a
+    # `supersede` key cancel the older ones.
+    img, key = await _read_image(file, image_id, inversion_steps, skip, seed)
+    if isinstance(key, dict):
+        return key
+    edit_args = _read_edit_form(prompt, thresholds, guidance, reverse)
+    job = jobs.submit("ledits", _edit_job, img, key, *edit_args, supersede_key=supersede)
+    return job.info()
+
+
+@app.post("/run_ledits_variants")
+async def run_ledits_variants(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    variants: str = Form(...),
+    inversion_steps: int = Form(INVERSION_STEPS),
+    skip: float = Form(INVERSION_SKIP),
+    seed: int = Form(INVERSION_SEED)
+):
+    # Several edit configurations for one image, e.g.
+    # [{"prompt": "sunglasses", "guidance": [3]}, {"prompt": "sunglasses", "guidance": [6]}].
+    # Images come back in the same order. The variants share the inversion, one
+    # queued job and one batched denoising loop.
+    img, key = await _read_image(file, image_id, inversion_steps, skip, seed)
+    if isinstance(key, dict):
+        return key
+    parsed, error = _parse_variants(variants)
+    if error:
+        return {"error": error}
+
+    try:
+        images = await executor.run(_edit_variants, img, key, parsed)
+    except ValueError as e:
+        return {"error": str(e)}
+
+    return _variants_result(images)
+
+
+def _variants_job(job, img, key, variants):
+    return _variants_result(_edit_variants(img, key, variants, job=job))
+
+
+@app.post("/jobs/run_ledits_variants")
+async def submit_ledits_variants(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    variants: str = Form(...),
+    inversion_steps: int = Form(INVERSION_STEPS),
+    skip: float = Form(INVERSION_SKIP),
+    seed: int = Form(INVERSION_SEED),
+    supersede: Optional[str] = Form(None)
+):
+    img, key = await _read_image(file, image_id, inversion_steps, skip, seed)
+    if isinstance(key, dict):
+        return key
+    parsed, error = _parse_variants(variants)
+    if error:
+        return {"error": error}
+
+    job = jobs.submit("ledits_variants", _variants_job, img, key, parsed, supersede_key=supersede)
+    return job.info()
+
 
 @app.post("/free_ledits")
-async def free_ledits():
-    global pipe
+async def free_ledits(force: bool = False):
+    # Demotes the pipeline to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued jobs first.
+    if force:
+        location = await executor.run(residency.evict, MODEL_KEY)
+    else:
+        location = await off_loop(residency.release, MODEL_KEY)
 
-    if pipe is None:
+    if location is None:
         return {"status": "already_empty"}
 
-    pipe = None
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
-
-    return {"status": "freed"}
+    return {"status": "freed", "location": location}
 
 
 @app.get("/")
@@ -1,14 +1,19 @@
-import io
-import base64
-import numpy as np
-import torch
-from fastapi import FastAPI, UploadFile, File, Form
-from PIL import Image
+import os
+import sys
+import uuid
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from lightning_drag_inference import load_lightningdrag, run_inference
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.executor import ModelExecutor, router as executor_router
+from common.transport import decode_image, multipart_response
+
 app = FastAPI(title="LightningDrag API")
+app.include_router(residency_router)
+app.include_router(executor_router)
 
-PIPE = None
+MODEL_KEY = "lightning_drag"
 
 BASE_SD_PATH = "/workspace/checkpoints/dreamshaper-8-inpainting"
 VAE_PATH = "/workspace/checkpoints/sd-vae-ft-ema"
@@ -18,21 +23,35 @@ LCM_LORA_PATH = "/workspace/checkpoints/lcm-lora-sdv1-5/pytorch_lora_weights.saf
 DEVICE = "cuda"
 
 
+def _load_pipe():
+    return load_lightningdrag(
+        base_sd_path=BASE_SD_PATH,
+        vae_path=VAE_PATH,
+        ip_adapter_path=IP_ADAPTER_PATH,
+        lightning_drag_path=LIGHTNING_DRAG_PATH,
+        lcm_lora_path=LCM_LORA_PATH,
+        device=DEVICE
+    )
+
+
+residency.register(MODEL_KEY, _load_pipe)
+
+executor = ModelExecutor(MODEL_KEY, max_queue=4)
+
+
+def _drag(**kwargs):
+    with residency.lease(MODEL_KEY) as pipe:
+        return run_inference(pipe=pipe, **kwargs)
+
+
  
 @app.post("/load_model")
 async def load_model():
-    global PIPE
-    if PIPE is not None:
+    # Advisory: /run_drag loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
         return {"status": "already_loaded"}
     try:
-        PIPE = load_lightningdrag(
-            base_sd_path=BASE_SD_PATH,
-            vae_path=VAE_PATH,
-            ip_adapter_path=IP_ADAPTER_PATH,
-            lightning_drag_path=LIGHTNING_DRAG_PATH,
-            lcm_lora_path=LCM_LORA_PATH,
-            device=DEVICE
-        )
+        await executor.run(residency.acquire, MODEL_KEY)
         return {
             "status": "loaded",
             "device": DEVICE,
@@ -53,63 +72,81 @@ async def run_drag(
     target_x: int = Form(...),
     num_inference_steps: int = Form(25),
     guidance_scale_points: float = Form(4.0),
-    output_dir: str = Form("./outputs")
+    output_dir: str = Form("./outputs"),
+    format: str = "json"
 ):
-    global PIPE
-    if PIPE is None:
-        return {"error": "Model not loaded. Call /load_model first."}
-
+    # format=multipart returns every result PNG in one multipart/mixed body
+    # instead of only the paths they were saved to.
     image_bytes = await image.read()
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    img = decode_image(image_bytes).convert("RGB")
     width, height = img.size
 
     if not (0 <= handle_x < width and 0 <= handle_y < height and
             0 <= target_x < width and 0 <= target_y < height):
         return {"error": "Points are out of image bounds"}
 
-    image_path = "./tmp_input.png"
-    mask_path = "./tmp_mask.png"
+    # Requests now overlap while a drag is queued, so inputs get per-request names.
+    request_id = uuid.uuid4().hex
+    image_path = f"./tmp_input_{request_id}.png"
+    mask_path = f"./tmp_mask_{request_id}.png"
     img.save(image_path)
 
     mask_bytes = await mask.read()
-    mask_img = Image.open(io.BytesIO(mask_bytes)).convert("L")
+    mask_img = decode_image(mask_bytes).convert("L")
     mask_img.save(mask_path)
 
     handle_points = [[handle_y, handle_x]]
     target_points = [[target_y, target_x]]
 
     try:
-        out_paths = run_inference(
-            pipe=PIPE,
+        out_paths = await executor.run(
+            _drag,
             image_path=image_path,
             mask_path=mask_path,
             handle_points=handle_points,
             target_points=target_points,
             num_inference_steps=num_inference_steps,
             guidance_scale_points=guidance_scale_points,
-            output_dir=output_dir
+            # Each request saves into its own subdirectory, so concurrent
+            # drags can't overwrite each other's result_{i}.png.
+            output_dir=os.path.join(output_dir, request_id)
         )
 
+        if format == "multipart":
+            parts = []
+            for path in out_paths:
+                with open(path, "rb") as f:
+                    parts.append((os.path.basename(path), f.read(), "image/png"))
+            return multipart_response(parts)
+
         return {
             "status": "success",
             "saved_images": out_paths
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
+    finally:
+        for path in (image_path, mask_path):
+            if os.path.exists(path):
+                os.remove(path)
+
 
 
 @app.post("/unload_model")
-async def unload_model():
-    global PIPE
-    if PIPE is None:
+async def unload_model(force: bool = False):
+    # Demotes the pipeline to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued jobs first.
+    if force:
+        location = await executor.run(residency.evict, MODEL_KEY)
+    else:
+        location = await off_loop(residency.release, MODEL_KEY)
+    if location is None:
         return {"status": "already_empty"}
-    del PIPE
-    PIPE = None
-    torch.cuda.empty_cache()
-    torch.cuda.synchronize()
-    return {"status": "freed"}
+    return {"status": "freed", "location": location}
 
 
 @app.get("/")
@@ -17,6 +17,13 @@ from MagicQuill import folder_paths
 from MagicQuill.llava_new import LLaVAModel
 from MagicQuill.scribble_color_edit import ScribbleColorEditModel
 from fastapi.middleware.cors import CORSMiddleware
+import comfy.utils
+from comfy.cli_args import args as comfy_args, LatentPreviewMethod
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.executor import ModelExecutor, router as executor_router
+from common.jobs import JobManager
 
 app = FastAPI(title="MagicQuill API")
 
@@ -30,6 +37,11 @@ app.add_middleware(
 
 router = APIRouter()
 
+executor = ModelExecutor("magicquill", max_queue=4)
+jobs = JobManager(executor)
+app.include_router(executor_router)
+app.include_router(jobs.router())
+
 MODEL = None  
 MODEL_LOCK = asyncio.Lock()
 WARMED = True
@@ -165,38 +177,56 @@ def guess_prompt_handler(original_image, add_color_image, add_edge_image):
 
 
         
-def generate(ckpt_name, total_mask, original_image, add_color_image, add_edge_image, remove_edge_image, positive_prompt, negative_prompt, grow_size, stroke_as_edge, fine_edge, edge_strength, color_strength, inpaint_strength, seed, steps, cfg, sampler_name, scheduler):
+def _report_sampling(job):
+    # comfy's ProgressBar picks the global hook up when the KSampler starts, and
+    # the sampler passes ("JPEG", PIL image, max size) as its latent preview.
+    def hook(value, total, preview):
+        job.progress(value, total, stage="sample", preview=preview[1] if preview else None)
+    return hook
+
+
+def generate(ckpt_name, total_mask, original_image, add_color_image, add_edge_image, remove_edge_image, positive_prompt, negative_prompt, grow_size, stroke_as_edge, fine_edge, edge_strength, color_strength, inpaint_strength, seed, steps, cfg, sampler_name, scheduler, job=None):
     scribbleColorEditModel=MODEL['sd1.5']
     add_color_image, original_image, total_mask, add_edge_mask, remove_edge_mask = prepare_images_and_masks(total_mask, original_image, add_color_image, add_edge_image, remove_edge_image)
     progress = None
+    if job:
+        job.progress(0, steps, stage="describe")
     positive_prompt=guess_prompt_handler(original_image, add_color_image, add_edge_image)
     if torch.sum(remove_edge_mask).item() > 0 and torch.sum(add_edge_mask).item() == 0:
         if positive_prompt == "":
             positive_prompt = "empty scene"
         edge_strength /= 3.
     
-    latent_samples, final_image, lineart_output, color_output = scribbleColorEditModel.process(
-        ckpt_name,
-        original_image, 
-        add_color_image, 
-        positive_prompt, 
-        negative_prompt, 
-        total_mask, 
-        add_edge_mask, 
-        remove_edge_mask, 
-        grow_size, 
-        stroke_as_edge, 
-        fine_edge,
-        edge_strength, 
-        color_strength,  
-        inpaint_strength, 
-        seed, 
-        steps, 
-        cfg, 
-        sampler_name, 
-        scheduler,
-        progress
-    )
+    comfy.utils.set_progress_bar_global_hook(_report_sampling(job) if job else None)
+    # comfy defaults to NoPreviews; the cheap latent->RGB projection is only
+    # worth it when a job is listening.
+    comfy_args.preview_method = LatentPreviewMethod.Latent2RGB if job else LatentPreviewMethod.NoPreviews
+    try:
+        latent_samples, final_image, lineart_output, color_output = scribbleColorEditModel.process(
+            ckpt_name,
+            original_image, 
+            add_color_image, 
+            positive_prompt, 
+            negative_prompt, 
+            total_mask, 
+            add_edge_mask, 
+            remove_edge_mask, 
+            grow_size, 
+            stroke_as_edge, 
+            fine_edge,
+            edge_strength, 
+            color_strength,  
+            inpaint_strength, 
+            seed, 
+            steps, 
+            cfg, 
+            sampler_name, 
+            scheduler,
+            progress
+        )
+    finally:
+        comfy.utils.set_progress_bar_global_hook(None)
+        comfy_args.preview_method = LatentPreviewMethod.NoPreviews
 
     final_image_base64 = tensor_to_base64(final_image)
     return final_image_base64
@@ -221,6 +251,45 @@ model_name = os.path.join('SD1.5', 'realisticVisionV60B1_v51VAE.safetensors')
 import base64
 from fastapi.responses import Response
 
+def _edit_kwargs(original_image, total_mask, add_color_image, add_edge_image, remove_edge_image, negative_prompt):
+    return dict(
+        ckpt_name=model_name,
+        total_mask=total_mask,
+        original_image=original_image,
+        add_color_image=add_color_image,
+        add_edge_image=add_edge_image,
+        remove_edge_image=remove_edge_image,
+        positive_prompt=None,
+        negative_prompt=negative_prompt or (
+            "out of frame, lowres, error, cropped, worst quality, low quality, "
+            "jpeg artifacts, ugly, duplicate, morbid, mutilated, out of frame, "
+            "mutation, deformed, blurry, dehydrated, bad anatomy, bad proportions, "
+            "extra limbs, disfigured, gross proportions, malformed limbs, watermark, signature"
+        ),
+        grow_size=15,
+        stroke_as_edge='enable',
+        fine_edge='disable',
+        edge_strength=0.55,
+        color_strength=0.55,
+        inpaint_strength=1,
+        seed=-1,
+        steps=20,
+        cfg=5,
+        sampler_name="euler_ancestral",
+        scheduler='karras'
+    )
+
+
+def _png_bytes(final_base64):
+    if "," in final_base64:
+        final_base64 = final_base64.split(",")[1]
+
+    try:
+        return base64.b64decode(final_base64)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Base64 decode failed: {str(e)}")
+
+
 @app.post('/edit_image')
 async def magic_image(
     original_image: str = Form(...),
@@ -234,47 +303,45 @@ async def magic_image(
     
     
     # --- Generate base64 image ---
+    kwargs = _edit_kwargs(original_image, total_mask, add_color_image, add_edge_image, remove_edge_image, negative_prompt)
     try:
-        final_base64 = generate(
-            ckpt_name=model_name,
-            total_mask=total_mask,
-            original_image=original_image,
-            add_color_image=add_color_image,
-            add_edge_image=add_edge_image,
-            remove_edge_image=remove_edge_image,
-            positive_prompt=None,
-            negative_prompt=negative_prompt or (
-                "out of frame, lowres, error, cropped, worst quality, low quality, "
-                "jpeg artifacts, ugly, duplicate, morbid, mutilated, out of frame, "
-                "mutation, deformed, blurry, dehydrated, bad anatomy, bad proportions, "
-                "extra limbs, disfigured, gross proportions, malformed limbs, watermark, signature"
-            ),
-            grow_size=15,
-            stroke_as_edge='enable',
-            fine_edge='disable',
-            edge_strength=0.55,
-            color_strength=0.55,
-            inpaint_strength=1,
-            seed=-1,
-            steps=20,
-            cfg=5,
-            sampler_name="euler_ancestral",
-            scheduler='karras'
-        )
+        final_base64 = await executor.run(generate, **kwargs)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image generation failed: {str(e)}")
 
-    if "," in final_base64:
-        final_base64 = final_base64.split(",")[1]
-
-    try:
-        image_bytes = base64.b64decode(final_base64)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Base64 decode failed: {str(e)}")
+    image_bytes = _png_bytes(final_base64)
 
     return Response(content=image_bytes, media_type="image/png")
 
 
+def _edit_job(job, kwargs):
+    return Response(content=_png_bytes(generate(**kwargs, job=job)), media_type="image/png")
+
+
+@app.post('/jobs/edit_image')
+async def submit_magic_image(
+    original_image: str = Form(...),
+    total_mask: str = Form(...),
+    add_color_image: Optional[str] = Form(None),
+    add_edge_image: str = Form(...),
+    remove_edge_image: str = Form(...),
+    positive_prompt: Optional[str] = Form(None),
+    negative_prompt: Optional[str] = Form(None),
+    supersede: Optional[str] = Form(None)
+):
+    """Same edit as /edit_image, but returns a job id right away.
+
+    Progress and latent previews stream from /jobs/{job_id}/events, the PNG is
+    served from /jobs/{job_id}/result. A new job with the same `supersede` key
+    (e.g. one per canvas) cancels the previous one.
+    """
+    kwargs = _edit_kwargs(original_image, total_mask, add_color_image, add_edge_image, remove_edge_image, negative_prompt)
+    job = jobs.submit("edit_image", _edit_job, kwargs, supersede_key=supersede)
+    return job.info()
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     return JSONResponse(
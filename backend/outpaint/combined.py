@@ -1,23 +1,22 @@
-import io
-import cv2
 import base64
-import numpy as np
 import torch
+from typing import Optional
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from PIL import Image
 
 # ========== INPAINT IMPORTS ==========
-from iopaint.download import cli_download_model
-from iopaint.model_manager import ModelManager
-from iopaint.helper import decode_base64_to_image, pil_to_bytes, concat_alpha_channel
-from iopaint.model.utils import torch_gc
+from .utils import InpaintRequest, PowerPaintTask
+from common.inpaint_roi import inpaint_upload
 
 # ========== OUTPAINT IMPORTS ==========
 from .model import load_model as outpaint_load_model
 from .model import unload_model as outpaint_unload_model
-from .model import run_outpaint
+from .model import calibrate, run_outpaint, executor
+from common.residency import off_loop, residency
+from common.executor import router as executor_router
+from common.sd15_pool import IOPAINT_KEY
+from common import sd_presets
 
 # ============================================================
 # APP INIT
@@ -30,11 +29,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(executor_router)
+app.include_router(sd_presets.router)
 
 device = torch.device("cuda")
 
-# Model holders
-INPAINT_MODEL = None
+# Inpaint and outpaint share one SD1.5 ModelManager (see common/sd15_pool.py),
+# these flags only track which tools the client asked for.
+INPAINT_READY = False
 OUTPAINT_READY = False
 
 
@@ -43,37 +45,27 @@ OUTPAINT_READY = False
 # ============================================================
 @app.post("/load_inpaint")
 async def load_inpaint():
-    global INPAINT_MODEL
-    if INPAINT_MODEL is not None:
+    global INPAINT_READY
+    if INPAINT_READY:
         return {"status": "inpaint_already_loaded"}
 
-    cli_download_model("runwayml/stable-diffusion-v1-5")
-
-    INPAINT_MODEL = ModelManager(
-        name="runwayml/stable-diffusion-v1-5",
-        device=device,
-        enable_powerpoint_v2=True,
-        disable_nsfw=True,
-        sd_cpu_textencoder=False,
-        cpu_offload=False,
-        local_files_only=False,
-        enable_brushnet=False
-    )
+    # Loads the shared manager and times the presets for budget_ms requests.
+    await executor.run(calibrate)
+    INPAINT_READY = True
 
     return {"status": "inpaint_loaded"}
 
 
 @app.post("/unload_inpaint")
 async def unload_inpaint():
-    global INPAINT_MODEL
-    if INPAINT_MODEL is None:
+    global INPAINT_READY
+    if not INPAINT_READY:
         return {"status": "inpaint_already_unloaded"}
 
-    del INPAINT_MODEL
-    INPAINT_MODEL = None
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
-    torch_gc()
+    INPAINT_READY = False
+    # The shared manager stays on the GPU while outpaint still uses it.
+    if not OUTPAINT_READY:
+        await off_loop(residency.release, IOPAINT_KEY)
 
     return {"status": "inpaint_unloaded"}
 
@@ -87,7 +79,7 @@ async def load_outpaint():
     if OUTPAINT_READY:
         return {"status": "outpaint_already_loaded"}
 
-    status = outpaint_load_model()
+    status = await executor.run(outpaint_load_model)
     OUTPAINT_READY = True
     return {"status": status}
 
@@ -98,55 +90,47 @@ async def unload_outpaint():
     if not OUTPAINT_READY:
         return {"status": "outpaint_already_unloaded"}
 
-    status = outpaint_unload_model()
     OUTPAINT_READY = False
+    status = "outpaint_unloaded" if INPAINT_READY else await off_loop(outpaint_unload_model)
     return {"status": status}
 
 
 # ============================================================
 # 3) INPAINT INFERENCE
 # ============================================================
+def _inpaint_request(**fields):
+    # Same request as the inpaint service (the ROI engine does the cropping);
+    # PowerPaint v2 stays on so the shared manager doesn't switch pipelines.
+    return InpaintRequest(
+        enable_powerpaint_v2=True,
+        hd_strategy="Original",
+        powerpaint_task=PowerPaintTask.object_remove,
+        **fields
+    )
+
+
 @app.post("/inpaint")
 async def inpaint(
     image: UploadFile = File(...),
     mask: UploadFile = File(...),
     prompt: str = Form(""),
-    negative: str = Form("")
+    negative: str = Form(""),
+    preset: Optional[str] = Form(None),
+    budget_ms: Optional[float] = Form(None),
+    steps: Optional[int] = Form(None)
 ):
-    global INPAINT_MODEL
-
-    if INPAINT_MODEL is None:
+    if not INPAINT_READY:
         return {"error": "Inpaint model not loaded. Call /load_inpaint"}
 
-    img_b64 = base64.b64encode(await image.read()).decode()
-    mask_b64 = base64.b64encode(await mask.read()).decode()
-
-    # decode + preprocess
-    image_np, alpha, infos, ext = decode_base64_to_image(img_b64)
-    mask_np, _, _, _ = decode_base64_to_image(mask_b64, gray=True)
+    if preset and preset not in sd_presets.PRESETS:
+        return {"error": f"preset must be one of {', '.join(sd_presets.PRESET_ORDER)}"}
 
-    mask_np = cv2.threshold(mask_np, 127, 255, cv2.THRESH_BINARY)[1]
-    mask_np = cv2.dilate(mask_np, np.ones((15, 15), np.uint8), iterations=1)
-
-    # inference
-    class Req(BaseModel):
-        image: str
-        mask: str
-        prompt: str
-        negative_prompt: str
-
-    req = Req(image=img_b64, mask=mask_b64, prompt=prompt, negative_prompt=negative)
-
-    out_np = INPAINT_MODEL(image_np, mask_np, req)
-    torch_gc()
-
-    out_rgb = cv2.cvtColor(out_np.astype(np.uint8), cv2.COLOR_BGR2RGB)
-    out_rgba = concat_alpha_channel(out_rgb, alpha)
-
-    out_bytes = pil_to_bytes(Image.fromarray(out_rgba), ext=ext, quality=100, infos=infos)
-    out_b64 = base64.b64encode(out_bytes).decode()
+    out_bytes, _, used = await executor.run(
+        inpaint_upload, await image.read(), await mask.read(), _inpaint_request,
+        prompt, negative, preset, budget_ms, steps
+    )
 
-    return {"image_base64": out_b64}
+    return {"image_base64": base64.b64encode(out_bytes).decode(), "preset": used}
 
 
 # ============================================================
@@ -157,6 +141,9 @@ class OutpaintReq(BaseModel):
     scale: float = 1.2
     positive_prompt: str = ""
     negative_prompt: str = ""
+    preset: Optional[str] = None
+    budget_ms: Optional[float] = None
+    steps: Optional[int] = None
 
 
 @app.post("/outpaint")
@@ -166,14 +153,21 @@ async def outpaint(req: OutpaintReq):
     if not OUTPAINT_READY:
         return {"error": "Outpaint model not loaded. Call /load_outpaint"}
 
-    out_bytes = run_outpaint(
+    if req.preset and req.preset not in sd_presets.PRESETS:
+        return {"error": f"preset must be one of {', '.join(sd_presets.PRESET_ORDER)}"}
+
+    out_bytes, used = await executor.run(
+        run_outpaint,
         image_b64=req.image_base64,
         scale=req.scale,
         prompt=req.positive_prompt,
-        negative_prompt=req.negative_prompt
+        negative_prompt=req.negative_prompt,
+        preset=req.preset,
+        budget_ms=req.budget_ms,
+        steps=req.steps
     )
 
-    return {"image_base64": base64.b64encode(out_bytes).decode()}
+    return {"image_base64": base64.b64encode(out_bytes).decode(), "preset": used}
 
 
 # ============================================================
@@ -1,10 +1,14 @@
 
 import base64
-from fastapi import FastAPI
+from typing import Optional
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from .model import load_model, unload_model, run_outpaint
+from .model import load_model, unload_model, run_outpaint, executor
+from common.residency import off_loop, router as residency_router
+from common.executor import router as executor_router
+from common import sd_presets
 
 
 app = FastAPI(title="IOPaint Outpaint API")
@@ -17,6 +21,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(residency_router)
+app.include_router(executor_router)
+app.include_router(sd_presets.router)
 
 
 class LoadResponse(BaseModel):
@@ -28,42 +35,56 @@ class OutpaintRequest(BaseModel):
     scale: float = 1.2
     positive_prompt: str = ""
     negative_prompt: str = ""
+    # fast|balanced|quality, or budget_ms to pick the best preset that fits.
+    preset: Optional[str] = None
+    budget_ms: Optional[float] = None
+    steps: Optional[int] = None
 
 
 @app.post("/load_model", response_model=LoadResponse)
-def load():
-    status = load_model()
+async def load():
+    status = await executor.run(load_model)
     return LoadResponse(status=status)
 
 
 
 @app.post("/infer")
-def infer(req: OutpaintRequest):
+async def infer(req: OutpaintRequest):
 
     if req.scale <= 1.0:
         return {"error": "Scale must be > 1.0 for outpainting"}
+    if req.preset and req.preset not in sd_presets.PRESETS:
+        return {"error": f"preset must be one of {', '.join(sd_presets.PRESET_ORDER)}"}
 
     try:
         
-        out_bytes = run_outpaint(
+        out_bytes, used = await executor.run(
+            run_outpaint,
             image_b64=req.image_base64,
             scale=req.scale,
             prompt=req.positive_prompt,
-            negative_prompt=req.negative_prompt
+            negative_prompt=req.negative_prompt,
+            preset=req.preset,
+            budget_ms=req.budget_ms,
+            steps=req.steps
         )
 
         
         out_b64 = base64.b64encode(out_bytes).decode("utf-8")
 
         return {
-            "image_base64": out_b64
+            "image_base64": out_b64,
+            "preset": used
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
 
 @app.post("/unload_model")
-def unload():
-    status = unload_model()
+async def unload(force: bool = False):
+    # A forced unload waits behind queued jobs instead of pulling the model mid-run.
+    status = await executor.run(unload_model, True) if force else await off_loop(unload_model)
     return {"status": status}
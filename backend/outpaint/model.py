@@ -1,95 +1,212 @@
 # model_handler.py
 
+import os
+import sys
+import time
+from itertools import zip_longest
 import torch
-from iopaint.model_manager import ModelManager
 from iopaint.helper import decode_base64_to_image, pil_to_bytes
-from iopaint.model.utils import torch_gc
 from PIL import Image
 import numpy as np
 import cv2
-import base64
 from .utils import InpaintRequest, PowerPaintTask
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import residency
+from common.sd15_pool import IOPAINT_KEY, iopaint_manager
+from common.executor import ModelExecutor
+from common import sd_presets
 
-model = None
-device = None
+
+# Shared with the inpaint service, see common/sd15_pool.py.
+MODEL_KEY = IOPAINT_KEY
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# One worker for the shared manager, used by both the outpaint and the combined app.
+executor = ModelExecutor("iopaint", max_queue=4)
 
 
 def load_model():
-    global model, device
-    if model is not None:
+    # Advisory: run_outpaint loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None and sd_presets.calibration:
         return "Model already loaded"
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    model = ModelManager(
-        name='runwayml/stable-diffusion-v1-5',
-        device=device,
-        enable_powerpoint_v2=True,
-        disable_nsfw=True,
-        sd_cpu_textencoder=False,
-        local_files_only=False,
-        cpu_offload=False,
-    )
-
+    # Also times each preset on this GPU, for budget_ms requests.
+    calibrate()
     return "Model loaded successfully"
 
 
-def unload_model():
-    global model, device
+def unload_model(force=False):
+    # Demotes the model to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=True` waits for the running
+    # job, then demotes; call it on the executor so queued jobs go first.
+    location = residency.evict(MODEL_KEY) if force else residency.release(MODEL_KEY)
 
-    if model is None:
+    if location is None:
         return "Model already unloaded"
 
-    del model
-    model = None
-
-    torch_gc()
-    return "Model unloaded and VRAM cleared"
-
-
-def run_outpaint(image_b64, scale, prompt, negative_prompt):
-
-    
-    img_bytes = base64.b64decode(image_b64)
-    nparr = np.frombuffer(img_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    H, W = img.shape[:2]
+    return "Model moved off the GPU"
+
+
+def _make_request(**fields):
+    # PowerPaint v2 stays on, otherwise the manager would switch pipelines.
+    return InpaintRequest(enable_powerpaint_v2=True, **fields)
+
+
+def calibrate():
+    with iopaint_manager() as model:
+        return sd_presets.calibrate(model, _make_request)
+
+
+# -------------------------------------------------------
+# Progressive outpainting
+# -------------------------------------------------------
+# Scales up to this run as one pass over the whole canvas; larger ones grow the
+# canvas stage by stage in strips, each pass at most the preset's max_side.
+SINGLE_PASS_SCALE = 1.5
+STEP_RATIO = 0.5        # new pixels per side per stage, relative to max_side
+CONTEXT_RATIO = 0.5     # already generated pixels each strip window sees
+WINDOW_OVERLAP = 0.25   # overlap between consecutive windows along a strip
+
+
+def _spans(lo, hi, size, overlap):
+    """Windows of at most `size` covering [lo, hi), consecutive ones overlapping by `overlap`."""
+    if hi - lo <= size:
+        return [(lo, hi)]
+    spans = []
+    start = lo
+    while start + size < hi:
+        spans.append((start, start + size))
+        start += size - overlap
+    spans.append((hi - size, hi))
+    return spans
+
+
+def plan_passes(canvas_w, canvas_h, box, max_side):
+    """
+    Splits growing the known rectangle `box` (x0, y0, x1, y1) to the full
+    canvas into passes. Each stage grows every side by at most STEP_RATIO *
+    max_side: the left/right strips first, then top/bottom across the new
+    width (corners included). Returns a list of groups of (x0, y0, x1, y1)
+    windows; windows in one group don't depend on each other, groups run in order.
+    """
+    step = max(8, int(max_side * STEP_RATIO))
+    context = max(8, int(max_side * CONTEXT_RATIO))
+    overlap = int(max_side * WINDOW_OVERLAP)
+    groups = []
+    x0, y0, x1, y1 = box
+
+    while (x0, y0, x1, y1) != (0, 0, canvas_w, canvas_h):
+        nx0, ny0 = max(0, x0 - step), max(0, y0 - step)
+        nx1, ny1 = min(canvas_w, x1 + step), min(canvas_h, y1 + step)
+
+        if nx1 - nx0 <= max_side and ny1 - ny0 <= max_side:
+            groups.append([(nx0, ny0, nx1, ny1)])
+        else:
+            rows = _spans(y0, y1, max_side, overlap)
+            left = [(nx0, a, min(x1, x0 + context), b) for a, b in rows] if nx0 < x0 else []
+            right = [(max(x0, x1 - context), a, nx1, b) for a, b in rows] if nx1 > x1 else []
+            # Window i of the left strip and window i of the right strip share a group.
+            groups.extend([w for w in pair if w] for pair in zip_longest(left, right))
+
+            cols = _spans(nx0, nx1, max_side, overlap)
+            top = [(a, ny0, b, min(y1, y0 + context)) for a, b in cols] if ny0 < y0 else []
+            bottom = [(a, max(y0, y1 - context), b, ny1) for a, b in cols] if ny1 > y1 else []
+            groups.extend([w for w in pair if w] for pair in zip_longest(top, bottom))
+
+        x0, y0, x1, y1 = nx0, ny0, nx1, ny1
+    return groups
+
+
+def _layout(name, W, H, scale):
+    """Work-space scale, canvas size and source box for a preset; the model never sees more than max_side per pass."""
+    max_side = sd_presets.preset(name)["max_side"]
+    factor = min(1.0, max_side / (max(W, H) * min(scale, SINGLE_PASS_SCALE)))
+    w, h = max(1, round(W * factor)), max(1, round(H * factor))
+    canvas_w, canvas_h = max(w, round(int(W * scale) * factor)), max(h, round(int(H * scale) * factor))
+    x, y = (canvas_w - w) // 2, (canvas_h - h) // 2
+    return factor, (canvas_w, canvas_h), (x, y, x + w, y + h)
+
+
+def _estimate_ms(name, W, H, scale):
+    """Sum of the calibrated estimates over all passes of a preset's plan."""
+    _, (canvas_w, canvas_h), box = _layout(name, W, H, scale)
+    total = 0.0
+    for group in plan_passes(canvas_w, canvas_h, box, sd_presets.preset(name)["max_side"]):
+        for x0, y0, x1, y1 in group:
+            ms = sd_presets.estimate_ms(name, x1 - x0, y1 - y0)
+            if ms is None:
+                return None
+            total += ms
+    return total
+
+
+def _run_group(model, canvas, known, windows, req, name, record):
+    """
+    Generates the unknown pixels of independent windows. All crops are taken
+    before any result is written back, so the group reads one canvas state.
+    iopaint's manager takes one image per call, so the windows run back to back.
+    """
+    crops = [(box, canvas[box[1]:box[3], box[0]:box[2]].copy(), ~known[box[1]:box[3], box[0]:box[2]]) for box in windows]
+    for (x0, y0, x1, y1), crop, unknown in crops:
+        if not unknown.any():
+            continue
+        start = time.monotonic()
+        out = model(crop, unknown.astype(np.uint8) * 255, req)
+        if record:
+            sd_presets.record(name, x1 - x0, y1 - y0, time.monotonic() - start)
+        out = cv2.cvtColor(out.astype(np.uint8), cv2.COLOR_BGR2RGB)
+        region = canvas[y0:y1, x0:x1]
+        region[unknown] = out[unknown]
+        known[y0:y1, x0:x1] = True
+
+
+def run_outpaint(image_b64, scale, prompt, negative_prompt, preset=None, budget_ms=None, steps=None):
+
+    # iopaint models take the decoded RGB array, the request carries no image copy.
+    image, _, _, _ = decode_base64_to_image(image_b64)
+    H, W = image.shape[:2]
 
     extender_w = int(W * scale)
     extender_h = int(H * scale)
     extender_x = (extender_w - W) // 2
     extender_y = (extender_h - H) // 2
 
-    
-    mask = np.zeros((H, W), dtype=np.uint8)
-    _, mask_buffer = cv2.imencode(".png", mask)
-    mask_b64 = base64.b64encode(mask_buffer).decode()
+    name = sd_presets.choose(
+        preset, budget_ms, (extender_w, extender_h),
+        estimate=lambda n, *_: _estimate_ms(n, W, H, scale)
+    )
 
-    
-    req = InpaintRequest(
-        image=image_b64,
-        mask=mask_b64,
+    # Work at model resolution: the source fits max_side (the whole canvas does
+    # up to SINGLE_PASS_SCALE), the result is resized back at the end.
+    factor, (canvas_w, canvas_h), box = _layout(name, W, H, scale)
+    x0, y0, x1, y1 = box
+    canvas = np.zeros((canvas_h, canvas_w, 3), np.uint8)
+    known = np.zeros((canvas_h, canvas_w), bool)
+    canvas[y0:y1, x0:x1] = image if factor == 1.0 else cv2.resize(image, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA)
+    known[y0:y1, x0:x1] = True
+
+    fields = sd_presets.settings(name)
+    if steps:
+        fields["sd_steps"] = steps
+    req = _make_request(
         prompt=prompt,
         negative_prompt=negative_prompt,
-        use_extender=True,
-        extender_x=-extender_x,
-        extender_y=-extender_y,
-        extender_width=extender_w,
-        extender_height=extender_h,
-        enable_powerpaint_v2=True,
-        powerpaint_task=PowerPaintTask.outpainting
+        hd_strategy="Original",
+        powerpaint_task=PowerPaintTask.outpainting,
+        **fields
     )
 
-    
-    mask_bin = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
+    groups = plan_passes(canvas_w, canvas_h, box, sd_presets.preset(name)["max_side"])
+    with iopaint_manager() as model:
+        for group in groups:
+            _run_group(model, canvas, known, group, req, name, record=not steps)
 
-    
-    np_out = model(image_b64, mask_bin, req)
+    if canvas.shape[:2] != (extender_h, extender_w):
+        canvas = cv2.resize(canvas, (extender_w, extender_h), interpolation=cv2.INTER_CUBIC)
+        # The source keeps its full resolution.
+        canvas[extender_y:extender_y + H, extender_x:extender_x + W] = image
 
-    
-    np_out = cv2.cvtColor(np_out.astype(np.uint8), cv2.COLOR_BGR2RGB)
-    img = Image.fromarray(np_out)
+    img = Image.fromarray(canvas)
     out_bytes = pil_to_bytes(img, ext=".png")
 
-    return out_bytes
+    return out_bytes, name
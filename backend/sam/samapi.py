@@ -1,16 +1,365 @@
 import io
+import os
+import sys
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import cv2
 from PIL import Image
 from fastapi import FastAPI, UploadFile, File, Form
-from typing import List
+from typing import List, Optional
+import threading
 import torch
-from segment_anything import sam_model_registry, SamPredictor
+from segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.batching import MicroBatcher
+from common.executor import ModelExecutor, router as queue_router
+from common.masks import mask_to_rle, refine_soft_mask
 
 app = FastAPI(title="SAM Segmentation API")
+app.include_router(residency_router)
+app.include_router(queue_router)
+
+MODEL_KEY = "sam_vit_b"
+checkpoint_path = "SAM.pth"
+
+
+def _load_predictor():
+    sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
+    sam.to(device="cuda")
+    return SamPredictor(sam)
 
-sam = None
-predictor = None
+
+# SAM is on every selection click, keep it ahead of the heavy diffusion models.
+residency.register(MODEL_KEY, _load_predictor, priority=2)
+
+
+# -------------------------------------------------------
+# Image encoder batching: the ViT encoder is the expensive part of a
+# click, so concurrent /segment calls share one encoder forward pass.
+# -------------------------------------------------------
+def encode_images(images):
+    """Runs the SAM image encoder once for a list of HxWx3 uint8 arrays."""
+    with residency.lease(MODEL_KEY) as predictor:
+        sam = predictor.model
+
+        # Each image is resized to long side 1024 and padded to 1024x1024, so
+        # images of any size can share a batch.
+        batch = []
+        input_sizes = []
+        for img in images:
+            transformed = predictor.transform.apply_image(img)
+            t = torch.as_tensor(transformed, device=predictor.device)
+            batch.append(sam.preprocess(t.permute(2, 0, 1).contiguous()[None, :, :, :]))
+            input_sizes.append(tuple(transformed.shape[:2]))
+
+        with torch.no_grad():
+            features = sam.image_encoder(torch.cat(batch, dim=0))
+
+        return [
+            (features[i:i + 1], img.shape[:2], input_sizes[i])
+            for i, img in enumerate(images)
+        ]
+
+
+encoder_batcher = MicroBatcher(
+    encode_images, max_batch_size=4, max_wait_ms=10, name="sam-encoder",
+)
+
+# The predictor keeps the current image embedding on itself, so setting it
+# and decoding the mask must happen together.
+predictor_lock = threading.Lock()
+
+# Prompt decoding runs off the event loop; "everything" mode can take a while.
+decoder = ModelExecutor("sam_decoder", max_queue=8)
+
+
+# -------------------------------------------------------
+# Embedding cache: interactive segmentation sends the same image again with
+# every click, so encoder output is kept per image hash and a click on a known
+# image only runs the prompt encoder and mask decoder.
+# -------------------------------------------------------
+EMBED_GPU_ENTRIES = 16    # ~4 MB each (256x64x64 fp32)
+EMBED_CPU_ENTRIES = 128   # older embeddings wait in pinned host RAM
+
+
+class EmbeddingCache:
+    def __init__(self, gpu_entries=EMBED_GPU_ENTRIES, cpu_entries=EMBED_CPU_ENTRIES):
+        self.gpu_entries = gpu_entries
+        self.cpu_entries = cpu_entries
+        self._entries = OrderedDict()  # image_id -> (features, original_size, input_size)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, image_id):
+        return image_id in self._entries
+
+    def get(self, image_id):
+        entry = self._entries.get(image_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(image_id)
+        features, original_size, input_size = entry
+        if features.device.type == "cpu" and torch.cuda.is_available():
+            features = features.to("cuda", non_blocking=True)
+            entry = (features, original_size, input_size)
+            self._entries[image_id] = entry
+            self._demote_old()
+        return entry
+
+    def put(self, image_id, entry):
+        self._entries[image_id] = entry
+        self._entries.move_to_end(image_id)
+        self._demote_old()
+        while len(self._entries) > self.cpu_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_encode(self, image_id, load_image):
+        """
+        Returns the cached embedding, or encodes `load_image()` once even if several
+        clicks race for the same image. The image is only decoded on a miss.
+        """
+        entry = self.get(image_id)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        task = self._inflight.get(image_id)
+        if task is None:
+            task = self._inflight[image_id] = asyncio.ensure_future(encoder_batcher.submit(load_image()))
+            task.add_done_callback(lambda _: self._inflight.pop(image_id, None))
+        entry = await task
+        if image_id not in self._entries:
+            self.put(image_id, entry)
+        return entry
+
+    def stats(self):
+        on_gpu = sum(1 for f, _, _ in self._entries.values() if f.device.type != "cpu")
+        return {
+            "entries": len(self._entries),
+            "on_gpu": on_gpu,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _demote_old(self):
+        if not torch.cuda.is_available():
+            return
+        # Everything but the most recent `gpu_entries` moves to pinned host RAM.
+        keep = len(self._entries) - self.gpu_entries
+        for image_id, (features, original_size, input_size) in list(self._entries.items())[:max(0, keep)]:
+            if features.device.type != "cpu":
+                features = features.to("cpu").pin_memory()
+                self._entries[image_id] = (features, original_size, input_size)
+
+
+embedding_cache = EmbeddingCache()
+
+# Grayscale copies of recent images, the guide for refine=true.
+GUIDE_ENTRIES = 8
+guides = OrderedDict()
+
+
+def image_id_for(img_bytes):
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def _prepare_image(img_bytes, image_id=None):
+    # Full resolution: SamPredictor's transform does the long-side-1024 resize,
+    # and masks come back at this size.
+    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+    img_np = np.array(img)
+
+    if image_id is not None:
+        guides[image_id] = cv2.cvtColor(img_np, cv2.COLOR_RGB2GRAY)
+        guides.move_to_end(image_id)
+        while len(guides) > GUIDE_ENTRIES:
+            guides.popitem(last=False)
+    return img_np
+
+
+async def _lookup_embedding(file, image_id, want_guide=False):
+    """Returns (image_id, embedding) for an upload or a known image_id, or (None, error dict)."""
+    if file is not None:
+        img_bytes = await file.read()
+        image_id = image_id_for(img_bytes)
+        entry = await embedding_cache.get_or_encode(image_id, lambda: _prepare_image(img_bytes, image_id))
+        if want_guide and image_id not in guides:
+            _prepare_image(img_bytes, image_id)
+        return image_id, entry
+    if image_id is not None:
+        entry = embedding_cache.get(image_id)
+        if entry is None:
+            return None, {"error": "Unknown image_id, send the file again."}
+        return image_id, entry
+    return None, {"error": "Send either file or image_id."}
+
+
+def _set_embedding(predictor, entry):
+    features, original_size, input_size = entry
+    predictor.reset_image()
+    predictor.features = features
+    predictor.original_size = original_size
+    predictor.input_size = input_size
+    predictor.is_image_set = True
+
+
+def _mask_contours(mask_255):
+    contours, _ = cv2.findContours(
+        mask_255, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    return [c.reshape(-1, 2).tolist() for c in contours]
+
+
+# -------------------------------------------------------
+# Prompt decoding
+# -------------------------------------------------------
+def decode_prompt_groups(entry, groups, guide=None, multimask_output=True):
+    """
+    Decodes many prompt groups on one image. Groups with the same prompt kinds
+    (points, box or both) go through the mask decoder as a single batch; point
+    lists are padded to equal length with label -1, which SAM treats as "no point".
+
+    Only the best low-res (256x256) logits of each group are upsampled, straight
+    to the original image size, and with a grayscale `guide` the soft mask is
+    snapped to image edges with a guided filter before thresholding.
+    Returns (HxW bool mask, score) per group, in order.
+    """
+    by_kind = {}
+    for i, group in enumerate(groups):
+        by_kind.setdefault((bool(group["points"]), group["box"] is not None), []).append(i)
+
+    results = [None] * len(groups)
+    with predictor_lock, residency.lease(MODEL_KEY) as predictor:
+        _set_embedding(predictor, entry)
+        sam = predictor.model
+        original_size = predictor.original_size
+        input_size = predictor.input_size
+        device = predictor.device
+        # One low-res logit spans this many original pixels.
+        radius = max(2, max(original_size) // 256)
+
+        for (has_points, has_box), idx in by_kind.items():
+            points = boxes = None
+            if has_points:
+                n = max(len(groups[i]["points"]) for i in idx)
+                coords = np.zeros((len(idx), n, 2), dtype=np.float32)
+                point_labels = np.full((len(idx), n), -1, dtype=np.int64)
+                for row, i in enumerate(idx):
+                    pts = groups[i]["points"]
+                    coords[row, :len(pts)] = pts
+                    point_labels[row, :len(pts)] = groups[i]["labels"]
+                coords = predictor.transform.apply_coords_torch(
+                    torch.as_tensor(coords, device=device), original_size
+                )
+                points = (coords, torch.as_tensor(point_labels, device=device))
+            if has_box:
+                boxes = torch.as_tensor(
+                    [groups[i]["box"] for i in idx], dtype=torch.float32, device=device
+                )
+                boxes = predictor.transform.apply_boxes_torch(boxes, original_size)
+
+            with torch.no_grad():
+                sparse, dense = sam.prompt_encoder(points=points, boxes=boxes, masks=None)
+                low_res, scores = sam.mask_decoder(
+                    image_embeddings=predictor.features,
+                    image_pe=sam.prompt_encoder.get_dense_pe(),
+                    sparse_prompt_embeddings=sparse,
+                    dense_prompt_embeddings=dense,
+                    multimask_output=multimask_output,
+                )
+
+                rows = torch.arange(len(idx), device=device)
+                best = scores.argmax(dim=1)
+                best_low_res = low_res[rows, best]
+                best_scores = scores[rows, best].tolist()
+
+                # One group at a time: full-resolution logits are large.
+                for row, i in enumerate(idx):
+                    logits = sam.postprocess_masks(
+                        best_low_res[row][None, None], input_size, original_size
+                    )[0, 0]
+                    if guide is None:
+                        mask = (logits > sam.mask_threshold).cpu().numpy()
+                    else:
+                        soft = torch.sigmoid(logits).cpu().numpy()
+                        mask = refine_soft_mask(guide, soft, radius=radius) > 0.5
+                    results[i] = (mask, best_scores[row])
+
+    return results
+
+
+class _CachedImagePredictor:
+    """
+    Stands in for SamPredictor inside SamAutomaticMaskGenerator: set_image()
+    installs the cached embedding instead of running the encoder again.
+    """
+
+    def __init__(self, predictor, entry):
+        self._predictor = predictor
+        self._entry = entry
+
+    def set_image(self, image, image_format="RGB"):
+        _set_embedding(self._predictor, self._entry)
+
+    def __getattr__(self, name):
+        return getattr(self._predictor, name)
+
+
+def segment_everything(entry, points_per_side, points_per_batch, pred_iou_thresh,
+                       stability_score_thresh, box_nms_thresh):
+    """
+    SAM's automatic mask generator over a points_per_side^2 grid. The grid is
+    decoded `points_per_batch` prompts at a time and duplicates are removed with
+    torchvision's batched NMS while boxes and scores are still on the GPU.
+    Runs on a single crop, so the image itself is never needed.
+    """
+    _, original_size, _ = entry
+    with predictor_lock, residency.lease(MODEL_KEY) as predictor:
+        generator = SamAutomaticMaskGenerator(
+            predictor.model,
+            points_per_side=points_per_side,
+            points_per_batch=points_per_batch,
+            pred_iou_thresh=pred_iou_thresh,
+            stability_score_thresh=stability_score_thresh,
+            box_nms_thresh=box_nms_thresh,
+            crop_n_layers=0,
+            output_mode="uncompressed_rle",
+        )
+        generator.predictor = _CachedImagePredictor(predictor, entry)
+        with torch.no_grad():
+            return generator.generate(np.zeros((*original_size, 3), dtype=np.uint8))
+
+
+def _parse_prompt_groups(prompts):
+    try:
+        groups = json.loads(prompts)
+    except ValueError:
+        return None, "prompts must be a JSON list."
+    if not isinstance(groups, list) or not groups:
+        return None, "prompts must be a non-empty JSON list."
+
+    parsed = []
+    for group in groups:
+        if not isinstance(group, dict):
+            return None, "Each prompt group must be an object."
+        points = group.get("points") or []
+        labels = group.get("labels", [1] * len(points))
+        box = group.get("box")
+        if not points and box is None:
+            return None, "Each prompt group needs points or a box."
+        if len(labels) != len(points):
+            return None, "points and labels must have same length."
+        if box is not None and len(box) != 4:
+            return None, "box must be [x0, y0, x1, y1]."
+        parsed.append({"points": points, "labels": labels, "box": box})
+    return parsed, None
 
 
 # -------------------------------------------------------
@@ -18,103 +367,178 @@ predictor = None
 # -------------------------------------------------------
 @app.post("/load_sam")
 async def load_sam():
-    global sam, predictor
-
-    if sam is not None:
+    # Advisory: /segment loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
         return {"status": "already_loaded"}
 
-    checkpoint_path = "SAM.pth"
+    await decoder.run(residency.acquire, MODEL_KEY)
 
-    sam = sam_model_registry["vit_b"](checkpoint=checkpoint_path)
-    sam.to(device="cuda")
+    return {"status": "loaded", "checkpoint": checkpoint_path}
 
-    predictor = SamPredictor(sam)
 
-    return {"status": "loaded", "checkpoint": checkpoint_path}
+# -------------------------------------------------------
+# 2) PRE-COMPUTE THE IMAGE EMBEDDING ON UPLOAD
+# -------------------------------------------------------
+@app.post("/embed")
+async def embed_image(file: UploadFile = File(...)):
+    # Call once when the image is opened; later /segment calls can send just
+    # the returned image_id with their clicks.
+    img_bytes = await file.read()
+    image_id = image_id_for(img_bytes)
+
+    cached = image_id in embedding_cache
+    await embedding_cache.get_or_encode(image_id, lambda: _prepare_image(img_bytes, image_id))
+
+    return {"status": "success", "image_id": image_id, "cached": cached}
 
 
 # -------------------------------------------------------
-# 2) RUN SEGMENTATION AND RETURN COORDINATES + SAVE IMAGE
+# 3) RUN SEGMENTATION AND RETURN COORDINATES + SAVE IMAGE
 # -------------------------------------------------------
 @app.post("/segment")
 async def segment_object(
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
     xs: List[int] = Form(...),
     ys: List[int] = Form(...),
     labels: List[int] = Form(...),
-    save_path: str = Form("sam_output.png")
+    save_path: Optional[str] = Form(None),
+    image_id: Optional[str] = Form(None),
+    refine: bool = Form(False)
 ):
-    global sam, predictor
-    if sam is None:
-        return {"error": "SAM NOT LOADED — call /load_sam first."}
-
     if not (len(xs) == len(ys) == len(labels)):
         return {"error": "xs, ys, labels must have same length."}
 
-    # Load input
-    img_bytes = await file.read()
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    img_np = np.array(img)
+    # Load input: either the image itself or the id from /embed
+    image_id, entry = await _lookup_embedding(file, image_id, want_guide=refine)
+    if image_id is None:
+        return entry
 
-    # SAM requires 512x512 input
-    resized = cv2.resize(img_np, (512, 512))
-    predictor.set_image(resized)
+    group = {"points": list(zip(xs, ys)), "labels": labels, "box": None}
+    guide = guides.get(image_id) if refine else None
 
-    # Prepare points
-    points = np.array(list(zip(xs, ys)), dtype=np.int32)
-    lbls = np.array(labels, dtype=np.int32)
+    # Predict mask (at the original image size)
+    [(mask, score)] = await decoder.run(decode_prompt_groups, entry, [group], guide)
+    mask_255 = mask.astype(np.uint8) * 255
 
-    # Predict mask
-    masks, scores, _ = predictor.predict(
-        point_coords=points,
-        point_labels=lbls,
-        multimask_output=True
-    )
+    result = {
+        "status": "success",
+        "image_id": image_id,
+        "mask_rle": mask_to_rle(mask),
+        "mask_coords": _mask_contours(mask_255),
+        "confidence": float(score),
+        "refined": guide is not None,
+    }
 
-    best = int(np.argmax(scores))
-    mask_255 = (masks[best] * 255).astype(np.uint8)
+    # Old clients asked for a PNG on the server's disk; only written on request now.
+    if save_path:
+        Image.fromarray(mask_255).save(save_path)
+        result["mask_path"] = save_path
 
-    # -------------------------------------------------------
-    # Extract contour coordinates
-    # -------------------------------------------------------
-    contours, _ = cv2.findContours(
-        mask_255, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-    )
-    coords = [c.reshape(-1, 2).tolist() for c in contours]
+    return result
 
-    # -------------------------------------------------------
-    # Save mask image
-    # -------------------------------------------------------
-    mask_img = Image.fromarray(mask_255)
-    mask_img.save(save_path)
 
+# -------------------------------------------------------
+# 4) MANY PROMPTS FOR ONE IMAGE
+# -------------------------------------------------------
+@app.post("/segment_batch")
+async def segment_batch(
+    prompts: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    refine: bool = Form(False)
+):
+    # prompts: JSON list of {"points": [[x, y], ...], "labels": [1, 0, ...], "box": [x0, y0, x1, y1]},
+    # points and box are both optional but each group needs one of them.
+    groups, error = _parse_prompt_groups(prompts)
+    if error:
+        return {"error": error}
+
+    image_id, entry = await _lookup_embedding(file, image_id, want_guide=refine)
+    if image_id is None:
+        return entry
+
+    guide = guides.get(image_id) if refine else None
+    decoded = await decoder.run(decode_prompt_groups, entry, groups, guide)
+
+    results = []
+    for mask, score in decoded:
+        mask_255 = mask.astype(np.uint8) * 255
+        results.append({
+            "mask_rle": mask_to_rle(mask),
+            "mask_coords": _mask_contours(mask_255),
+            "confidence": float(score),
+            "area": int(mask.sum()),
+        })
+
+    return {"status": "success", "image_id": image_id, "refined": guide is not None, "results": results}
+
+
+@app.post("/segment_everything")
+async def segment_everything_endpoint(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    points_per_side: int = Form(32),
+    points_per_batch: int = Form(128),
+    pred_iou_thresh: float = Form(0.88),
+    stability_score_thresh: float = Form(0.95),
+    box_nms_thresh: float = Form(0.7),
+    max_masks: Optional[int] = Form(None)
+):
+    if not 1 <= points_per_side <= 64:
+        return {"error": "points_per_side must be between 1 and 64."}
+
+    image_id, entry = await _lookup_embedding(file, image_id)
+    if image_id is None:
+        return entry
+
+    masks = await decoder.run(
+        segment_everything, entry, points_per_side, points_per_batch,
+        pred_iou_thresh, stability_score_thresh, box_nms_thresh,
+    )
+    masks.sort(key=lambda m: m["predicted_iou"], reverse=True)
+    if max_masks is not None:
+        masks = masks[:max_masks]
+
+    # "segmentation" is COCO uncompressed RLE: column-major run lengths starting with 0s.
     return {
         "status": "success",
-        "mask_path": save_path,
-        "mask_coords": coords,
-        "confidence": float(scores[best])
+        "image_id": image_id,
+        "masks": [
+            {
+                "segmentation": m["segmentation"],
+                "bbox": m["bbox"],
+                "area": m["area"],
+                "predicted_iou": m["predicted_iou"],
+                "stability_score": m["stability_score"],
+                "point_coords": m["point_coords"],
+            }
+            for m in masks
+        ],
     }
 
 
 # -------------------------------------------------------
-# 3) UNLOAD MODEL
+# 5) UNLOAD MODEL
 # -------------------------------------------------------
 @app.post("/free_sam")
-async def free_sam():
-    global sam, predictor
-
-    if sam is None:
+async def free_sam(force: bool = False):
+    # Demotes SAM to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued
+    # decodes first.
+    if force:
+        location = await decoder.run(residency.evict, MODEL_KEY)
+    else:
+        location = await off_loop(residency.release, MODEL_KEY)
+
+    if location is None:
         return {"status": "already_empty"}
 
-    del sam
-    del predictor
-    sam = None
-    predictor = None
+    return {"status": "freed", "location": location}
 
-    torch.cuda.empty_cache()
-    torch.cuda.synchronize()
 
-    return {"status": "freed"}
+@app.get("/batching")
+def batching_stats():
+    return {**encoder_batcher.stats(), "embedding_cache": embedding_cache.stats()}
 
 
 @app.get("/")
@@ -1,11 +1,22 @@
+import os
+import sys
 import torch
 import base64
 import io
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Optional
 from diffusers import SanaPipeline
 from nunchaku import NunchakuSanaTransformer2DModel
 from fastapi.middleware.cors import CORSMiddleware
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.executor import ModelExecutor, router as executor_router
+from common.jobs import JobManager, pipeline_progress
+from common.transport import bytes_response, check_format, decode_image, encode_image, image_response
+from common.result_cache import ResultCache, cache_key, router as cache_router
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -14,8 +25,17 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-pipe = None
-transformer = None
+app.include_router(residency_router)
+app.include_router(executor_router)
+app.include_router(cache_router)
+
+MODEL_KEY = "sana_1600m_int4"
+MODEL_REVISION = "svdq-int4_r32+Sana_1600M_1024px_BF16"
+executor = ModelExecutor("sana", max_queue=4)
+jobs = JobManager(executor)
+# Generation is seeded, so the same request always gives the same image.
+image_cache = ResultCache("sana_images")
+app.include_router(jobs.router())
 
 
 # ----------------------------
@@ -33,28 +53,34 @@ class InferenceRequest(BaseModel):
 # ----------------------------
 # LOAD MODEL
 # ----------------------------
-@app.get("/load")
-def load_model():
-    global pipe, transformer
+def _load_pipe():
+    transformer = NunchakuSanaTransformer2DModel.from_pretrained(
+        "nunchaku-tech/nunchaku-sana/svdq-int4_r32-sana1.6b.safetensors"
+    )
 
-    if pipe is not None:
-        return {"status": "already_loaded"}
+    pipe = SanaPipeline.from_pretrained(
+        "Efficient-Large-Model/Sana_1600M_1024px_BF16_diffusers",
+        transformer=transformer,
+        variant="bf16",
+        torch_dtype=torch.bfloat16,
+    ).to("cuda")
 
-    try:
-        transformer = NunchakuSanaTransformer2DModel.from_pretrained(
-            "nunchaku-tech/nunchaku-sana/svdq-int4_r32-sana1.6b.safetensors"
-        )
+    pipe.vae.to(torch.bfloat16)
+    pipe.text_encoder.to(torch.bfloat16)
+    return pipe
 
-        pipe = SanaPipeline.from_pretrained(
-            "Efficient-Large-Model/Sana_1600M_1024px_BF16_diffusers",
-            transformer=transformer,
-            variant="bf16",
-            torch_dtype=torch.bfloat16,
-        ).to("cuda")
 
-        pipe.vae.to(torch.bfloat16)
-        pipe.text_encoder.to(torch.bfloat16)
+residency.register(MODEL_KEY, _load_pipe)
 
+
+@app.get("/load")
+def load_model():
+    # Advisory: /run loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
+        return {"status": "already_loaded"}
+
+    try:
+        residency.acquire(MODEL_KEY)
         return {"status": "model_loaded"}
 
     except Exception as e:
@@ -65,15 +91,19 @@ def load_model():
 # UNLOAD MODEL (Free GPU)
 # ----------------------------
 @app.get("/unload")
-def unload_model():
-    global pipe, transformer
-
+async def unload_model(force: bool = False):
+    # Demotes the pipeline to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services; the next /run copies it back.
+    # `force=true` also waits for queued jobs first.
     try:
-        pipe = None
-        transformer = None
-        torch.cuda.empty_cache()
-        return {"status": "model_unloaded"}
-
+        if force:
+            location = await executor.run(residency.evict, MODEL_KEY)
+        else:
+            location = await off_loop(residency.release, MODEL_KEY)
+        return {"status": "model_unloaded", "location": location}
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -81,17 +111,11 @@ def unload_model():
 # ----------------------------
 # RUN INFERENCE
 # ----------------------------
-@app.post("/run")
-def run_inference(req: InferenceRequest):
-    global pipe
+def _generate(req, job=None):
+    generator = torch.Generator(device="cuda").manual_seed(req.seed)
 
-    if pipe is None:
-        raise HTTPException(status_code=400, detail="Model is not loaded. Call /load first.")
-
-    try:
-        generator = torch.Generator(device="cuda").manual_seed(req.seed)
-
-        image = pipe(
+    with residency.lease(MODEL_KEY) as pipe, pipeline_progress(pipe, job, stage="denoise"):
+        return pipe(
             prompt=req.prompt,
             height=req.height,
             width=req.width,
@@ -100,12 +124,44 @@ def run_inference(req: InferenceRequest):
             generator=generator,
         ).images[0]
 
-        # Convert to base64
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
-        return {"image_base64": img_str}
+def _to_base64(image):
+    return base64.b64encode(encode_image(image)).decode("utf-8")
+
 
+@app.post("/run")
+async def run_inference(req: InferenceRequest, format: str = "json"):
+    # format=png|webp|npy returns the image as a raw body instead of base64 JSON.
+    check_format(format)
+    try:
+        key = cache_key(MODEL_KEY, MODEL_REVISION, **req.dict())
+        png = image_cache.get(key)
+        if png is None:
+            image = await executor.run(_generate, req)
+            png = encode_image(image)
+            image_cache.put(key, png)
+        elif format not in ("json", "png"):
+            image = decode_image(png)
+
+        if format in ("json", "png"):
+            return bytes_response(png, format)
+        return image_response(image, format)
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+# ----------------------------
+# RUN AS A JOB
+# ----------------------------
+def _generate_job(job, req):
+    return {"image_base64": _to_base64(_generate(req, job=job))}
+
+
+@app.post("/jobs/run")
+async def submit_inference(req: InferenceRequest, supersede: Optional[str] = None):
+    # Same as /run, but returns a job id right away; see /jobs/{id}/events and /jobs/{id}/result.
+    job = jobs.submit("sana", _generate_job, req, supersede_key=supersede)
+    return job.info()
@@ -1,4 +1,5 @@
 import os
+import sys
 import pickle
 import numpy as np
 import tensorflow as tf
@@ -12,6 +13,9 @@ import base64
 from .smartcrop_utils import network
 from .smartcrop_utils.actions import command2action, generate_bbox, crop_input
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.result_cache import ResultCache, cache_key, router as cache_router
+
 app = FastAPI()
 
 app.add_middleware(
@@ -21,6 +25,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(cache_router)
+
+# Only the bbox is cached; cropping the original again is cheap.
+bbox_cache = ResultCache("smartcrop_bbox", disk_bytes=16 * 1024 ** 2)
 
 model = None
 var_dict = None
@@ -132,12 +140,18 @@ async def run_auto_crop(image: UploadFile = File(...)):
         image_bytes = await image.read()
         pil_image = Image.open(BytesIO(image_bytes)).convert("RGB")
 
-        # Convert to numpy float32 and normalize
-        im_np = np.array(pil_image).astype(np.float32) / 255.0
-        im_input = [im_np - 0.5]     # model expects mean-centered input
-
-        # Run auto-cropping
-        xmin, ymin, xmax, ymax = auto_cropping(model, im_input)[0]
+        key = cache_key("vfn_rl", "1", image_bytes)
+        cached = bbox_cache.get(key)
+        if cached is not None:
+            xmin, ymin, xmax, ymax = cached
+        else:
+            # Convert to numpy float32 and normalize
+            im_np = np.array(pil_image).astype(np.float32) / 255.0
+            im_input = [im_np - 0.5]     # model expects mean-centered input
+
+            # Run auto-cropping
+            xmin, ymin, xmax, ymax = auto_cropping(model, im_input)[0]
+            bbox_cache.put(key, [int(xmin), int(ymin), int(xmax), int(ymax)])
 
         # Crop original resolution
         original_np = np.array(pil_image)
@@ -1,17 +1,25 @@
 import os
-import base64
-from fastapi import FastAPI, File, UploadFile, Form
+import sys
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from io import BytesIO
-from PIL import Image
 import rembg
 import torch
 from contextlib import nullcontext
+from typing import Optional
 from sf3d.system import SF3D
 from sf3d.utils import remove_background, resize_foreground
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.executor import ModelExecutor, router as executor_router
+from common.jobs import JobManager
+from common.transport import MEDIA_TYPES, bytes_response, decode_image
+from common.result_cache import ResultCache, cache_key, router as cache_router
+
 app = FastAPI()
+app.include_router(residency_router)
+app.include_router(executor_router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,30 +29,95 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global model placeholder
-model = None
+MODEL_KEY = "sf3d"
+# Checkpoint behind MODEL_KEY; /load can switch it.
+model_id = "stabilityai/stable-fast-3d"
 rembg_session = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
+executor = ModelExecutor(MODEL_KEY, max_queue=4)
+jobs = JobManager(executor)
+app.include_router(jobs.router())
+app.include_router(cache_router)
+# Reconstruction is deterministic for a given image and settings.
+mesh_cache = ResultCache("sf3d_meshes", memory_bytes=512 * 1024 ** 2, disk_bytes=4 * 1024 ** 3)
+
+
+def _load_sf3d():
+    model = SF3D.from_pretrained(
+        model_id,
+        config_name="config.yaml",
+        weight_name="model.safetensors",
+    )
+    model.to(device)
+    model.eval()
+    return model
+
+
+residency.register(MODEL_KEY, _load_sf3d)
+
+
+def _load(pretrained_model):
+    global model_id
+    _prepare_session()
+    if pretrained_model != model_id:
+        # Another checkpoint: drop the current weights so acquire loads the new ones.
+        residency.evict(MODEL_KEY, drop=True)
+        model_id = pretrained_model
+    residency.acquire(MODEL_KEY)
+
 
 @app.post("/load")
-def load_model(pretrained_model: str = "stabilityai/stable-fast-3d"):
-    global model, rembg_session
-    if model:
+async def load_model(pretrained_model: str = "stabilityai/stable-fast-3d"):
+    # Advisory: /run loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None and pretrained_model == model_id:
         return {"status": "Model already loaded"}
     
     try:
-        rembg_session = rembg.new_session()
-        model = SF3D.from_pretrained(
-            pretrained_model,
-            config_name="config.yaml",
-            weight_name="model.safetensors",
-        )
-        model.to(device)
-        model.eval()
-        return {"status": "Model loaded", "device": device}
+        # On the worker, so a switch never drops the model under a running job.
+        await executor.run(_load, pretrained_model)
+        return {"status": "Model loaded", "model": model_id, "device": device}
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+def _reconstruct(pil_image, foreground_ratio, texture_resolution, remesh_option, target_vertex_count, job=None):
+    # SF3D is a single forward pass, so jobs only report coarse stages.
+    if job:
+        job.progress(0, 3, stage="remove_background")
+
+    # Background removal runs on the worker too, it is the other heavy step.
+    pil_image = remove_background(pil_image, rembg_session)
+    pil_image = resize_foreground(pil_image, foreground_ratio)
+
+    if job:
+        job.progress(1, 3, stage="reconstruct")
+
+    with residency.lease(MODEL_KEY) as model, torch.no_grad():
+        with torch.autocast(
+            device_type=device, dtype=torch.bfloat16
+        ) if "cuda" in device else nullcontext():
+            mesh, _ = model.run_image(
+                [pil_image],
+                bake_resolution=texture_resolution,
+                remesh=remesh_option,
+                vertex_count=target_vertex_count,
+            )
+    return mesh
+
+
+def _export_glb(mesh):
+    # Export mesh as .glb to memory; jobs and /run can export at the same time,
+    # so there is no shared file on disk.
+    return mesh.export(file_type="glb", include_normals=True)
+
+
+def _prepare_session():
+    global rembg_session
+    if rembg_session is None:
+        rembg_session = rembg.new_session()
+
+
 @app.post("/run")
 async def run_inference(
     image: UploadFile = File(...),
@@ -52,49 +125,84 @@ async def run_inference(
     texture_resolution: int = 1024,
     remesh_option: str = "none",
     target_vertex_count: int = -1,
+    format: str = "json",
 ):
-    global model, rembg_session
-    if not model:
-        return JSONResponse(status_code=400, content={"error": "Model not loaded. Call /load first."})
-    
+    # format=glb returns the mesh as a raw model/gltf-binary body instead of base64 JSON.
+    if format not in ("json", "glb"):
+        return JSONResponse(status_code=400, content={"error": "format must be json or glb"})
+
     try:
+        _prepare_session()
+
         # Load and preprocess image
         image_bytes = await image.read()
-        pil_image = Image.open(BytesIO(image_bytes)).convert("RGBA")
-        pil_image = remove_background(pil_image, rembg_session)
-        pil_image = resize_foreground(pil_image, foreground_ratio)
-        
-        with torch.no_grad():
-            with torch.autocast(
-                device_type=device, dtype=torch.bfloat16
-            ) if "cuda" in device else nullcontext():
-                mesh, _ = model.run_image(
-                    [pil_image],
-                    bake_resolution=texture_resolution,
-                    remesh=remesh_option,
-                    vertex_count=target_vertex_count,
-                )
-        # Export mesh as .glb to memory
-        glb_path = "output/mesh.glb"
-        os.makedirs("output", exist_ok=True)
-        mesh.export(glb_path, include_normals=True)
-        
-        with open(glb_path, "rb") as f:
-            mesh_data = base64.b64encode(f.read()).decode("utf-8")
-        
-        return {"status": "Success", "mesh_glb_base64": mesh_data}
-    
+        key = cache_key(
+            MODEL_KEY, model_id, image_bytes,
+            foreground_ratio=foreground_ratio, texture_resolution=texture_resolution,
+            remesh_option=remesh_option, target_vertex_count=target_vertex_count,
+        )
+        glb_bytes = mesh_cache.get(key)
+
+        if glb_bytes is None:
+            pil_image = decode_image(image_bytes).convert("RGBA")
+
+            mesh = await executor.run(
+                _reconstruct, pil_image, foreground_ratio,
+                texture_resolution, remesh_option, target_vertex_count,
+            )
+            glb_bytes = _export_glb(mesh)
+            mesh_cache.put(key, glb_bytes)
+
+        return bytes_response(
+            glb_bytes, format, media_type=MEDIA_TYPES["glb"],
+            key="mesh_glb_base64", extra={"status": "Success"},
+        )
+
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+def _reconstruct_job(job, *args):
+    mesh = _reconstruct(*args, job=job)
+    job.progress(2, 3, stage="export")
+    return bytes_response(
+        _export_glb(mesh), key="mesh_glb_base64", extra={"status": "Success"}
+    )
+
+
+@app.post("/jobs/run")
+async def submit_inference(
+    image: UploadFile = File(...),
+    foreground_ratio: float = 0.85,
+    texture_resolution: int = 1024,
+    remesh_option: str = "none",
+    target_vertex_count: int = -1,
+    supersede: Optional[str] = None,
+):
+    # Same as /run, but returns a job id right away; see /jobs/{id}/events and /jobs/{id}/result.
+    _prepare_session()
+    image_bytes = await image.read()
+    pil_image = decode_image(image_bytes).convert("RGBA")
+
+    job = jobs.submit(
+        "sf3d", _reconstruct_job, pil_image, foreground_ratio,
+        texture_resolution, remesh_option, target_vertex_count,
+        supersede_key=supersede,
+    )
+    return job.info()
+
+
 @app.post("/unload")
-def unload_model():
-    global model
-    if model:
-        del model
-        model = None
-        torch.cuda.empty_cache()
-        return {"status": "Model unloaded and GPU memory cleared"}
+async def unload_model(force: bool = False):
+    # Demotes the model to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued jobs first.
+    if force:
+        location = await executor.run(residency.evict, MODEL_KEY)
+    else:
+        location = await off_loop(residency.release, MODEL_KEY)
+    if location is not None:
+        return {"status": "Model unloaded and GPU memory cleared", "location": location}
     else:
         return {"status": "No model to unload"}
 
@@ -1,4 +1,6 @@
 import io
+import os
+import sys
 import base64
 import torch
 from PIL import Image
@@ -10,6 +12,11 @@ huggingface_hub.cached_download = huggingface_hub.hf_hub_download
 from sentence_transformers import SentenceTransformer, util
 from diffusers import StableDiffusionImg2ImgPipeline
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.sd15_pool import get_pool
+from common.executor import ModelExecutor, router as executor_router
+
 
 
 lora_list = [{
@@ -266,6 +273,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.include_router(residency_router)
+app.include_router(executor_router)
 
 
 print("Loading embedding model...")
@@ -296,47 +305,71 @@ def unify_prompt(x):
 
 
 class SDModelManager:
+    """Img2Img views over the SD1.5 components shared with the other tools in this process."""
+
     def __init__(self):
-        self.pipe = None
+        self.pool = get_pool()
+
+    @property
+    def pipe(self):
+        return self.pool.pipeline(StableDiffusionImg2ImgPipeline) if self.loaded else None
+
+    @property
+    def loaded(self):
+        return residency.get(self.pool.key) is not None
 
     def load(self):
-        if self.pipe is None:
+        if not self.loaded:
             print("LOADING Stable Diffusion Img2Img Pipeline...")
-            self.pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-                "runwayml/stable-diffusion-v1-5",
-                torch_dtype=torch.float16
-            ).to("cuda")
+            self.pool.components()
             print("Pipeline loaded into GPU!")
             return True
         else:
             print("Pipeline already loaded.")
             return False
 
-    def unload(self):
-        if self.pipe is not None:
-            print("UNLOADING Stable Diffusion Pipeline...")
-            del self.pipe
-            self.pipe = None
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
-            print("Pipeline removed from GPU.")
-            return True
-        return False
+    def acquire(self):
+        return self.pool.pipeline(StableDiffusionImg2ImgPipeline)
+
+    def unload(self, force=False):
+        # Demotes the shared components to pinned CPU RAM (once the running job
+        # ends), so the VRAM goes back to the other services.
+        if force:
+            return self.pool.evict() is not None
+        return self.pool.release() is not None
 
 
 model_mgr = SDModelManager()
+executor = ModelExecutor("style_transfer", max_queue=4)
+
+
+def _stylize(init_image, best_lora, final_prompt, final_negative):
+    pipe = model_mgr.acquire()
+
+    # The LoRA is patched into the shared UNet only for the duration of this job.
+    with model_mgr.pool.use(pipe, lora_path=best_lora["path_to_lora"]):
+        return pipe(
+            prompt=final_prompt,
+            negative_prompt=final_negative,
+            image=init_image,
+            strength=0.6,
+            num_inference_steps=best_lora["num_inference_steps"],
+            guidance_scale=best_lora["guidance"],
+            cross_attention_kwargs={"scale": best_lora["strength"]},
+        ).images[0]
 
 
 
 @app.post("/load_model")
-def load_model():
-    status = model_mgr.load()
+async def load_model():
+    status = await executor.run(model_mgr.load)
     return {"status": "loaded" if status else "already_loaded"}
 
 
 @app.post("/unload_model")
-def unload_model():
-    status = model_mgr.unload()
+async def unload_model(force: bool = False):
+    # A forced unload waits behind queued jobs instead of pulling the weights mid-run.
+    status = await executor.run(model_mgr.unload, True) if force else await off_loop(model_mgr.unload)
     return {"status": "unloaded" if status else "not_loaded"}
 
 
@@ -346,14 +379,6 @@ async def generate(
     prompt: str = Form(...),
     image: UploadFile = File(...)
 ):
-    
-    if model_mgr.pipe is None:
-        print("Auto-loading pipeline for generation...")
-        model_mgr.load()
-
-    pipe = model_mgr.pipe
-
-    
     img_bytes = await image.read()
     init_image = Image.open(io.BytesIO(img_bytes)).convert("RGB").resize((512,512))
 
@@ -365,19 +390,7 @@ async def generate(
     final_prompt = f"{trigger} {prompt}"
     final_negative = unify_prompt(best_lora["negative_prompt"])
 
-    
-    pipe.load_lora_weights(best_lora["path_to_lora"])
-
-    
-    out = pipe(
-        prompt=final_prompt,
-        negative_prompt=final_negative,
-        image=init_image,
-        strength=0.6,
-        num_inference_steps=best_lora["num_inference_steps"],
-        guidance_scale=best_lora["guidance"],
-        cross_attention_kwargs={"scale": best_lora["strength"]},
-    ).images[0]
+    out = await executor.run(_stylize, init_image, best_lora, final_prompt, final_negative)
 
     
     buf = io.BytesIO()
@@ -1,32 +1,255 @@
-import io
-import base64
+import os
+import sys
+import math
+import time
+import numpy as np
 import torch
+import torch.nn.functional as F
+from typing import Optional
 from fastapi import FastAPI, UploadFile, File, Form
-from PIL import Image
+from PIL import Image, ImageFilter, ImageStat
 import huggingface_hub
 huggingface_hub.cached_download = huggingface_hub.hf_hub_download
 from diffusers import StableDiffusionUpscalePipeline
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import off_loop, residency, router as residency_router
+from common.executor import ModelExecutor, router as executor_router
+from common.transport import check_format, decode_image, image_response
+
 
 app = FastAPI()
+app.include_router(residency_router)
+app.include_router(executor_router)
 
-pipe = None
+MODEL_KEY = "stabilityai/stable-diffusion-x4-upscaler"
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 
+def _load_pipe():
+    pipe = StableDiffusionUpscalePipeline.from_pretrained(
+        MODEL_KEY,
+        torch_dtype=torch.float16
+    ).to(device)
+    # Decodes the 2048x2048 output in tiles instead of one large activation.
+    pipe.vae.enable_tiling()
+    return pipe
+
+
+residency.register(MODEL_KEY, _load_pipe)
+
+executor = ModelExecutor("upscaler", max_queue=4)
+
+
+def _upscale(low_res, prompt):
+    with residency.lease(MODEL_KEY) as pipe, torch.autocast("cuda", dtype=torch.float16):
+        return pipe(prompt=prompt, image=low_res).images[0]
+
+
+# -------------------------------------------------------
+# Tiling: any size and aspect ratio, bounded VRAM
+# -------------------------------------------------------
+SCALE = 4
+TILE = 128          # input pixels per tile; the x4 upscaler's latents are at input resolution
+TILE_OVERLAP = 32
+TILE_BATCH = 4      # tiles per pipeline call, this (not the image size) sets peak VRAM
+MAX_OUTPUT_PIXELS = 64 * 1024 ** 2
+
+
+def _tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride))
+    return starts + [length - tile]
+
+
+def _feather(size, ramp):
+    # Linear ramp across the overlap at both ends; weights are normalized after
+    # accumulation, so tiles on the image border are unaffected.
+    return np.minimum(1.0, (np.minimum(np.arange(size), np.arange(size)[::-1]) + 1) / (ramp + 1))
+
+
+def blend_tiles(image, scale, tile, overlap, batch_size, run_tiles):
+    """
+    Upscales `image` by `scale` tile by tile: overlapping tile x tile crops go
+    through `run_tiles(list of uint8 arrays) -> list of upscaled arrays`
+    `batch_size` at a time and are blended with feathered weights.
+    """
+    w, h = image.size
+    # Images smaller than one tile are edge-padded up to it and cropped after.
+    pixels = np.asarray(image)
+    pad_w, pad_h = max(0, tile - w), max(0, tile - h)
+    if pad_w or pad_h:
+        pixels = np.pad(pixels, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+    ph, pw = pixels.shape[:2]
+
+    boxes = [(x, y) for y in _tile_starts(ph, tile, overlap) for x in _tile_starts(pw, tile, overlap)]
+    out = np.zeros((ph * scale, pw * scale, 3), dtype=np.float32)
+    weight = np.zeros((ph * scale, pw * scale, 1), dtype=np.float32)
+    ramp = _feather(tile * scale, overlap * scale)
+    tile_weight = np.outer(ramp, ramp)[..., None].astype(np.float32)
+    size = tile * scale
+
+    for i in range(0, len(boxes), batch_size):
+        batch = boxes[i:i + batch_size]
+        results = run_tiles([pixels[y:y + tile, x:x + tile] for x, y in batch])
+
+        for (x, y), result in zip(batch, results):
+            ys, xs = y * scale, x * scale
+            out[ys:ys + size, xs:xs + size] += np.asarray(result, dtype=np.float32) * tile_weight
+            weight[ys:ys + size, xs:xs + size] += tile_weight
+
+    out = (out / weight)[:h * scale, :w * scale]
+    return Image.fromarray(np.clip(out, 0, 255).round().astype(np.uint8))
+
+
+def _upscale_tiled(image, prompt):
+    """Diffusion x4 at the image's own size and aspect ratio."""
+
+    def run_tiles(tiles):
+        # Same seed for every batch so the added noise looks alike across seams.
+        generator = torch.Generator(device).manual_seed(0)
+        with torch.autocast("cuda", dtype=torch.float16):
+            images = pipe(
+                prompt=[prompt] * len(tiles),
+                image=[Image.fromarray(t) for t in tiles],
+                generator=generator,
+            ).images
+        return [np.asarray(im) for im in images]
+
+    with residency.lease(MODEL_KEY) as pipe:
+        return blend_tiles(image, SCALE, TILE, TILE_OVERLAP, TILE_BATCH, run_tiles)
+
+
+# -------------------------------------------------------
+# Fast tier: Swin2SR x2 (~1M params), Lanczos if it cannot be loaded
+# -------------------------------------------------------
+FAST_MODEL_KEY = "caidas/swin2SR-classical-sr-x2-64"
+FAST_TILE = 256
+FAST_TILE_OVERLAP = 16
+FAST_TILE_BATCH = 4
+SWIN_WINDOW = 8
+fast_model_failed = False
+
+
+def _load_fast_model():
+    from transformers import Swin2SRForImageSuperResolution
+
+    return Swin2SRForImageSuperResolution.from_pretrained(FAST_MODEL_KEY).eval().to(device)
+
+
+residency.register(FAST_MODEL_KEY, _load_fast_model, priority=1)
+
+# Own worker, so quick upscales never wait behind a diffusion run.
+fast_executor = ModelExecutor("upscaler_fast", max_queue=16)
+
+
+def _swin2sr_tiles(model, tiles):
+    batch = torch.from_numpy(np.stack(tiles)).to(device).permute(0, 3, 1, 2).float() / 255.0
+    h, w = batch.shape[-2:]
+    # Swin2SR needs sides that are a multiple of its window size.
+    batch = F.pad(batch, (0, -w % SWIN_WINDOW, 0, -h % SWIN_WINDOW), mode="reflect")
+    with torch.no_grad():
+        out = model(pixel_values=batch).reconstruction[..., :h * 2, :w * 2]
+    out = (out.clamp(0, 1) * 255).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+    return list(out)
+
+
+def _upscale_fast(image, scale):
+    """x2 Swin2SR passes until the requested scale is reached, then Lanczos to the exact size."""
+    global fast_model_failed
+    w, h = image.size
+    target = (round(w * scale), round(h * scale))
+
+    if fast_model_failed:
+        return image.resize(target, Image.LANCZOS), "lanczos"
+    try:
+        residency.acquire(FAST_MODEL_KEY)
+    except (OSError, ImportError, ValueError) as e:
+        # The checkpoint can't be downloaded or loaded (e.g. offline without a
+        # cache), so it won't work on a retry either.
+        print(f"Swin2SR unavailable, falling back to Lanczos: {e}")
+        fast_model_failed = True
+        return image.resize(target, Image.LANCZOS), "lanczos"
+    except RuntimeError as e:
+        # e.g. CUDA OOM while another model is resident: only this request falls back.
+        print(f"Swin2SR could not be placed on the GPU, Lanczos for this request: {e}")
+        return image.resize(target, Image.LANCZOS), "lanczos"
+
+    out = image
+    reached = 1
+    with residency.lease(FAST_MODEL_KEY) as model:
+        while reached < scale:
+            out = blend_tiles(
+                out, 2, FAST_TILE, FAST_TILE_OVERLAP, FAST_TILE_BATCH,
+                lambda tiles: _swin2sr_tiles(model, tiles),
+            )
+            reached *= 2
+    if out.size != target:
+        out = out.resize(target, Image.LANCZOS)
+    return out, "swin2sr"
+
+
+# -------------------------------------------------------
+# Routing
+# -------------------------------------------------------
+ENHANCE_MAX_INPUT_SIDE = 512   # bigger photos already have the detail diffusion would invent
+SOFT_EDGE_VARIANCE = 150.0     # edge-map variance below this reads as a soft, low-detail image
+DEFAULT_ENHANCE_MS = 30000.0
+_enhance_ms = None             # moving average of diffusion runs
+
+
+def edge_variance(image):
+    small = image.convert("L")
+    small.thumbnail((256, 256))
+    return ImageStat.Stat(small.filter(ImageFilter.FIND_EDGES)).var[0]
+
+
+def route(image, scale, budget_ms=None):
+    """
+    Picks the tier for mode=auto. Diffusion is only worth it for a x4
+    enlargement (the only factor it produces) of a small, soft image that fits
+    the latency budget; everything else goes to the fast tier.
+    """
+    if scale != SCALE:
+        return "fast"
+    if budget_ms is not None and budget_ms < (_enhance_ms or DEFAULT_ENHANCE_MS):
+        return "fast"
+    if max(image.size) > ENHANCE_MAX_INPUT_SIDE:
+        return "fast"
+    if edge_variance(image) < SOFT_EDGE_VARIANCE:
+        return "enhance"
+    return "fast"
+
+
+def output_scale(tier, scale, tiled):
+    """
+    Largest per-side factor the chosen tier produces, intermediates included:
+    the fast tier runs x2 passes up to the next power of two before resizing
+    down. None for the squashed non-tiled enhance, which is always 2048x2048.
+    """
+    if tier == "fast":
+        return 2 ** math.ceil(math.log2(scale))
+    return SCALE if tiled else None
+
+
+def _timed_enhance(fn, *args):
+    global _enhance_ms
+    start = time.monotonic()
+    result = fn(*args)
+    elapsed = (time.monotonic() - start) * 1000
+    _enhance_ms = elapsed if _enhance_ms is None else 0.8 * _enhance_ms + 0.2 * elapsed
+    return result
+
+
 @app.post("/load")
 def load_model():
-    global pipe
-
-    if pipe is not None:
+    # Advisory: /run loads on demand, this only warms the model up front.
+    if residency.get(MODEL_KEY) is not None:
         return {"status": "already_loaded"}
 
-    model_id = "stabilityai/stable-diffusion-x4-upscaler"
-
-    pipe = StableDiffusionUpscalePipeline.from_pretrained(
-        model_id,
-        torch_dtype=torch.float16
-    ).to(device)
+    residency.acquire(MODEL_KEY)
 
     return {
         "status": "model_loaded",
@@ -38,41 +261,61 @@ def load_model():
 @app.post("/run")
 async def run(
     file: UploadFile = File(...),
-    prompt: str = Form(...)
+    prompt: str = Form(""),
+    mode: str = Form("auto"),
+    scale: float = Form(4),
+    budget_ms: Optional[int] = Form(None),
+    tiled: bool = Form(False),
+    format: str = "json"
 ):
-    global pipe
-
-    if pipe is None:
-        return {"error": "Model not loaded. Use /load first."}
-
+    # mode: fast (Swin2SR, well under a second), enhance (SD x4 diffusion) or
+    # auto, which routes on scale, image content and budget_ms.
+    # For enhance, tiled=true keeps the input's size and aspect ratio (output is
+    # 4x each side); otherwise the input is squashed to 512x512 and comes back as 2048x2048.
+    # Auto only picks enhance for scale=4 and then always tiles, so its output
+    # is exactly `scale`x the input.
+    check_format(format)
+    if mode not in ("auto", "fast", "enhance"):
+        return {"error": "mode must be auto, fast or enhance."}
+    if not 1 < scale <= 8:
+        return {"error": "scale must be above 1 and at most 8."}
 
     img_bytes = await file.read()
-    low_res = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-
+    low_res = decode_image(img_bytes).convert("RGB")
 
-    low_res = low_res.resize((512, 512))
+    tier = route(low_res, scale, budget_ms) if mode == "auto" else mode
+    if mode == "auto" and tier == "enhance":
+        tiled = True
 
+    w, h = low_res.size
+    out_scale = output_scale(tier, scale, tiled)
+    if out_scale is not None and w * h * out_scale * out_scale > MAX_OUTPUT_PIXELS:
+        return {"error": f"Output would exceed {MAX_OUTPUT_PIXELS // 1024 ** 2} MP, send a smaller image."}
 
-    with torch.autocast("cuda", dtype=torch.float16):
-        upscaled = pipe(prompt=prompt, image=low_res).images[0]
+    if tier == "fast":
+        upscaled, tier = await fast_executor.run(_upscale_fast, low_res, scale)
+    elif tiled:
+        upscaled = await executor.run(_timed_enhance, _upscale_tiled, low_res, prompt)
+    else:
+        low_res = low_res.resize((512, 512))
 
+        upscaled = await executor.run(_timed_enhance, _upscale, low_res, prompt)
 
-    buf = io.BytesIO()
-    upscaled.save(buf, format="PNG")
-    img_b64 = base64.b64encode(buf.getvalue()).decode()
 
-    return {"upscaled_image_base64": img_b64}
+    return image_response(upscaled, format, key="upscaled_image_base64", extra={"tier": tier})
 
 
 @app.post("/unload")
-def unload_model():
-    global pipe
+async def unload_model(force: bool = False):
+    # Demotes the pipeline to pinned CPU RAM (once the running job ends), so the
+    # VRAM goes back to the other services. `force=true` also waits for queued
+    # jobs first.
+    if force:
+        location = await executor.run(residency.evict, MODEL_KEY)
+    else:
+        location = await off_loop(residency.release, MODEL_KEY)
 
-    if pipe is None:
+    if location is None:
         return {"status": "already_unloaded"}
 
-    del pipe
-    pipe = None
-    torch.cuda.empty_cache()
-
-    return {"status": "model_unloaded"}
+    return {"status": "model_unloaded", "location": location}
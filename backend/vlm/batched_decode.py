@@ -0,0 +1,212 @@
+import sys
+import threading
+
+import torch
+
+# Moondream's own query() sampling defaults.
+DEFAULT_TEMPERATURE = 0.5
+DEFAULT_TOP_P = 0.3
+DEFAULT_MAX_TOKENS = 768
+
+
+class _SlotCache:
+    """
+    Stands in for one decoder block's KVCache during a batched step. Every
+    sequence owns a `max_context` slice of the buffers, and `index` maps this
+    step's rows to their slots, so Moondream's attention writes each token's
+    keys into its own sequence.
+    """
+
+    def __init__(self, like, slots):
+        _, heads, context, head_dim = like.k_cache.shape
+        shape = (1, heads, slots * context, head_dim)
+        # Zeros, not empty: masked columns still go through softmax(...) @ v.
+        self.k_cache = torch.zeros(shape, device=like.k_cache.device, dtype=like.k_cache.dtype)
+        self.v_cache = torch.zeros_like(self.k_cache)
+        self.index = None
+
+    def update(self, pos_ids, k, v):
+        self.k_cache[:, :, self.index] = k
+        self.v_cache[:, :, self.index] = v
+        return self.k_cache, self.v_cache
+
+
+class Sequence:
+    """One streamed answer. `emit(event, data)` is called from the decode thread."""
+
+    def __init__(self, encoded, question, emit, max_tokens=DEFAULT_MAX_TOKENS):
+        self.encoded = encoded
+        self.question = question
+        self.emit = emit
+        self.max_tokens = max_tokens
+        self.cancelled = threading.Event()
+        self.slot = None
+        self.pos = 0
+        self.pending = []
+        self.tokens = []
+        self.sent = ""
+
+    def push(self, text):
+        # Held back while the text ends in half a multi-byte character.
+        if text.endswith("\ufffd") or len(text) <= len(self.sent):
+            return
+        self.emit("token", {"text": text[len(self.sent):]})
+        self.sent = text
+
+
+class BatchedDecoder:
+    """
+    Continuous batching for Moondream answers. Concurrent sequences share
+    every decode step: each step is one text-decoder call whose rows are the
+    pending tokens of all running sequences (the whole prompt for one that just
+    joined, one token otherwise). A sequence leaves the batch on its own EOS,
+    token limit or cancellation, and waiting ones take its slot at the next step.
+    """
+
+    def __init__(self, max_batch=4):
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._running = []
+        self.active = False
+        self.steps = 0
+        self.rows = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiting) + len(self._running)
+
+    def add(self, seq):
+        """Queues `seq`. Returns True when the caller has to start `run` on the model's worker."""
+        with self._lock:
+            self._waiting.append(seq)
+            start, self.active = not self.active, True
+            return start
+
+    def discard(self, seq):
+        with self._lock:
+            if seq in self._waiting:
+                self._waiting.remove(seq)
+            if not self._waiting and not self._running:
+                self.active = False
+
+    def stats(self):
+        return {
+            "running": len(self._running),
+            "waiting": len(self._waiting),
+            "max_batch": self.max_batch,
+            "steps": self.steps,
+            "mean_rows": self.rows / self.steps if self.steps else 0.0,
+        }
+
+    # ---------------------------------------------------
+
+    def run(self, model):
+        """Decodes until no sequence is left. Blocking, runs on the model's worker thread."""
+        moondream = getattr(model, "model", model)  # HF wrapper around MoondreamModel
+        blocks = moondream.text.blocks
+        caches = [_SlotCache(block.kv_cache, self.max_batch) for block in blocks]
+        context = blocks[0].kv_cache.k_cache.shape[2]
+        originals = [block.kv_cache for block in blocks]
+        try:
+            while self._admit(moondream, caches, context):
+                for block, cache in zip(blocks, caches):
+                    block.kv_cache = cache
+                try:
+                    self._step(moondream, caches, context)
+                finally:
+                    for block, cache in zip(blocks, originals):
+                        block.kv_cache = cache
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error):
+        """Ends every running and waiting sequence with an error event."""
+        with self._lock:
+            failed, self._running, self._waiting = self._running + self._waiting, [], []
+            self.active = False
+        for seq in failed:
+            seq.emit("error", {"error": str(error)})
+
+    def _admit(self, moondream, caches, context):
+        """Moves waiting sequences into free slots. Returns False (and stops) once idle."""
+        with self._lock:
+            self._running = [seq for seq in self._running if seq.slot is not None]
+            free = sorted(set(range(self.max_batch)) - {seq.slot for seq in self._running})
+            while free and self._waiting:
+                seq = self._waiting.pop(0)
+                if seq.cancelled.is_set():
+                    continue
+                seq.slot = free.pop(0)
+                self._running.append(seq)
+                self._prefill_slot(moondream, seq, caches, context)
+            if not self._running:
+                self.active = False
+                return False
+            return True
+
+    def _prefill_slot(self, moondream, seq, caches, context):
+        # The image part of the prompt comes from the session's encode_image.
+        base = seq.slot * context
+        for cache, (k, v) in zip(caches, seq.encoded.caches):
+            cache.k_cache[:, :, base:base + k.shape[2]] = k
+            cache.v_cache[:, :, base:base + v.shape[2]] = v
+        template = moondream.config.tokenizer.templates["query"]
+        seq.pos = seq.encoded.pos
+        seq.pending = template["prefix"] + moondream.tokenizer.encode(" " + seq.question).ids + template["suffix"]
+
+    @torch.no_grad()
+    def _step(self, moondream, caches, context):
+        running = list(self._running)
+        device = caches[0].k_cache.device
+
+        tokens, positions, slots, last_rows = [], [], [], []
+        for seq in running:
+            tokens += seq.pending
+            positions += range(seq.pos, seq.pos + len(seq.pending))
+            slots += [seq.slot] * len(seq.pending)
+            last_rows.append(len(tokens) - 1)
+        tokens = torch.tensor(tokens, device=device)
+        positions = torch.tensor(positions, device=device)
+        base = torch.tensor(slots, device=device) * context
+
+        # Row r attends to its own sequence's slot, up to and including itself.
+        index = base + positions
+        columns = torch.arange(caches[0].k_cache.shape[2], device=device)
+        mask = (columns[None] >= base[:, None]) & (columns[None] <= index[:, None])
+        for cache in caches:
+            cache.index = index
+
+        # The text model functions moondream.py itself uses.
+        functions = sys.modules[type(moondream).__module__]
+        x = functions.text_encoder(tokens[None], moondream.text)
+        hidden = functions.text_decoder(x, moondream.text, mask[None, None], positions, moondream.config.text)
+        logits = moondream.text.lm_head(moondream.text.post_ln(hidden[0, last_rows]))
+        next_tokens = _sample(logits, DEFAULT_TEMPERATURE, DEFAULT_TOP_P).tolist()
+
+        self.steps += 1
+        self.rows += len(index)
+        eos = moondream.config.tokenizer.eos_id
+        for seq, token in zip(running, next_tokens):
+            seq.pos += len(seq.pending)
+            if token != eos:
+                seq.tokens.append(token)
+                seq.push(moondream.tokenizer.decode(seq.tokens))
+            if seq.cancelled.is_set():
+                seq.slot = None
+            elif token == eos or len(seq.tokens) >= seq.max_tokens or seq.pos + 1 >= context:
+                seq.emit("done", {"answer": moondream.tokenizer.decode(seq.tokens)})
+                seq.slot = None
+            else:
+                seq.pending = [token]
+
+
+def _sample(logits, temperature, top_p):
+    if temperature == 0:
+        return logits.argmax(dim=-1)
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    sorted_probs, order = probs.sort(dim=-1, descending=True)
+    # Keep the smallest set of tokens whose probability reaches top_p.
+    sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p] = 0.0
+    choice = torch.multinomial(sorted_probs / sorted_probs.sum(dim=-1, keepdim=True), 1)
+    return order.gather(-1, choice).squeeze(-1)
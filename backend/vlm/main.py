@@ -1,10 +1,93 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from PIL import Image
 from io import BytesIO
-from .model import load_model, unload_model, get_model
+from .model import load_model, unload_model, run_model
+from .batched_decode import BatchedDecoder, Sequence
+from common.residency import off_loop, router as residency_router
+from common.executor import ModelExecutor, too_busy, router as executor_router
 
 app = FastAPI()
+app.include_router(residency_router)
+app.include_router(executor_router)
+
+executor = ModelExecutor("moondream", max_queue=8)
+
+# Encoded images keep their vision-tower KV cache on the GPU (~150 MB each).
+MAX_SESSIONS = 8
+SESSION_TTL_SECONDS = 10 * 60
+
+
+class ImageSessions:
+    """
+    Moondream `encode_image` results by image content hash, so any number of
+    captions and questions about one image only pay for the vision encoder once.
+    Least recently used sessions go first, and idle ones expire after the TTL.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # session_id -> [encoded image, last used]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id):
+        self._expire()
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        entry[1] = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return entry[0]
+
+    async def open(self, contents):
+        """Returns (session_id, encoded image) for uploaded bytes, encoding only unseen images."""
+        session_id = hashlib.sha256(contents).hexdigest()
+        encoded = self.get(session_id)
+        if encoded is not None:
+            self.hits += 1
+            return session_id, encoded
+
+        self.misses += 1
+        pil_image = Image.open(BytesIO(contents)).convert("RGB")
+        encoded = await executor.run(run_model, lambda model: model.encode_image(pil_image))
+        self._sessions[session_id] = [encoded, time.monotonic()]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return session_id, encoded
+
+    def close(self, session_id):
+        return self._sessions.pop(session_id, None) is not None
+
+    def clear(self):
+        self._sessions.clear()
+
+    def stats(self):
+        self._expire()
+        return {"sessions": len(self._sessions), "hits": self.hits, "misses": self.misses}
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        for session_id, (_, last_used) in list(self._sessions.items()):
+            if last_used < cutoff:
+                del self._sessions[session_id]
+
+
+sessions = ImageSessions()
+
+
+def _session(session_id):
+    encoded = sessions.get(session_id)
+    if encoded is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session, upload the image again.")
+    return encoded
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,34 +99,117 @@ app.add_middleware(
 
 @app.post("/load_model/")
 async def load_model_endpoint():
-    load_model()
+    await executor.run(load_model)
     return {"status": "Model loaded into GPU"}
 
 @app.post("/caption/")
 async def caption_image(image: UploadFile = File(...)):
-    model = get_model()
-    if model is None:
-        raise HTTPException(status_code=400, detail="Model not loaded. Please call /load_model first.")
-
-    contents = await image.read()
-    pil_image = Image.open(BytesIO(contents)).convert("RGB")
-    caption = model.caption(pil_image, length="normal")["caption"]
+    # One-shot calls go through the session cache too, so asking about the
+    # same upload again skips the vision encoder.
+    _, encoded = await sessions.open(await image.read())
+    caption = await executor.run(run_model, lambda model: model.caption(encoded, length="normal")["caption"])
     return {"caption": caption}
 
 @app.post("/query/")
 async def query_image(question: str, image: UploadFile = File(...)):
-    model = get_model()
-    if model is None:
-        raise HTTPException(status_code=400, detail="Model not loaded. Please call /load_model first.")
-    
-    contents = await image.read()
-    pil_image = Image.open(BytesIO(contents)).convert("RGB")
-    answer = model.query(pil_image, question)["answer"]
+    _, encoded = await sessions.open(await image.read())
+    answer = await executor.run(run_model, lambda model: model.query(encoded, question)["answer"])
     return {"answer": answer}
 
+# -------------------------------------------------------
+# Image sessions: upload once, then caption/query by session id
+# -------------------------------------------------------
+@app.post("/sessions/")
+async def open_session(image: UploadFile = File(...)):
+    session_id, _ = await sessions.open(await image.read())
+    return {"session_id": session_id, "ttl_seconds": SESSION_TTL_SECONDS}
+
+@app.post("/sessions/{session_id}/caption/")
+async def caption_session(session_id: str, length: str = "normal"):
+    encoded = _session(session_id)
+    caption = await executor.run(run_model, lambda model: model.caption(encoded, length=length)["caption"])
+    return {"caption": caption}
+
+@app.post("/sessions/{session_id}/query/")
+async def query_session(session_id: str, question: str):
+    encoded = _session(session_id)
+    answer = await executor.run(run_model, lambda model: model.query(encoded, question)["answer"])
+    return {"answer": answer}
+
+# -------------------------------------------------------
+# Token streaming (server-sent events)
+# -------------------------------------------------------
+# Concurrent streams are decoded together: BatchedDecoder runs one decode loop
+# on the model's worker, new questions join it at the next step and each one
+# leaves on its own EOS. A stream also leaves as soon as its client
+# disconnects, so abandoned questions do not take up a batch slot.
+MAX_STREAM_BATCH = 4
+MAX_STREAMS = 16  # running + waiting
+
+decoder = BatchedDecoder(max_batch=MAX_STREAM_BATCH)
+
+
+def _stream_response(encoded, question):
+    if len(decoder) >= MAX_STREAMS:
+        raise too_busy(executor.retry_after())
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    seq = Sequence(encoded, question, lambda event, data: loop.call_soon_threadsafe(queue.put_nowait, (event, data)))
+    if decoder.add(seq):
+        # Admitted (or rejected with 429) before the response starts.
+        try:
+            future = executor.submit(run_model, decoder.run)
+        except HTTPException:
+            decoder.discard(seq)
+            raise
+        # e.g. the model failed to load before the loop started.
+        future.add_done_callback(lambda f: f.exception() and decoder.fail(f.exception()))
+
+    async def events():
+        try:
+            while True:
+                event, data = await queue.get()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event != "token":
+                    return
+        finally:
+            seq.cancelled.set()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/query/stream/")
+async def query_image_stream(question: str, image: UploadFile = File(...)):
+    _, encoded = await sessions.open(await image.read())
+    return _stream_response(encoded, question)
+
+@app.post("/sessions/{session_id}/query/stream/")
+async def query_session_stream(session_id: str, question: str):
+    return _stream_response(_session(session_id), question)
+
+@app.get("/query/stream/stats")
+async def stream_stats():
+    return decoder.stats()
+
+@app.delete("/sessions/{session_id}")
+async def close_session(session_id: str):
+    return {"closed": sessions.close(session_id)}
+
+@app.get("/sessions/")
+async def session_stats():
+    return sessions.stats()
+
 @app.post("/unload_model/")
-async def unload_model_endpoint():
-    unload_model()
-    return {"status": "Model unloaded from GPU"}
+async def unload_model_endpoint(force: bool = False):
+    # A forced unload waits behind queued jobs instead of pulling the model mid-run.
+    location = await executor.run(unload_model, True) if force else await off_loop(unload_model)
+    if force:
+        # Encoded images hold VRAM of their own.
+        sessions.clear()
+    return {"status": "Model unloaded from GPU", "location": location}
 
 
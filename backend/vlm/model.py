@@ -1,39 +1,58 @@
-import torch
+import os
+import sys
 from transformers import AutoModelForCausalLM
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.residency import residency
+
 MODEL_NAME = "vikhyatk/moondream2"
 REVISION = "2025-06-21"
 
-_model = None
+
+def _build_model():
+    print("Loading model onto GPU...")
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        revision=REVISION,
+        trust_remote_code=True,
+    ).to("cuda")
+    print("Model loaded!")
+    return model
+
+
+residency.register(MODEL_NAME, _build_model, priority=1)
+
 
 def load_model():
     """
     Loads the model on the GPU if not already loaded.
     """
-    global _model
-    if _model is None:
-        print("Loading model onto GPU...")
-        _model = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME,
-            revision=REVISION,
-            trust_remote_code=True,
-        ).to("cuda")
-        print("Model loaded!")
+    return residency.acquire(MODEL_NAME)
 
 def get_model():
     """
-    Returns the model if it is loaded, else None.
+    Returns the model, promoting it back to the GPU if it was evicted.
+    """
+    return residency.acquire(MODEL_NAME)
+
+def model_lease():
+    """
+    Context manager keeping the model on the GPU for one job, see residency.lease.
+    """
+    return residency.lease(MODEL_NAME)
+
+def run_model(fn):
+    """
+    Calls fn(model) with the model leased for the whole call.
     """
-    return _model
+    with model_lease() as model:
+        return fn(model)
 
-def unload_model():
+def unload_model(force=False):
     """
-    Unloads the model from GPU and clears cache.
+    Demotes the model to pinned CPU RAM once its running job ends, so the VRAM
+    goes back to the other services. `force=True` waits for the job instead.
     """
-    global _model
-    if _model is not None:
-        print("Unloading model from GPU...")
-        del _model
-        torch.cuda.empty_cache()
-        _model = None
-        print("Model unloaded.")
+    if force:
+        return residency.evict(MODEL_NAME)
+    return residency.release(MODEL_NAME)
@@ -50,4 +50,50 @@ export const hitBackend = async (port, path, options = {}) => {
     // console.error(`Error hitting backend at ${url}:`, error);
     throw error;
   }
-};
\ No newline at end of file
+};
+
+/**
+ * Runs a long backend job without holding one HTTP request open for the whole
+ * run (the RunPod proxy times out on slow diffusion jobs). Submits to a
+ * `/jobs/...` endpoint, follows progress over SSE and fetches the result.
+ * @param {number} port - The specific port to hit.
+ * @param {string} path - The job submit path (e.g., '/jobs/run_ledits').
+ * @param {object} options - Fetch options for the submit request.
+ * @param {function} onProgress - Optional callback receiving each progress event.
+ * @param {boolean} previews - Ask for base64 latent previews in progress events.
+ * @returns {Promise<Response>} The result response once the job is done.
+ */
+export const runBackendJob = async (port, path, options = {}, onProgress = null, previews = false) => {
+  const baseUrl = getBackendUrl(port);
+  const submitted = await (await hitBackend(port, path, options)).json();
+  const jobId = submitted.job_id;
+
+  await new Promise((resolve, reject) => {
+    const events = new EventSource(`${baseUrl}/jobs/${jobId}/events?previews=${previews}`);
+    const finish = (handler) => (event) => {
+      events.close();
+      handler(JSON.parse(event.data));
+    };
+
+    events.addEventListener('progress', (event) => {
+      if (onProgress) onProgress(JSON.parse(event.data));
+    });
+    events.addEventListener('done', finish(resolve));
+    events.addEventListener('error', (event) => {
+      events.close();
+      reject(new Error(event.data ? JSON.parse(event.data).error : 'Job event stream failed'));
+    });
+    events.addEventListener('cancelled', finish(() => reject(new Error('Job was cancelled'))));
+  });
+
+  return hitBackend(port, `/jobs/${jobId}/result`);
+};
+
+/**
+ * Cancels a running or queued backend job.
+ * @param {number} port - The specific port to hit.
+ * @param {string} jobId - The id returned by the submit endpoint.
+ */
+export const cancelBackendJob = async (port, jobId) => {
+  return hitBackend(port, `/jobs/${jobId}`, { method: 'DELETE' });
+};